@@ -0,0 +1,218 @@
+# Modified by Paulo Chiliguano
+# Developed by Travis West
+# Directed by Dr Roberto Alonso Trillo
+# HKBU Academy of Music
+# 2024
+
+"""Batched fusion filter and gesture model
+
+Vectorized counterparts of FusionFilter and GestureModel advancing N devices
+in one call. The bridge fuses every device on its own partition of the
+pipeline, so these are only kept to compare both layouts in bench_bank.py.
+"""
+import sys
+from pathlib import Path
+from time import monotonic
+
+import numpy as np
+from pyquaternion import Quaternion
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from calibrator import Calibrator  # noqa: E402
+from features import quaternion_spherical_coords  # noqa: E402
+from gesture_model import GestureSnapshot  # noqa: E402
+
+
+class FusionFilterBank:
+    """State of N fusion filters advanced together in one vectorized call
+
+    Equivalent to N independent FusionFilter instances, with the state held
+    in (N, 3) and (N, 4) arrays.
+
+    Parameters
+    ----------
+    n : int
+        Number of filters (devices)
+    """
+    def __init__(self, n: int):
+        self.n = n
+        self.static_threshold = 0.01
+        self.galpha = 0.93
+        self.period = np.zeros(n)
+        self.current = np.full(n, monotonic())
+        self.previous = self.current.copy()
+        self.q = np.zeros((n, 4))
+        self.q[:, 0] = 1.0
+        self.rotation = np.tile(np.identity(3), (n, 1, 1))
+        self.b_hat = np.zeros((n, 3))
+        self.ma_earth = np.zeros((n, 3))
+        self.ma_sensor = np.zeros((n, 3))
+        self.da = np.zeros((n, 3))
+        self.anm1 = np.zeros((n, 3))
+        self.aa = np.zeros((n, 3))
+        self.gyro_bias = np.zeros((n, 3))
+        self.static = np.zeros(n, dtype=bool)
+
+    def set_gyro_bias_alpha(self, v):
+        self.galpha = v
+
+    def set_static_threshold(self, v):
+        self.static_threshold = v
+
+    def calculate_period(self):
+        self.current[:] = monotonic()
+        np.subtract(self.current, self.previous, out=self.period)
+        self.previous[:] = self.current
+
+        return self.period
+
+    def rotation_matrix(self):
+        return self.rotation
+
+    def fuse(self, omega, v_a, v_m, k_I = 0.0, k_P = 3.0, k_a=1.0, k_m=0.0, period=None):
+        """Advances every filter by one sample
+
+        Parameters
+        ----------
+        omega, v_a, v_m : numpy.ndarray
+            (N, 3) calibrated gyro, accl and magn samples
+        period : numpy.ndarray, optional
+            (N,) integration periods, host time since the last call otherwise
+
+        Returns
+        -------
+        numpy.ndarray
+            (N, 4) orientation quaternions (w, x, y, z)
+        """
+        if period is None:
+            period = self.calculate_period()
+        else:
+            self.period[:] = period
+            period = self.period
+
+        self.aa = self.anm1 * 0.5 + self.aa * 0.5 # average accel
+        np.subtract(self.aa, self.anm1, out=self.da) # "derivative" accel
+        self.static = np.sqrt(np.einsum('ni,ni->n', self.da, self.da)) < self.static_threshold
+        self.anm1 = np.array(v_a, dtype=float)
+
+        static = self.static[:, None]
+        self.gyro_bias = np.where(static, (1 - self.galpha) * omega + self.galpha * self.gyro_bias, self.gyro_bias)
+        omega = omega - self.gyro_bias
+
+        rotation = self.rotation
+        v_hat_a = rotation[:, 2, :] # estimated gravity vector in the sensor frame
+        np.subtract(v_a, v_hat_a, out=self.ma_sensor) # zero-g in sensor frame
+        self.ma_earth = np.einsum('nji,nj->ni', rotation, self.ma_sensor) # zero-g in global frame
+
+        v_a = v_a / np.linalg.norm(v_a, axis=1, keepdims=True)
+        v_m = v_m / np.linalg.norm(v_m, axis=1, keepdims=True)
+        v_x = np.cross(v_a, v_m)
+
+        h = np.einsum('nij,nj->ni', rotation, v_x)
+        b = np.zeros((self.n, 3))
+        b[:, 0] = np.hypot(h[:, 0], h[:, 1])
+        b[:, 2] = h[:, 2]
+        v_hat_x = np.einsum('nji,nj->ni', rotation, b) # estimated cross vector
+
+        w_mes = np.cross(v_a, v_hat_a) * k_a + np.cross(v_x, v_hat_x) * k_m
+
+        if k_I > 0.0:
+            self.b_hat += static * w_mes * period[:, None] # see eq. (48c)
+            omega += k_P * w_mes + k_I * self.b_hat
+        else:
+            self.b_hat[:] = 0.0 # Madgwick: "prevent integral windup"
+            omega += k_P * w_mes
+
+        self._integrate(omega, period)
+        return self.q
+
+    def _integrate(self, omega, period):
+        q = _fast_normalise_rows(self.q)
+        rotation_vector = omega * period[:, None]
+        angle = np.linalg.norm(rotation_vector, axis=1)
+        moving = angle > 0
+        half = 0.5 * angle
+        scale = np.divide(np.sin(half), angle, out=np.zeros_like(angle), where=moving)
+        c = np.where(moving, np.cos(half), 1.0)
+        x, y, z = (rotation_vector * scale[:, None]).T
+        qw, qx, qy, qz = q.T
+        q = np.stack((qw*c - qx*x - qy*y - qz*z,
+                      qw*x + qx*c + qy*z - qz*y,
+                      qw*y - qx*z + qy*c + qz*x,
+                      qw*z + qx*y - qy*x + qz*c), axis=1)
+        q = np.where(moving[:, None], _fast_normalise_rows(q), q)
+        norm_sq = np.einsum('ni,ni->n', q, q)
+        self.q = q / np.where(np.abs(1.0 - norm_sq) >= 1e-14, np.sqrt(norm_sq), 1.0)[:, None]
+
+        qw, qx, qy, qz = self.q.T
+        ww, xx, yy, zz = qw*qw, qx*qx, qy*qy, qz*qz
+        r = self.rotation
+        r[:, 0, 0] = ww + xx - yy - zz
+        r[:, 0, 1] = 2*(qx*qy - qw*qz)
+        r[:, 0, 2] = 2*(qx*qz + qw*qy)
+        r[:, 1, 0] = 2*(qx*qy + qw*qz)
+        r[:, 1, 1] = ww - xx + yy - zz
+        r[:, 1, 2] = 2*(qy*qz - qw*qx)
+        r[:, 2, 0] = 2*(qx*qz - qw*qy)
+        r[:, 2, 1] = 2*(qy*qz + qw*qx)
+        r[:, 2, 2] = ww - xx - yy + zz
+
+
+def _fast_normalise_rows(q):
+    """Row-wise version of Quaternion._fast_normalise for an (N, 4) array"""
+    mag_squared = np.einsum('ni,ni->n', q, q)
+    error = np.abs(1.0 - mag_squared)
+    mag = np.where(error < 2.107342e-08, (1.0 + mag_squared) / 2.0, np.sqrt(mag_squared))
+    mag[(error < 1e-14) | (mag_squared == 0)] = 1.0
+
+    return q / mag[:, None]
+
+
+class GestureModelBank():
+    """Batched GestureModel for N devices ticked together
+
+    Every attribute of GestureModel is held as an array with a leading
+    device axis, e.g. ``quaternion`` is (N, 4) and ``skewness`` is (N,).
+    All rows share one Calibrator, which is enough to time the batched
+    kernel but not to run real devices.
+    """
+    def __init__(self, n: int):
+        self.n = n
+        self.RAD_DEG_RATIO = 180 / np.pi
+        self.skewness = np.zeros(n)
+        self.tilt = np.zeros(n)
+        self.roll = np.zeros(n)
+        self.matrix = np.tile(np.identity(3), (n, 1, 1))
+        self.movement_acceleration = np.zeros((n, 3))
+        self.acceleration_derivative = np.zeros((n, 3))
+        self.movement_velocity = np.zeros((n, 3))
+        self.quaternion = np.zeros((n, 4))
+        self.quaternion[:, 0] = 1.0
+        self.calibrator = Calibrator()
+        self.fusion_filter = FusionFilterBank(n)
+
+    def tick(self, accl: np.ndarray, gyro: np.ndarray, magn: np.ndarray, period=None):
+        calibrator = self.calibrator
+        self.caccl = accl @ calibrator.accl_transform.T - calibrator.accl_offset
+        self.cgyro = gyro @ calibrator.gyro_transform.T - calibrator.gyro_offset
+        self.cmagn = magn @ calibrator.magn_transform.T - calibrator.magn_offset
+        self.quaternion = self.fusion_filter.fuse(self.cgyro, self.caccl, self.cmagn, period=period)
+        m = self.matrix = self.fusion_filter.rotation_matrix()
+        self.skewness = self.RAD_DEG_RATIO * np.arctan2(m[:, 1, 0], m[:, 0, 0])
+        self.tilt = self.RAD_DEG_RATIO * np.arctan2(m[:, 2, 0], np.hypot(m[:, 2, 1], m[:, 2, 2]))
+        self.roll = self.RAD_DEG_RATIO * np.arctan2(m[:, 2, 1], m[:, 2, 2])
+        self.movement_acceleration = self.fusion_filter.ma_sensor
+        self.acceleration_derivative = self.fusion_filter.da
+        self.movement_velocity = self.movement_velocity * 0.9999 + self.movement_acceleration
+
+    def snapshot(self, i: int) -> GestureSnapshot:
+        """Outputs of device ``i`` in the same form as GestureModel.snapshot"""
+        return GestureSnapshot(Quaternion(array=self.quaternion[i].copy()),
+                               self.movement_acceleration[i].copy(),
+                               self.acceleration_derivative[i].copy(),
+                               self.movement_velocity[i].copy(),
+                               float(self.skewness[i]),
+                               float(self.tilt[i]),
+                               float(self.roll[i]),
+                               quaternion_spherical_coords(*self.quaternion[i].tolist()))
@@ -0,0 +1,57 @@
+# Developed by Paulo Chiliguano
+# Directed by Dr Roberto Alonso Trillo
+# HKBU Academy of Music
+# 2024
+
+"""Per-device cost of GestureModelBank as the number of devices grows
+
+Run from the repository root: ``python benchmarks/bench_bank.py``
+"""
+import sys
+from pathlib import Path
+from time import perf_counter
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from bank import GestureModelBank  # noqa: E402
+from gesture_model import GestureModel  # noqa: E402
+
+
+def time_bank(n: int, ticks: int = 500) -> float:
+    rng = np.random.default_rng(n)
+    accl = np.array([10.0, 20.0, 1000.0]) + rng.normal(0, 20, (ticks, n, 3))
+    gyro = rng.normal(0, 30, (ticks, n, 3))
+    magn = np.array([300.0, 200.0, 100.0]) + rng.normal(0, 5, (ticks, n, 3))
+    period = np.full(n, 0.01)
+    bank = GestureModelBank(n)
+    start = perf_counter()
+    for t in range(ticks):
+        bank.tick(accl[t], gyro[t], magn[t], period=period)
+
+    return (perf_counter() - start) / ticks / n
+
+
+def time_models(n: int, ticks: int = 500, fast: bool = True) -> float:
+    rng = np.random.default_rng(n)
+    accl = np.array([10.0, 20.0, 1000.0]) + rng.normal(0, 20, (ticks, n, 3))
+    gyro = rng.normal(0, 30, (ticks, n, 3))
+    magn = np.array([300.0, 200.0, 100.0]) + rng.normal(0, 5, (ticks, n, 3))
+    models = [GestureModel(fast) for _ in range(n)]
+    start = perf_counter()
+    for t in range(ticks):
+        for i, model in enumerate(models):
+            model.tick(accl[t, i], gyro[t, i], magn[t, i])
+
+    return (perf_counter() - start) / ticks / n
+
+
+def main():
+    print(f"{'N':>4} {'bank us/device':>15} {'fast model us/device':>21}")
+    for n in (1, 2, 4, 8, 16, 32, 64, 128):
+        print(f"{n:>4} {time_bank(n) * 1e6:>15.2f} {time_models(n, ticks=100) * 1e6:>21.2f}")
+
+
+if __name__ == '__main__':
+    main()
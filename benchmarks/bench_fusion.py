@@ -0,0 +1,60 @@
+# Developed by Paulo Chiliguano
+# Directed by Dr Roberto Alonso Trillo
+# HKBU Academy of Music
+# 2024
+
+"""Per-tick cost of FusionFilter against FastFusionFilter
+
+Run from the repository root: ``python benchmarks/bench_fusion.py``
+"""
+import sys
+from pathlib import Path
+from time import perf_counter
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from fusion_filter import FastFusionFilter, FusionFilter  # noqa: E402
+
+
+def synthetic_samples(n: int, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    accl = 0.001 * (np.array([10.0, 20.0, 1000.0]) + rng.normal(0, 20, (n, 3)))
+    gyro = np.deg2rad(rng.normal(0, 30, (n, 3)))
+    magn = np.array([300.0, 200.0, 100.0]) + rng.normal(0, 5, (n, 3))
+
+    return accl, gyro, magn
+
+
+def time_filter(fusion_filter, accl, gyro, magn) -> float:
+    start = perf_counter()
+    for i in range(len(accl)):
+        fusion_filter.fuse(gyro[i].copy(), accl[i], magn[i])
+
+    return (perf_counter() - start) / len(accl)
+
+
+def max_difference(accl, gyro, magn) -> float:
+    reference, fast = FusionFilter(), FastFusionFilter()
+    difference = 0.0
+    for i in range(len(accl)):
+        # NOTE: Same fixed 10 ms period for both filters
+        q0 = reference.fuse(gyro[i].copy(), accl[i], magn[i], timestamp=i * 0.01).elements
+        q1 = fast.fuse(gyro[i].copy(), accl[i], magn[i], timestamp=i * 0.01).elements
+        difference = max(difference, np.max(np.abs(q0 - q1)))
+
+    return difference
+
+
+def main(n: int = 20000):
+    accl, gyro, magn = synthetic_samples(n)
+    reference = time_filter(FusionFilter(), accl, gyro, magn)
+    fast = time_filter(FastFusionFilter(), accl, gyro, magn)
+    print(f"FusionFilter.fuse:     {reference * 1e6:8.2f} us/tick")
+    print(f"FastFusionFilter.fuse: {fast * 1e6:8.2f} us/tick ({reference / fast:.1f}x)")
+    print(f"max |q - q_fast|:      {max_difference(accl, gyro, magn):.3e}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+# Developed by Paulo Chiliguano
+# Directed by Dr Roberto Alonso Trillo
+# HKBU Academy of Music
+# 2024
+
+"""Engine callback latency under GUI activity
+
+Streams simulated devices through the engine while a stand-in for the Tk
+window blocks for ``--gui-work`` milliseconds every ``--gui-interval``
+(a headless Tcl interpreter running ``after``, i.e. a slow redraw). A probe
+coroutine on the engine loop measures how late its wake-ups are, which is
+how late BLE callbacks and OSC sends would be.
+
+Two layouts are compared:
+
+shared
+    GUI work scheduled on the engine loop, as when the window was refreshed
+    by a coroutine between ``root.update()`` calls
+threaded
+    GUI work on the main thread and the engine on ``EngineLoop``, as in
+    ``metabow_bridge.py``
+
+Run from the repository root: ``python benchmarks/bench_gui_latency.py``
+"""
+import argparse
+import asyncio
+import sys
+import tkinter
+from pathlib import Path
+from time import perf_counter
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from bridge_engine import BridgeEngine, EngineLoop, load_configuration  # noqa: E402
+from telemetry import LatencyHistogram, percentile  # noqa: E402
+
+
+PROBE_PERIOD = 0.002
+
+
+async def probe(histogram: LatencyHistogram, duration: float):
+    """Records how late each wake-up of a periodic sleep is"""
+    deadline = perf_counter() + duration
+    while perf_counter() < deadline:
+        start = perf_counter()
+        await asyncio.sleep(PROBE_PERIOD)
+        histogram.record(perf_counter() - start - PROBE_PERIOD)
+
+
+def gui_step(interpreter: tkinter.Tcl, work: int):
+    interpreter.eval(f"after {work}")  # NOTE: Blocks like a slow redraw, without a display
+
+
+async def shared_gui(interpreter: tkinter.Tcl, work: int, interval: float, duration: float):
+    deadline = perf_counter() + duration
+    while perf_counter() < deadline:
+        gui_step(interpreter, work)
+        await asyncio.sleep(interval)
+
+
+async def session(configuration_dict: dict, histogram: LatencyHistogram, duration: float, gui=None):
+    engine = BridgeEngine(configuration_dict)
+    running = asyncio.create_task(engine.run((), scan_time=0.0))
+    tasks = [probe(histogram, duration)]
+    if gui is not None:
+        tasks.append(gui)
+    await asyncio.gather(*tasks)
+    await engine.disconnect()
+    await running
+
+
+def run_shared(configuration_dict: dict, duration: float, work: int, interval: float) -> LatencyHistogram:
+    histogram = LatencyHistogram()
+    gui = None
+    if work > 0:
+        gui = shared_gui(tkinter.Tcl(), work, interval, duration)
+    asyncio.run(session(configuration_dict, histogram, duration, gui))
+    return histogram
+
+
+def run_threaded(configuration_dict: dict, duration: float, work: int, interval: float) -> LatencyHistogram:
+    histogram = LatencyHistogram()
+    interpreter = tkinter.Tcl()
+    engine_loop = EngineLoop()
+    engine_loop.start()
+    try:
+        future = engine_loop.submit(session(configuration_dict, histogram, duration))
+        while not future.done():
+            if work > 0:
+                gui_step(interpreter, work)
+            try:
+                future.result(interval)
+            except TimeoutError:
+                pass
+    finally:
+        engine_loop.stop()
+    return histogram
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description="Engine callback latency under GUI activity")
+    parser.add_argument('-c', '--config', default="metabow.toml")
+    parser.add_argument('--devices', type=int, default=4)
+    parser.add_argument('--rate', type=float, default=100.0)
+    parser.add_argument('--duration', type=float, default=5.0, help="seconds per run")
+    parser.add_argument('--gui-work', type=int, default=40, help="milliseconds blocked per GUI refresh")
+    parser.add_argument('--gui-interval', type=float, default=0.1, help="seconds between GUI refreshes")
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_arguments(argv)
+    print(f"{'layout':>8} {'gui':>4} {'wakeups':>8} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for name, run in (('shared', run_shared), ('threaded', run_threaded)):
+        for gui in (False, True):
+            configuration_dict = load_configuration(args.config)
+            configuration_dict['simulation'].update({'enabled': True, 'devices': args.devices, 'rate': args.rate})
+            configuration_dict['capture']['enabled'] = False
+            histogram = run(configuration_dict, args.duration, args.gui_work if gui else 0, args.gui_interval)
+            counts = histogram.counts
+            print(f"{name:>8} {'on' if gui else 'off':>4} {sum(counts):8d} {percentile(counts, 50) * 1e3:8.3f} "
+                  f"{percentile(counts, 99) * 1e3:8.3f} {histogram.maximum * 1e3:8.3f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+# Developed by Paulo Chiliguano
+# Directed by Dr Roberto Alonso Trillo
+# HKBU Academy of Music
+# 2024
+
+"""Sustained load of one bridge with simulated devices
+
+Streams N virtual bows at R samples per second through the whole engine
+(pipeline, OSC output and session log) and reports how much of the offered
+load came out, and the queue depths and drops on the way.
+
+Run from the repository root: ``python benchmarks/bench_load.py --devices 1 4 16 --rates 100 400``
+"""
+import argparse
+import asyncio
+import sys
+from pathlib import Path
+from time import perf_counter
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from bridge_engine import BridgeEngine, load_configuration  # noqa: E402
+
+
+async def load(configuration_dict: dict, devices: int, rate: float, duration: float) -> dict:
+    configuration_dict['simulation'].update({'enabled': True, 'devices': devices, 'rate': rate})
+    engine = BridgeEngine(configuration_dict)
+    session = asyncio.create_task(engine.run((), scan_time=0.0))
+    await asyncio.sleep(duration)
+    start = perf_counter()
+    await engine.disconnect()
+    simulated = await session
+    drain = perf_counter() - start
+
+    stats = engine.pipeline_stats()
+    offered = sum(device.notifications_sent for device in simulated)
+    logged = stats['log']['processed']
+    return {
+        'offered': offered,
+        'lost': sum(device.notifications_lost for device in simulated),
+        'logged': logged,
+        'dropped': sum(stage['dropped'] for stage in stats.values()),
+        'max_depth': max(stage['max_depth'] for stage in stats.values()),
+        'drain': drain,
+    }
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description="Bridge load test with simulated devices")
+    parser.add_argument('-c', '--config', default="metabow.toml")
+    parser.add_argument('--protocol', choices=('nordic', 'sensortile'), default='sensortile',
+                        help="packet layout of the simulated devices")
+    parser.add_argument('--devices', type=int, nargs='+', default=[1, 2, 4, 8, 16])
+    parser.add_argument('--rates', type=float, nargs='+', default=[100.0, 200.0])
+    parser.add_argument('--duration', type=float, default=5.0, help="seconds per run")
+    parser.add_argument('--policy', default="drop-oldest", help="pipeline overload policy")
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_arguments(argv)
+    print(f"{'devices':>7} {'rate':>6} {'offered':>8} {'lost':>7} {'logged':>8} {'dropped':>8} {'depth':>6} {'drain s':>8}")
+    for rate in args.rates:
+        for devices in args.devices:
+            configuration_dict = load_configuration(args.config)
+            configuration_dict['device']['protocol'] = args.protocol
+            configuration_dict['pipeline'].update({'policy': args.policy, 'log-policy': args.policy})
+            result = asyncio.run(load(configuration_dict, devices, rate, args.duration))
+            print(f"{devices:7d} {rate:6.0f} {result['offered']:8d} {result['lost']:7d} {result['logged']:8d} "
+                  f"{result['dropped']:8d} {result['max_depth']:6d} {result['drain']:8.2f}")
+
+
+if __name__ == '__main__':
+    main()
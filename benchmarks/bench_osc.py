@@ -0,0 +1,61 @@
+# Developed by Paulo Chiliguano
+# Directed by Dr Roberto Alonso Trillo
+# HKBU Academy of Music
+# 2024
+
+"""Encoded OSC messages per second, python-osc builders against OscEncoder
+
+Run from the repository root: ``python benchmarks/bench_osc.py``
+"""
+import sys
+from pathlib import Path
+from time import perf_counter, time
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from gesture_model import GestureModel  # noqa: E402
+from osc_output import OscEncoder, build_message, build_sample_bundle, sample_messages, sample_values  # noqa: E402
+
+
+def rate(function, n: int) -> float:
+    start = perf_counter()
+    for _ in range(n):
+        function()
+
+    return n / (perf_counter() - start)
+
+
+def main(n: int = 5000):
+    model = GestureModel()
+    model.tick([10.0, 20.0, 1000.0], [5.0, 6.0, 7.0], [300.0, 200.0, 100.0])
+    sample = model.snapshot()
+    raw = [1.0, 10.0, 20.0, 1000.0, 0.5, 0.6, 0.7, 300.0, 200.0, 100.0]
+    encoder = OscEncoder()
+    streams = 9  # NOTE: /raw and the eight derived streams
+
+    def python_osc_messages():
+        build_message("/0/raw", raw).dgram
+        for address, value in sample_messages(0, sample):
+            build_message(address, value).dgram
+
+    def encoder_messages():
+        encoder.message(0, "raw", raw)
+        for stream, values in sample_values(sample):
+            encoder.message(0, stream, values)
+
+    def python_osc_bundle():
+        build_sample_bundle(0, time(), raw, sample).dgram
+
+    def encoder_bundle():
+        encoder.bundle(0, time(), [("raw", raw), *sample_values(sample)])
+
+    before = rate(python_osc_messages, n) * streams
+    after = rate(encoder_messages, n) * streams
+    print(f"messages: python-osc {before:10.0f}/s  OscEncoder {after:10.0f}/s ({after / before:.1f}x)")
+    before = rate(python_osc_bundle, n)
+    after = rate(encoder_bundle, n)
+    print(f"bundles:  python-osc {before:10.0f}/s  OscEncoder {after:10.0f}/s ({after / before:.1f}x)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+# Developed by Paulo Chiliguano
+# Directed by Dr Roberto Alonso Trillo
+# HKBU Academy of Music
+# 2024
+
+"""Startup time of the bridge
+
+Imports the entry points in fresh interpreters and reports the median time
+of every case, then the heaviest modules imported by the window. Optional
+dependencies (BLE, python-osc) are imported on first use, so their cost is
+listed separately.
+
+Run from the repository root: ``python benchmarks/bench_startup.py -n 10 --top 15``
+"""
+import argparse
+import subprocess
+import sys
+from pathlib import Path
+from statistics import median
+
+ROOT = Path(__file__).resolve().parent.parent
+
+CASES = (
+    ('interpreter', "", "pass"),
+    ('import metabow_bridge', "", "import metabow_bridge"),
+    ('import metabow_daemon', "", "import metabow_daemon"),
+    ('BridgeEngine()', "",
+     "from bridge_engine import BridgeEngine, load_configuration; BridgeEngine(load_configuration())"),
+    ('first use: bleak', "import bridge_engine", "import bleak"),
+    ('first use: python-osc', "from osc_output import build_message", "build_message('/bridge/metrics', 0.0)"),
+)
+TIMER = "from time import perf_counter as _t; {setup}; _s = _t(); {statement}; print(_t() - _s)"
+
+
+def time_case(setup: str, statement: str) -> float:
+    """Seconds spent in ``statement`` in a fresh interpreter"""
+    result = subprocess.run([sys.executable, "-c", TIMER.format(setup=setup or "pass", statement=statement)],
+                            cwd=ROOT, capture_output=True, text=True, check=True)
+    return float(result.stdout.split()[-1])
+
+
+def heaviest_imports(module: str, top: int) -> list:
+    """``(cumulative seconds, module)`` of the slowest imports, from ``-X importtime``"""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            cwd=ROOT, capture_output=True, text=True, check=True)
+    imports = []
+    for line in result.stderr.splitlines():
+        fields = line.split("|")
+        if len(fields) == 3 and fields[1].strip().isdigit():
+            imports.append((int(fields[1]) * 1e-6, fields[2].strip()))
+
+    return sorted(imports, reverse=True)[:top]
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description="Startup time of the bridge")
+    parser.add_argument('-n', type=int, default=5, help="fresh interpreters per case")
+    parser.add_argument('--top', type=int, default=10, help="heaviest imports of the window to list")
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_arguments(argv)
+    print(f"{'case':<30} {'median ms':>10} {'min ms':>8}")
+    for name, setup, statement in CASES:
+        times = [time_case(setup, statement) for _ in range(args.n)]
+        print(f"{name:<30} {median(times) * 1e3:10.1f} {min(times) * 1e3:8.1f}")
+
+    if args.top:
+        print()
+        print(f"{'cumulative ms':>13}  module (import metabow_bridge)")
+        for seconds, module in heaviest_imports("metabow_bridge", args.top):
+            print(f"{seconds * 1e3:13.1f}  {module}")
+
+
+if __name__ == '__main__':
+    main()
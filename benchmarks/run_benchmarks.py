@@ -0,0 +1,325 @@
+# Developed by Paulo Chiliguano
+# Directed by Dr Roberto Alonso Trillo
+# HKBU Academy of Music
+# 2024
+
+"""Benchmark suite of the bridge hot paths
+
+Times packet decoding, fusion, GestureModel.tick, the spherical
+coordinates, OSC publishing to a local UDP sink and session log writes,
+then measures the packet-to-datagram latency of the whole engine. No BLE
+hardware is needed. Results are written as JSON so releases can be
+compared.
+
+Run from the repository root::
+
+    python benchmarks/run_benchmarks.py -o results.json
+    python benchmarks/run_benchmarks.py -o new.json --compare results.json
+"""
+import argparse
+import asyncio
+import json
+import platform
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+from datetime import datetime
+from pathlib import Path
+from statistics import median
+from time import perf_counter, time
+
+import numpy as np
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import bridge_engine  # noqa: E402
+from bridge_engine import BridgeEngine, load_configuration  # noqa: E402
+from calibration import OnlineCalibration  # noqa: E402
+from features import quaternion_spherical_coords  # noqa: E402
+from fusion_filter import FastFusionFilter, FusionFilter  # noqa: E402
+from gesture_model import GestureModel  # noqa: E402
+from osc_output import OscFanout, Destination, sample_values  # noqa: E402
+from session_log import SessionLogWriter  # noqa: E402
+from simulated_ble import bow_stroke  # noqa: E402
+from utils import (  # noqa: E402
+    bytearray_to_fusion_data,
+    decode_nordic_records,
+    decode_sensortile_packets,
+)
+
+
+PACKET = struct.Struct('<H9h')
+
+
+def packet(timestamp: int = 1) -> bytearray:
+    return bytearray(PACKET.pack(timestamp & 0xFFFF, 10, 20, 1000, 5, 6, 7, 300, 200, 100))
+
+
+def pyquaternion_as_spherical_coords(elements):
+    """numpy-quaternion reference of features.quaternion_spherical_coords, see benchmarks/requirements.txt"""
+    import quaternion  # NOTE: Pulls in scipy, only the benchmarks depend on it
+    elems = quaternion.from_float_array(elements)
+    return quaternion.as_spherical_coords(elems)
+
+
+def measure(function, n: int, repeat: int = 5) -> dict:
+    """Per-call time of ``function`` over ``repeat`` rounds of ``n`` calls"""
+    rounds = []
+    for _ in range(repeat):
+        start = perf_counter()
+        for _ in range(n):
+            function()
+        rounds.append((perf_counter() - start) / n)
+
+    return {'best_us': min(rounds) * 1e6, 'median_us': median(rounds) * 1e6,
+            'ops_per_s': 1.0 / min(rounds), 'calls': n * repeat}
+
+
+class UdpSink(threading.Thread):
+    """Local UDP receiver recording the arrival time of every datagram"""
+    def __init__(self, on_datagram=None):
+        super().__init__(name="benchmark-sink", daemon=True)
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 22)
+        self.socket.bind(("127.0.0.1", 0))
+        self.socket.settimeout(0.2)
+        self.port = self.socket.getsockname()[1]
+        self.on_datagram = on_datagram
+        self.received = 0
+        self.running = True
+
+    def run(self):
+        while self.running:
+            try:
+                dgram = self.socket.recv(65536)
+            except socket.timeout:
+                continue
+            arrival = perf_counter()
+            self.received += 1
+            if self.on_datagram is not None:
+                self.on_datagram(dgram, arrival)
+        self.socket.close()
+
+    def stop(self):
+        self.running = False
+        self.join()
+
+
+def bench_decode(n: int) -> dict:
+    single = packet()
+    batch = b"".join(packet(i) for i in range(10))
+    nordic = struct.pack('<13fB', *range(13), 1) * 4
+    return {
+        'bytearray_to_fusion_data': measure(lambda: bytearray_to_fusion_data(single), n),
+        'decode_sensortile_packets_x10': measure(lambda: decode_sensortile_packets(batch), n),
+        'decode_nordic_records_x4': measure(lambda: decode_nordic_records(nordic), n),
+    }
+
+
+def bench_fusion(n: int) -> dict:
+    rng = np.random.default_rng(0)
+    accl = 0.001 * (np.array([10.0, 20.0, 1000.0]) + rng.normal(0, 20, 3))
+    gyro = np.deg2rad(rng.normal(0, 30, 3))
+    magn = np.array([300.0, 200.0, 100.0]) + rng.normal(0, 5, 3)
+    results = {}
+    for name, fusion_filter in (('FusionFilter.fuse', FusionFilter()), ('FastFusionFilter.fuse', FastFusionFilter())):
+        results[name] = measure(lambda: fusion_filter.fuse(gyro.copy(), accl, magn), n)
+
+    return results
+
+
+def bench_tick(n: int) -> dict:
+    accl, gyro, magn = [10.0, 20.0, 1000.0], [5.0, 6.0, 7.0], [300.0, 200.0, 100.0]
+    results = {}
+    for name, fast, features in (('GestureModel.tick', False, None), ('GestureModel.tick_fast', True, None),
+                                 ('GestureModel.tick_quaternion', True, ['quaternion'])):
+        model = GestureModel(fast, features=features)
+        results[name] = measure(lambda: model.tick(accl, gyro, magn), n)
+    model = GestureModel(True)
+    model.tick(accl, gyro, magn)
+    elements = model.snapshot().quaternion.elements
+    results['pyquaternion_as_spherical_coords'] = measure(lambda: pyquaternion_as_spherical_coords(elements), n)
+    results['quaternion_spherical_coords'] = measure(lambda: quaternion_spherical_coords(*elements.tolist()), n)
+
+    calibration = OnlineCalibration()
+    results['OnlineCalibration.update_static'] = measure(lambda: calibration.update(accl, gyro, magn), n)
+    stroke = bow_stroke(400, 100.0, seed=0)
+    samples = [((stroke['accl'][i] * 1000.0).tolist(), stroke['gyro'][i].tolist(), (stroke['magn'][i] * 1000.0).tolist())
+               for i in range(400)]
+    calibration, index = OnlineCalibration(), iter(range(10 ** 9))
+    results['OnlineCalibration.update_moving'] = measure(lambda: calibration.update(*samples[next(index) % 400]), n)
+
+    return results
+
+
+async def _bench_publish(n: int, bundle: bool) -> dict:
+    sink = UdpSink()
+    sink.start()
+    fanout = OscFanout([Destination("127.0.0.1", sink.port, bundle=bundle)])
+    await fanout.open()
+    model = GestureModel(True)
+    model.tick([10.0, 20.0, 1000.0], [5.0, 6.0, 7.0], [300.0, 200.0, 100.0])
+    streams = [("raw", [1.0, 10.0, 20.0, 1000.0, 0.5, 0.6, 0.7, 300.0, 200.0, 100.0]),
+               *sample_values(model.snapshot())]
+    result = measure(lambda: fanout.publish(0, time(), streams), n)
+    result['datagrams'] = fanout.stats()[fanout.destinations[0].name]['sent']
+    fanout.close()
+    sink.stop()
+
+    return result
+
+
+def bench_publish(n: int) -> dict:
+    return {
+        'OscFanout.publish_messages': asyncio.run(_bench_publish(n, False)),
+        'OscFanout.publish_bundle': asyncio.run(_bench_publish(n, True)),
+    }
+
+
+def bench_write_log(n: int, directory: Path) -> dict:
+    model = GestureModel(True)
+    model.tick([10.0, 20.0, 1000.0], [5.0, 6.0, 7.0], [300.0, 200.0, 100.0])
+    snapshot = model.snapshot()
+    fusion_data = [1.0, 10.0, 20.0, 1000.0, 0.5, 0.6, 0.7, 300.0, 200.0, 100.0]
+    timestamp = time()
+    results = {}
+    for format in ('csv', 'binary'):
+        engine = BridgeEngine(load_configuration(ROOT / "metabow.toml"))
+        engine.log_writer = SessionLogWriter(lambda extension: directory / f"bench.{extension}", format=format)
+        engine.log_writer.start()
+        results[f'_write_log_{format}'] = measure(lambda: engine._write_log(timestamp, 0, fusion_data, snapshot), n)
+        engine.log_writer.stop()
+
+    return results
+
+
+async def _bench_latency(devices: int, rate: float, duration: float, directory: Path) -> dict:
+    sent = {}
+    latencies = []
+
+    def on_datagram(dgram, arrival):
+        # NOTE: The device timestamp carries a sequence number; it is the first float of /<device>/raw
+        address_end = dgram.index(b"\x00")
+        if not dgram.endswith(b"raw", 0, address_end) or dgram.startswith(b"#bundle"):
+            return
+        device_number = int(dgram[1:address_end - 4])
+        offset = (address_end + 4) & ~3
+        offset = (dgram.index(b"\x00", offset) + 4) & ~3
+        sequence = int(struct.unpack_from('>f', dgram, offset)[0])
+        start = sent.pop((device_number, sequence), None)
+        if start is not None:
+            latencies.append(arrival - start)
+
+    sink = UdpSink(on_datagram)
+    sink.start()
+    configuration_dict = load_configuration(ROOT / "metabow.toml")
+    configuration_dict['device']['protocol'] = "sensortile"  # NOTE: The packets carry the sequence number
+    configuration_dict['destinations'] = [{'port': sink.port}]
+    configuration_dict['streams'] = {}
+    configuration_dict['osc']['bundle'] = False
+    # NOTE: Calibrates online as in a session, without saving profiles of the fake bench-N devices
+    configuration_dict['calibration']['profiles'] = ""
+    # NOTE: Session logs go to the scratch directory instead of the Desktop
+    bridge_engine.log_file_path = lambda extension: directory / f"latency.{extension}"
+    engine = BridgeEngine(configuration_dict)
+    await engine.start_session([(i, f"bench-{i}") for i in range(devices)])
+
+    loop = asyncio.get_running_loop()
+    period = 1.0 / rate
+    count = int(duration * rate)
+    start = loop.time()
+    for sequence in range(count):
+        for device_number in range(devices):
+            sent[(device_number, sequence & 0xFFFF)] = perf_counter()
+            engine.notification_handler(device_number, 0, packet(sequence))
+        await asyncio.sleep(max(start + (sequence + 1) * period - loop.time(), 0.0))
+    await engine.stop_session()
+    sink.stop()
+
+    latencies = np.array(latencies) * 1e3
+    return {
+        'devices': devices,
+        'rate': rate,
+        'samples': count * devices,
+        'received': int(latencies.size),
+        'p50_ms': float(np.percentile(latencies, 50)) if latencies.size else None,
+        'p99_ms': float(np.percentile(latencies, 99)) if latencies.size else None,
+        'max_ms': float(latencies.max()) if latencies.size else None,
+    }
+
+
+def bench_latency(duration: float, directory: Path, loads=((1, 100.0), (4, 100.0), (8, 200.0))) -> dict:
+    return {f'latency_{devices}x{rate:.0f}hz': asyncio.run(_bench_latency(devices, rate, duration, directory))
+            for devices, rate in loads}
+
+
+def metadata() -> dict:
+    try:
+        commit = subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=ROOT,
+                                capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'commit': commit,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'processor': platform.processor() or platform.machine(),
+    }
+
+
+def compare(results: dict, baseline: dict):
+    """Prints the speed of every case relative to a previous results file"""
+    print(f"{'case':<36} {'baseline':>12} {'current':>12} {'ratio':>7}")
+    for name, current in results['results'].items():
+        previous = baseline.get('results', {}).get(name)
+        if previous is None:
+            continue
+        key = 'p99_ms' if 'p99_ms' in current else 'best_us'
+        if current.get(key) is None or previous.get(key) is None:
+            continue
+        print(f"{name:<36} {previous[key]:>12.2f} {current[key]:>12.2f} {previous[key] / current[key]:>6.2f}x")
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark suite of the bridge hot paths")
+    parser.add_argument('-o', '--output', help="JSON results file")
+    parser.add_argument('--compare', help="previous JSON results file to compare against")
+    parser.add_argument('-n', type=int, default=2000, help="calls per round of the micro benchmarks")
+    parser.add_argument('--duration', type=float, default=3.0, help="seconds per latency run")
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_arguments(argv)
+    results = {}
+    with tempfile.TemporaryDirectory() as scratch:
+        directory = Path(scratch)
+        for suite in (bench_decode, bench_fusion, bench_tick, bench_publish):
+            results.update(suite(args.n))
+        results.update(bench_write_log(args.n * 10, directory))
+        results.update(bench_latency(args.duration, directory))
+
+    for name, result in results.items():
+        if 'p50_ms' in result:
+            print(f"{name:<36} p50 {result['p50_ms']:8.3f} ms  p99 {result['p99_ms']:8.3f} ms  "
+                  f"({result['received']}/{result['samples']})")
+        else:
+            print(f"{name:<36} {result['best_us']:10.2f} us  {result['ops_per_s']:12.0f}/s")
+
+    output = {'metadata': metadata(), 'results': results}
+    if args.output:
+        Path(args.output).write_text(json.dumps(output, indent=2))
+    if args.compare:
+        compare(output, json.loads(Path(args.compare).read_text()))
+
+
+if __name__ == '__main__':
+    main()
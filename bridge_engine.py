@@ -0,0 +1,655 @@
+# Developed by Paulo Chiliguano and KA HO Wong
+# Directed by Dr Roberto Alonso Trillo
+# HKBU Academy of Music
+# 2024
+
+"""Bridge engine
+
+Headless BLE to OSC pipeline. It has no GUI dependency so it can be driven
+either by the Tk window or by the command line daemon.
+"""
+import asyncio
+import json
+import threading
+from concurrent.futures import Future
+import tomllib
+from functools import partial
+from importlib import import_module
+from pathlib import Path
+from time import monotonic, time
+from calibration import CalibrationProfiles, OnlineCalibration
+from capture import NORDIC, SENSORTILE, CaptureWriter
+from connection_manager import CONNECTION_ERRORS, ConnectionManager, KnownDevices, Link
+from features import FEATURES, LOGGED_FEATURES, features_for, resolve
+from gesture_model import GestureModel
+from pipeline import Batch, Pipeline
+from sample_clock import SampleClock
+from sequence_tracker import InterpolatedSample, SequenceTracker
+from simulated_ble import simulated_backend
+from session_log import CSV_HEADER, SessionLogWriter, log_row
+from osc_output import (
+    OscEncoder,
+    OscFanout,
+    OutputPolicies,
+    build_message,
+    destinations_from_configuration,
+    sample_values,
+)
+from telemetry import Telemetry, metrics_messages
+from utils import PACKET_LAYOUTS, log_file_path, sensor_values
+
+
+DEFAULT_CONFIGURATION = {
+    'device': {
+        'characteristic-uuid': "6e400003-b5a3-f393-e0a9-e50e24dcca9e",
+        'name': "metabow",
+        'protocol': "nordic",
+        'timestamp-tick': 0.0,
+        },
+    'bridge': {
+        'port': 8888,
+        'mirror-port': 8889,
+        'use-address': False,
+        'scan-time': 5.0,
+        'devices': [],
+        },
+    'connection': {
+        'known-devices': "known_devices.json",
+        'direct': True,
+        'timeout': 10.0,
+        'reconnect': True,
+        'backoff-initial': 0.5,
+        'backoff-max': 10.0,
+        },
+    'pipeline': {
+        'queue-size': 256,
+        'inbox-policy': "drop-oldest",
+        'policy': "block",
+        'log-policy': "block",
+        },
+    'fusion': {
+        'fast': True,
+        },
+    'calibration': {
+        'online': True,
+        'profiles': "calibration_profiles.json",
+        'static-gyro': 1.0,
+        'static-accl': 10.0,
+        'static-samples': 50,
+        },
+    'osc': {
+        'bundle': False,
+        },
+    'capture': {
+        'enabled': False,
+        },
+    'sequence': {
+        'interpolate': 0,
+        },
+    'metrics': {
+        'interval': 1.0,
+        'osc': True,
+        'file': True,
+        },
+    'simulation': {
+        'enabled': False,
+        'devices': 4,
+        'rate': 100.0,
+        'samples-per-notification': 1,
+        'dropout': 0.0,
+        },
+    'log': {
+        'format': "csv",
+        'flush-rows': 256,
+        'flush-interval': 1.0,
+        'rotate-mb': 0,
+        'rotate-minutes': 0,
+        'compress': False,
+        'gestures': True,
+        },
+    }
+
+# NOTE: Files the bridge writes, resolved beside the configuration file instead of the working directory
+DATA_FILES = (('connection', 'known-devices'), ('calibration', 'profiles'))
+
+
+def load_configuration(path: str | Path = "metabow.toml") -> dict:
+    """Reads a TOML configuration file, falling back to the defaults
+
+    Parameters
+    ----------
+    path : str or Path
+        Location of the configuration file
+
+    Returns
+    -------
+    dict
+        Configuration with every missing section filled from the defaults,
+        and the relative DATA_FILES paths made relative to the file
+    """
+    try:
+        configuration_dict = tomllib.loads(Path(path).read_text())
+    except Exception:
+        configuration_dict = {}
+
+    for section, defaults in DEFAULT_CONFIGURATION.items():
+        configuration_dict[section] = {**defaults, **configuration_dict.get(section, {})}
+    directory = Path(path).resolve().parent
+    for section, key in DATA_FILES:
+        value = configuration_dict[section].get(key)
+        if value:  # NOTE: "" disables the file
+            configuration_dict[section][key] = str(directory / value)
+
+    return configuration_dict
+
+
+class EngineLoop:
+    """Event loop running in its own thread
+
+    Lets a GUI toolkit own the main thread while BLE callbacks, the OSC
+    fan-out and the engine coroutines run on this loop, never behind a
+    redraw.
+    """
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run, name="engine-loop", daemon=True)
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def start(self):
+        self._thread.start()
+
+    def submit(self, coroutine) -> Future:
+        """Schedules a coroutine from any thread"""
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def schedule(self, function, *args) -> Future:
+        """Runs a function on the loop thread without waiting for it"""
+        async def run():
+            return function(*args)
+        return self.submit(run())
+
+    def stop(self, timeout: float | None = 5.0):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(timeout)
+
+
+class BridgeEngine:
+    def __init__(self, configuration_dict: dict | None = None):
+        if configuration_dict is None:
+            configuration_dict = load_configuration()
+        self.configuration_dict = configuration_dict
+        self.characteristic_uuid = self.configuration_dict['device']['characteristic-uuid']
+        self.device_name = self.configuration_dict['device']['name']
+        self.protocol = self.configuration_dict['device'].get('protocol', "nordic")
+        self.layout = PACKET_LAYOUTS[self.protocol]
+        self.timestamp_tick = self.configuration_dict['device'].get('timestamp-tick', 0.0)
+        self.scanner_class = None  # NOTE: bleak is imported on first use, see _load_backend
+        self.client_class = None
+        self.client_errors = CONNECTION_ERRORS
+        simulation = self.configuration_dict.get('simulation', {})
+        if simulation.get('enabled', False):
+            self.scanner_class, self.client_class = simulated_backend(simulation, self.device_name, self.protocol)
+        bridge = self.configuration_dict.get('bridge', DEFAULT_CONFIGURATION['bridge'])
+        self.port0 = bridge.get('port', 8888)
+        self.port1 = bridge.get('mirror-port', 8889)
+        self.use_address = bridge.get('use-address', False)
+        self.fast_fusion = self.configuration_dict.get('fusion', {}).get('fast', True)
+        self.osc_encoder = OscEncoder()
+        self.features = resolve(FEATURES)  # NOTE: Narrowed to the outputs of the session, see _select_features
+        self.output_policies = OutputPolicies(self.configuration_dict.get('streams', {}))
+        self.fanout = None
+        self.log_options = self.configuration_dict.get('log', DEFAULT_CONFIGURATION['log'])
+        self.log_writer = None
+        self.capture_enabled = self.configuration_dict.get('capture', {}).get('enabled', False)
+        self.capture = None
+        self.metrics_options = self.configuration_dict.get('metrics', DEFAULT_CONFIGURATION['metrics'])
+        self.telemetry = Telemetry()
+        self.metrics = {}  # NOTE: Latest telemetry snapshot, see telemetry.Telemetry.snapshot
+        self.metrics_path = None
+        self._metrics_task = None
+        self._metrics_time = monotonic()
+        self.connection_options = self.configuration_dict.get('connection', DEFAULT_CONFIGURATION['connection'])
+        # NOTE: Simulated addresses are not remembered, they would be dialled on real hardware
+        cache = None if simulation.get('enabled', False) else self.connection_options.get('known-devices')
+        self.known_devices = KnownDevices(cache, bridge.get('devices', []))
+        self.connections = None
+        self.calibration_options = self.configuration_dict.get('calibration', DEFAULT_CONFIGURATION['calibration'])
+        profiles = None if simulation.get('enabled', False) else self.calibration_options.get('profiles')
+        self.calibration_profiles = CalibrationProfiles(profiles)
+        self.calibrations = {}  # NOTE: One OnlineCalibration per BLE address, like the models
+        self.device_calibrations = {}
+        self.scanner = None
+        self.IMU_devices = {}
+        self.is_notify_loop = False
+        self.stop_requested = False  # NOTE: Set by disconnect, also before the session has started
+        self.pipeline = None
+        self.models = {}  # NOTE: One GestureModel per BLE address, kept across reconnects
+        self.device_models = {}
+        self.sample_clocks = {}  # NOTE: One SampleClock per BLE address, the time base of its model
+        self.clocks = {}
+        self.sequence_trackers = {}  # NOTE: Only for packets with a counter (SensorTile)
+        self.interpolate = self.configuration_dict.get('sequence', {}).get('interpolate', 0)
+        self.csv_header = CSV_HEADER
+
+
+    def instantiate_scanner(self):
+        """Creates the BLE scanner
+
+        Raises
+        ------
+        BleakError
+            When the Bluetooth adapter is turned off or unavailable
+        """
+        self._load_backend()
+        self.scanner = self.scanner_class(self.device_detected)
+
+
+    def _load_backend(self):
+        if self.client_class is None:
+            from bleak import BleakClient, BleakScanner
+            from bleak.exc import BleakError
+            self.scanner_class, self.client_class = BleakScanner, BleakClient
+            self.client_errors = (BleakError, *CONNECTION_ERRORS)
+
+
+    async def _instantiate_udp_client(self):
+        if self.fanout is not None:
+            self.fanout.close()
+        destinations = destinations_from_configuration(self.configuration_dict, self.port0, self.port1)
+        self.fanout = OscFanout(destinations, self.osc_encoder)
+        await self.fanout.open()
+
+
+    def _select_features(self):
+        """Features wanted by an OSC destination or logged, with their dependencies"""
+        destinations = self.fanout.destinations
+        wanted = features_for(lambda stream: any(i.wants(stream) for i in destinations))
+        logged = LOGGED_FEATURES if self.log_options.get('gestures', True) else ()
+        self.features = resolve((*wanted, *logged))
+        for model in self.device_models.values():
+            model.select_features(self.features)
+
+
+    def _metrics_destinations(self) -> list:
+        """Destinations subscribed to ``bridge/metrics`` by name, see Destination.wants"""
+        if self.fanout is None:
+            return []
+        return [i for i in self.fanout.destinations if i.wants("bridge/metrics")]
+
+
+    def _preload_outputs(self):
+        """Imports the modules of the enabled outputs in the background
+
+        They are loaded lazily to keep startup fast; importing them while
+        the devices connect keeps the first sample from waiting for them.
+        """
+        modules = []
+        if self.metrics_options.get('osc', True) and self._metrics_destinations():
+            modules.append("pythonosc.osc_message_builder")
+        loop = asyncio.get_running_loop()
+        for module in modules:
+            loop.run_in_executor(None, import_module, module)
+
+
+    def osc_stats(self) -> dict:
+        """Datagrams, bytes and errors per OSC destination"""
+        if self.fanout is None:
+            return {}
+        stats = self.fanout.stats()
+        stats['suppressed'] = self.output_policies.suppressed
+
+        return stats
+
+
+    def _create_pipeline(self):
+        options = self.configuration_dict.get('pipeline', DEFAULT_CONFIGURATION['pipeline'])
+        self.pipeline = Pipeline([('decode', self._decode_stage),
+                                  ('fuse', self._fuse_stage),
+                                  ('publish', self._publish_stage),
+                                  ('log', self._log_stage)],
+                                 maxsize=options.get('queue-size', 256),
+                                 policy=options.get('policy', "block"),
+                                 # NOTE: The BLE callbacks fill the decode inbox on the event loop, it must not block
+                                 policies={'decode': options.get('inbox-policy', "drop-oldest"),
+                                           'log': options.get('log-policy', "block")},
+                                 partitioned=('fuse',))
+        self.pipeline.start()
+
+
+    def pipeline_stats(self) -> dict:
+        """Queue depth, drop and throughput counters of every pipeline stage"""
+        if self.pipeline is None:
+            return {}
+        return self.pipeline.stats()
+
+
+    async def _report_metrics(self):
+        """Publishes a telemetry snapshot every ``[metrics] interval`` seconds"""
+        interval = self.metrics_options.get('interval', 1.0)
+        self._metrics_time = monotonic()
+        while True:
+            await asyncio.sleep(interval)
+            self._publish_metrics()
+
+
+    def _publish_metrics(self):
+        """Takes a telemetry snapshot
+
+        The snapshot is kept in ``self.metrics`` for the GUI, sent as
+        ``/bridge/metrics`` messages and appended to the session stats file.
+        """
+        now = monotonic()
+        stages = self.pipeline.timings() if self.pipeline is not None else {}
+        sequence = {identifier: tracker.counters() for identifier, tracker in self.sequence_trackers.items()}
+        connections = self.connections.counters() if self.connections is not None else {}
+        counters = {name: {'dropped': stage['dropped'], 'errors': stage['errors']}
+                    for name, stage in self.pipeline_stats().items()}
+        log = {key: value for key, value in self.log_stats().items() if key in ('lag', 'dropped', 'failed')}
+        self.metrics = self.telemetry.snapshot(time(), now - self._metrics_time, stages, sequence, connections,
+                                               counters, log)
+        self._metrics_time = now
+        if self.metrics_options.get('osc', True) and self.fanout is not None:
+            destinations = self._metrics_destinations()
+            if destinations:
+                for arguments in metrics_messages(self.metrics):
+                    self.fanout.send(build_message("/bridge/metrics", arguments).dgram, destinations)
+        if self.metrics_path is not None:
+            try:
+                with open(self.metrics_path, 'a', encoding='UTF8') as f:
+                    f.write(json.dumps(self.metrics) + "\n")
+            except OSError:
+                self.metrics_path = None
+
+
+    def device_detected(self, device, _):
+        if device.name == self.device_name:
+            self.IMU_devices[device.address] = device  # bleak.backends.device.BLEDevice
+
+
+    def device_addresses(self) -> list:
+        """Known addresses followed by the newly detected ones
+
+        Safe to call from another thread (the window): the engine loop adds
+        devices meanwhile, so both tables are copied in one step each before
+        being iterated.
+        """
+        addresses = self.known_devices.addresses
+        return addresses + [i for i in list(self.IMU_devices) if i not in addresses]
+
+
+    async def start_scan(self):
+        await self.scanner.start()
+
+
+    async def stop_scan(self):
+        await self.scanner.stop()
+
+
+    def device_identifier(self, i: int, device) -> int | str:
+        """OSC identifier of a device, either its index or its BLE address
+
+        ``device`` is a BLEDevice or an address string.
+        """
+        if self.use_address:
+            return str(getattr(device, 'address', device))
+        return i
+
+
+    async def start_session(self, devices):
+        """Prepares models, OSC output, logging and the pipeline
+
+        Parameters
+        ----------
+        devices : list
+            ``(identifier, address)`` pairs, where identifier is the OSC
+            identifier passed to the notification handlers
+        """
+        self.is_notify_loop = True
+        self.device_calibrations = {}
+        self.pipeline = None
+        self.log_writer = None
+        for identifier, address in devices:
+            address = str(address)
+            if address not in self.models:
+                self.models[address] = GestureModel(self.fast_fusion)
+                profile = self.calibration_profiles.get(address)
+                if profile is not None:
+                    self.models[address].calibrator.load_profile(profile)
+            self.device_models[identifier] = self.models[address]
+            # NOTE: The filter keeps its last sample time, so the clock lives as long as the model;
+            # after a reconnect it resynchronises instead of integrating over the gap
+            self.clocks[identifier] = self.sample_clocks.setdefault(address, SampleClock(self.timestamp_tick))
+            if self.calibration_options.get('online', True):
+                calibration = self.calibrations.setdefault(address, OnlineCalibration(self.calibration_options))
+                self.device_calibrations[identifier] = calibration
+        self.sequence_trackers = {}
+        if self.layout.counter is not None:
+            self.sequence_trackers = {identifier: SequenceTracker(interpolate=self.interpolate)
+                                      for identifier, _ in devices}
+        await self._instantiate_udp_client()
+        self._select_features()
+        self._preload_outputs()
+        self._create_log_file()
+        if self.capture_enabled:
+            self.capture = CaptureWriter(log_file_path("mbcap"), {
+                'device': self.configuration_dict['device'],
+                'devices': {str(identifier): str(address) for identifier, address in devices},
+            })
+        self._create_pipeline()
+        self.telemetry = Telemetry()
+        self.metrics = {}
+        if self.metrics_options.get('file', True):
+            self.metrics_path = self.log_name.with_name(f"{self.log_name.stem}_metrics.jsonl")
+        self._metrics_task = asyncio.get_running_loop().create_task(self._report_metrics())
+
+
+    async def stop_session(self):
+        """Drains the pipeline and closes the session outputs
+
+        Also cleans up after a start_session that failed part way, e.g. on a
+        destination host that does not resolve.
+        """
+        self.is_notify_loop = False
+        if self._metrics_task is not None:
+            self._metrics_task.cancel()
+            self._metrics_task = None
+        if self.capture is not None:
+            self.capture.close()
+            self.capture = None
+        if self.pipeline is not None:
+            await asyncio.to_thread(self.pipeline.stop)
+        if self.log_writer is not None:
+            await asyncio.to_thread(self.log_writer.stop)
+        self._save_calibrations()
+        self._publish_metrics()  # NOTE: Final counters of the session, e.g. packets lost
+        if self.fanout is not None:
+            await asyncio.sleep(0)  # NOTE: Lets pending sends scheduled by the workers run
+            self.fanout.close()
+
+
+    def _save_calibrations(self):
+        """Stores the estimated calibrations in the profiles file"""
+        estimated = False
+        for address, calibration in self.calibrations.items():
+            if calibration.estimated:
+                self.calibration_profiles.put(address, self.models[address].calibrator, calibration.estimated)
+                estimated = True
+        if estimated:
+            self.calibration_profiles.save()
+
+
+    async def connect(self, devices):
+        """Streams from the devices until disconnected
+
+        Parameters
+        ----------
+        devices : list
+            BLEDevices from a scan or BLE addresses; address strings are
+            connected to directly, without a full scan
+        """
+        if len(devices) == 0:
+            return
+        self.stop_requested = False
+        links = [Link(self.device_identifier(i, device), device) for i, device in enumerate(devices)]
+        handler = self.notification_handler if self.protocol == "sensortile" else self.notification_handler_for_nordic
+        try:
+            await self.start_session([(link.identifier, link.address) for link in links])
+            self._load_backend()
+            self.connections = ConnectionManager(self.client_class, self.characteristic_uuid,
+                                                 lambda identifier: partial(handler, identifier),
+                                                 self.telemetry, self.known_devices, self.connection_options,
+                                                 self.client_errors)
+            if self.stop_requested:
+                self.connections.stop()  # NOTE: Disconnected while the session was starting
+            await self.connections.run(links)
+        finally:
+            await self.stop_session()
+
+
+    async def disconnect(self):
+        self.stop_requested = True
+        self.is_notify_loop = False
+        if self.connections is not None:
+            self.connections.stop()
+
+
+    async def run(self, addresses=(), scan_time: float = 5.0):
+        """Headless session: connect, then stream until disconnected
+
+        Parameters
+        ----------
+        addresses : iterable of str
+            BLE addresses to connect to. When empty, the known devices are
+            connected to directly, or, without any known device (or with
+            ``[connection] direct = false``), every device named as in the
+            configuration after a scan.
+        scan_time : float
+            Seconds spent scanning before connecting
+
+        Returns
+        -------
+        list
+            Devices or addresses of the session
+        """
+        self.stop_requested = False
+        addresses = list(addresses)
+        if not addresses and self.connection_options.get('direct', True):
+            addresses = self.known_devices.addresses
+        if addresses:
+            devices = addresses
+        else:
+            if self.scanner is None:
+                self.instantiate_scanner()
+            await self.start_scan()
+            await asyncio.sleep(scan_time)
+            await self.stop_scan()
+            devices = list(self.IMU_devices.values())
+        if not self.stop_requested:  # NOTE: Disconnected while scanning
+            await self.connect(devices)
+
+        return devices
+
+
+    def notification_handler_for_nordic(self, device_number: int | str, sender: int, data: bytearray):
+        """
+        Async callback for Nordic IMU
+
+        Like notification_handler, the notification may hold several samples.
+        """
+        now = time()
+        self.telemetry.arrival(device_number, now)
+        if self.capture is not None:
+            self.capture.write(NORDIC, device_number, data)
+        self.pipeline.submit(device_number, (now, bytes(data)))
+
+
+    def notification_handler(self, device_number: int | str, sender: int, data: bytearray):
+        """Simple notification handler
+
+        Only stamps and enqueues the packet; the pipeline stages do the work.
+        """
+        now = time()
+        self.telemetry.arrival(device_number, now)
+        if self.capture is not None:
+            self.capture.write(SENSORTILE, device_number, data)
+        self.pipeline.submit(device_number, (now, bytes(data)))
+
+
+    def _decode_stage(self, device_number, item):
+        sample_time, data = item
+        if not self.layout.complete(data):
+            self.telemetry.malformed(device_number)  # NOTE: Short or truncated, decoding would misalign it
+            return None
+        # NOTE: A notification may carry several concatenated packets
+        samples = self.layout.decode(data).tolist()
+        tracker = self.sequence_trackers.get(device_number)
+        if tracker is None:
+            return Batch((sample_time, sample) for sample in samples)
+        batch = Batch()
+        for sample in samples:
+            batch.extend(tracker.update(sample_time, sample))
+        return batch
+
+
+    def _fuse_stage(self, device_number, item):
+        sample_time, fusion_data = item
+        model = self.device_models[device_number]
+        # NOTE: Integrates on the device counter when [device] timestamp-tick is set, else on arrival time
+        counter = None if self.layout.counter is None else fusion_data[self.layout.counter]
+        timestamp = self.clocks[device_number](counter, sample_time)
+        sensors = sensor_values(self.layout, fusion_data)
+        calibration = self.device_calibrations.get(device_number)
+        if calibration is not None and calibration.update(sensors[0:3], sensors[3:6], sensors[6:9]):
+            calibration.apply(model.calibrator)
+        model.tick(sensors[0:3], sensors[3:6], sensors[6:9], timestamp=timestamp)
+        # NOTE: Arrival time for latencies and the log, device sample time (as POSIX) for the OSC output
+        return sample_time, fusion_data, model.snapshot(), self.clocks[device_number].posix_time(timestamp)
+
+
+    def _publish_stage(self, device_number, item):
+        sample_time, fusion_data, model, device_time = item
+        streams = [("raw", fusion_data), *sample_values(model, self.features)]
+        if self.output_policies:
+            streams = self.output_policies.filter(device_number, device_time, streams)
+        if streams:
+            self.fanout.publish(device_number, device_time, streams)
+        self.telemetry.latency("ble_to_osc", time() - sample_time)
+        return item
+
+
+    def _log_stage(self, device_number, item):
+        sample_time, fusion_data, model, _ = item
+        if isinstance(fusion_data, InterpolatedSample):
+            return
+        # NOTE: The writer formats the time for CSV, the binary log keeps the float
+        self._write_log(sample_time, device_number, fusion_data, model)
+        self.telemetry.latency("ble_to_log", time() - sample_time)
+
+
+    def _write_log(self, timestamp, device_number, fusion_data, model):
+        self.log_writer.write(log_row(timestamp, device_number, sensor_values(self.layout, fusion_data), model))
+
+
+    def _create_log_file(self):
+        options = self.log_options
+        pipeline = self.configuration_dict.get('pipeline', DEFAULT_CONFIGURATION['pipeline'])
+        self.log_writer = SessionLogWriter(log_file_path,
+                                           format=options.get('format', "csv"),
+                                           flush_rows=options.get('flush-rows', 256),
+                                           flush_interval=options.get('flush-interval', 1.0),
+                                           rotate_bytes=int(options.get('rotate-mb', 0) * 1024 * 1024),
+                                           rotate_seconds=options.get('rotate-minutes', 0) * 60.0,
+                                           compress=options.get('compress', False),
+                                           policy=pipeline.get('log-policy', "block"))
+        self.log_name = self.log_writer.path
+        self.log_writer.start()
+
+
+    def log_stats(self) -> dict:
+        """Backlog, bytes written and rows lost by the session log writer"""
+        if self.log_writer is None:
+            return {}
+        return self.log_writer.stats()
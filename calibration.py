@@ -0,0 +1,306 @@
+# Developed by Paulo Chiliguano and KA HO Wong
+# Directed by Dr Roberto Alonso Trillo
+# HKBU Academy of Music
+# 2024
+
+"""Online calibration
+
+Estimates, while the bow is played, the corrections applied by Calibrator:
+the gyroscope bias from static periods, the accelerometer offset and scale
+from the gravity vector seen in different static poses, and the
+magnetometer hard- and soft-iron ellipsoid. Every estimator keeps
+fixed-size running sums (Welford means, normal equations of a least-squares
+fit), so a sample costs O(1) and no raw data is buffered. Results are kept
+per BLE address in a JSON file and loaded when the device connects.
+"""
+import json
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List
+import numpy as np
+from calibrator import Calibrator
+
+
+MAX_CONDITION = 1e12  # NOTE: Normal equations above this condition number are not solved
+MAX_ANISOTROPY = 2.0  # NOTE: Largest to smallest ellipsoid radius of a plausible fit
+
+
+class RunningMean:
+    """Welford mean of 3-vectors
+
+    Past ``horizon`` samples it turns into an exponential average, so the
+    estimate follows slow drift (e.g. the gyro bias warming up).
+    """
+    def __init__(self, horizon: int = 0):
+        self.horizon = horizon
+        self.count = 0
+        self._mean = [0.0, 0.0, 0.0]  # NOTE: Plain floats, cheaper than NumPy for three values
+
+    @property
+    def mean(self) -> np.ndarray:
+        return np.array(self._mean)
+
+    def add(self, x):
+        self.count += 1
+        weight = 1.0 / (min(self.count, self.horizon) if self.horizon else self.count)
+        mean = self._mean
+        mean[0] += (x[0] - mean[0]) * weight
+        mean[1] += (x[1] - mean[1]) * weight
+        mean[2] += (x[2] - mean[2]) * weight
+
+
+class StaticDetector:
+    """Flags samples taken while the sensor rests
+
+    Exponential moving variances of the gyroscope and the accelerometer
+    must stay under their thresholds for ``hold`` consecutive samples.
+
+    Parameters
+    ----------
+    gyro_noise : float
+        Largest standard deviation at rest, in degrees per second
+    accl_noise : float
+        Largest standard deviation at rest, in mg
+    hold : int
+        Samples at rest before the sensor is considered static
+    alpha : float
+        Gain of the moving averages
+    """
+    def __init__(self, gyro_noise: float = 1.0, accl_noise: float = 10.0, hold: int = 50, alpha: float = 0.05):
+        self.gyro_limit = 3.0 * gyro_noise * gyro_noise  # NOTE: Summed over the three axes
+        self.accl_limit = 3.0 * accl_noise * accl_noise
+        self.hold = hold
+        self.alpha = alpha
+        self.mean = None
+        self.variance = [0.0] * 6
+        self.run = 0
+
+    def update(self, accl, gyro) -> bool:
+        values = [*accl, *gyro]
+        if self.mean is None:
+            self.mean = [float(i) for i in values]
+            return False
+        alpha = self.alpha
+        mean, variance = self.mean, self.variance
+        for i, value in enumerate(values):
+            delta = value - mean[i]
+            mean[i] += alpha * delta
+            variance[i] = (1.0 - alpha) * (variance[i] + alpha * delta * delta)
+        if sum(variance[3:]) < self.gyro_limit and sum(variance[:3]) < self.accl_limit:
+            self.run += 1
+        else:
+            self.run = 0
+
+        return self.run >= self.hold
+
+
+class EllipsoidFit:
+    """Least-squares ellipsoid through 3-D points, from running normal equations
+
+    The quadric ``x' M x + 2 v' x = 1`` is fitted, with a full symmetric M
+    (9 parameters) or, when ``axis_aligned``, a diagonal one (6 parameters).
+    Points are divided by the norm of the first one to keep the sums well
+    conditioned.
+    """
+    def __init__(self, axis_aligned: bool = False):
+        self.axis_aligned = axis_aligned
+        size = 6 if axis_aligned else 9
+        self.normal = np.zeros((size, size))
+        self.rhs = np.zeros(size)
+        self.count = 0
+        self.scale = None
+
+    def add(self, point):
+        point = np.asarray(point, dtype=float)
+        if self.scale is None:
+            self.scale = float(np.linalg.norm(point)) or 1.0
+        x, y, z = point / self.scale
+        if self.axis_aligned:
+            row = np.array([x * x, y * y, z * z, 2 * x, 2 * y, 2 * z])
+        else:
+            row = np.array([x * x, y * y, z * z, 2 * x * y, 2 * x * z, 2 * y * z, 2 * x, 2 * y, 2 * z])
+        self.normal += np.outer(row, row)
+        self.rhs += row
+        self.count += 1
+
+    def solve(self):
+        """Centre and the matrix mapping the ellipsoid onto the unit sphere
+
+        Returns
+        -------
+        tuple or None
+            ``(center, transform, radii)`` in the units of the points, or
+            None while the points do not determine a plausible ellipsoid
+        """
+        if self.count < len(self.rhs) or np.linalg.cond(self.normal) > MAX_CONDITION:
+            return None
+        p = np.linalg.solve(self.normal, self.rhs)
+        if self.axis_aligned:
+            m, v = np.diag(p[:3]), p[3:]
+        else:
+            m = np.array([[p[0], p[3], p[4]],
+                          [p[3], p[1], p[5]],
+                          [p[4], p[5], p[2]]])
+            v = p[6:]
+        center = -np.linalg.solve(m, v)
+        k = 1.0 + center @ m @ center
+        if k <= 0.0:
+            return None
+        eigenvalues, eigenvectors = np.linalg.eigh(m / k)
+        if eigenvalues.min() <= 0.0:
+            return None
+        radii = self.scale / np.sqrt(eigenvalues)
+        if radii.max() > MAX_ANISOTROPY * radii.min():
+            return None
+        transform = eigenvectors @ np.diag(np.sqrt(eigenvalues)) @ eigenvectors.T / self.scale
+
+        return center * self.scale, transform, radii
+
+
+class OnlineCalibration:
+    """Running calibration estimates of one device
+
+    Inputs are raw sensor values as passed to GestureModel.tick: accl in mg,
+    gyro in degrees per second and magn in sensor units.
+
+    Parameters
+    ----------
+    options : dict
+        ``[calibration]`` configuration section
+    """
+    def __init__(self, options: dict | None = None):
+        options = options or {}
+        self.detector = StaticDetector(options.get('static-gyro', 1.0), options.get('static-accl', 10.0),
+                                       options.get('static-samples', 50))
+        self.min_static = options.get('min-static', 100)
+        self.min_poses = options.get('min-poses', 6)
+        self.min_field_points = options.get('min-field-points', 60)
+        self.pose_spacing = options.get('pose-spacing', 0.2)
+        self.field_spacing = options.get('field-spacing', 0.05)
+        self.gyro_bias = RunningMean(horizon=options.get('gyro-horizon', 3000))
+        self.pose = RunningMean()
+        self.poses = EllipsoidFit(axis_aligned=True)
+        self.field = EllipsoidFit()
+        self._last_pose = None
+        self._last_field = None
+        self._pending = set()
+        self.estimated: Dict[str, int] = {}  # NOTE: Number of estimates applied, per sensor
+
+    def update(self, accl, gyro, magn) -> bool:
+        """Adds one sample
+
+        Returns True when an estimate changed and ``apply`` should be
+        called; at most once per static period, pose or batch of field
+        points, so the cost stays O(1) per sample on average.
+        """
+        if self.detector.update(accl, gyro):
+            self.gyro_bias.add(gyro)
+            self.pose.add(accl)
+            if self.gyro_bias.count >= self.min_static and self.gyro_bias.count % self.min_static == 0:
+                self._pending.add('gyro')
+        elif self.pose.count:
+            self._add_pose(self.pose.mean)
+            self.pose = RunningMean()
+        self._add_field(magn)
+
+        return bool(self._pending)
+
+    def _add_pose(self, mean: np.ndarray):
+        if self.pose.count < self.detector.hold:
+            return
+        norm = np.linalg.norm(mean)
+        if self._last_pose is not None and np.linalg.norm(mean - self._last_pose) < self.pose_spacing * norm:
+            return
+        self._last_pose = mean
+        self.poses.add(mean)
+        if self.poses.count >= self.min_poses:
+            self._pending.add('accl')
+
+    def _add_field(self, magn):
+        x, y, z = magn
+        last = self._last_field
+        if last is not None:
+            dx, dy, dz = x - last[0], y - last[1], z - last[2]
+            spacing = self.field_spacing * self.field_spacing * (x * x + y * y + z * z)
+            if dx * dx + dy * dy + dz * dz < spacing:
+                return
+        self._last_field = (x, y, z)
+        self.field.add(magn)
+        if self.field.count >= self.min_field_points and self.field.count % 20 == 0:
+            self._pending.add('magn')
+
+    def apply(self, calibrator: Calibrator) -> List[str]:
+        """Applies the pending estimates to ``calibrator``
+
+        Returns
+        -------
+        list
+            Sensors whose calibration changed
+        """
+        applied = []
+        for sensor in sorted(self._pending):
+            if sensor == 'gyro':
+                calibrator.set_calibration('gyro', bias=self.gyro_bias.mean)
+            elif sensor == 'accl':
+                fit = self.poses.solve()
+                if fit is None:
+                    continue
+                center, transform, _ = fit
+                calibrator.set_calibration('accl', transform, center)
+            else:
+                fit = self.field.solve()
+                if fit is None:
+                    continue
+                center, transform, radii = fit
+                # NOTE: Scaled back to the mean field strength, the magnetometer units are kept
+                calibrator.set_calibration('magn', transform * np.cbrt(radii.prod()), center)
+            self.estimated[sensor] = self.estimated.get(sensor, 0) + 1
+            applied.append(sensor)
+        self._pending.clear()
+
+        return applied
+
+    def counters(self) -> dict:
+        return {
+            'static': self.gyro_bias.count,
+            'poses': self.poses.count,
+            'field_points': self.field.count,
+            **{f"{sensor}_estimates": count for sensor, count in self.estimated.items()},
+        }
+
+
+class CalibrationProfiles:
+    """Calibrator profiles keyed by BLE address, persisted as JSON
+
+    Parameters
+    ----------
+    path : str or Path, optional
+        JSON file, None to keep the profiles in memory
+    """
+    def __init__(self, path: str | Path | None = None):
+        self.path = Path(path) if path else None
+        self.profiles: Dict[str, dict] = {}
+        if self.path is not None and self.path.exists():
+            try:
+                self.profiles = json.loads(self.path.read_text(encoding='UTF8'))
+            except (OSError, ValueError):
+                pass
+
+    def get(self, address: str) -> dict | None:
+        return self.profiles.get(str(address))
+
+    def put(self, address: str, calibrator: Calibrator, sensors=None):
+        """Stores the calibration of ``sensors`` (all by default) of a device"""
+        profile = self.profiles.setdefault(str(address), {})
+        for sensor, values in calibrator.profile().items():
+            if sensors is None or sensor in sensors:
+                profile[sensor] = values
+        profile['updated'] = datetime.now().isoformat(timespec='seconds')
+
+    def save(self):
+        if self.path is None:
+            return
+        try:
+            self.path.write_text(json.dumps(self.profiles, indent=2), encoding='UTF8')
+        except OSError:
+            self.path = None
@@ -1,15 +1,20 @@
-
-
 # Modified by Paulo Chiliguano and Travis West
 # Directed by Dr Roberto Alonso Trillo
 # Department of Music - Hong Kong Baptist University
 # 2022
 
 """Calibrator
+
+Every sensor is corrected by one affine transform, ``transform @ x - offset``,
+where ``offset = transform @ bias`` is precomputed whenever the calibration
+changes.
 """
 import numpy as np
 
 
+SENSORS = ('accl', 'gyro', 'magn')
+
+
 class Calibrator():
     def __init__(self):
         self.DEG_RAD_RATIO = np.pi / 180.0
@@ -22,17 +27,45 @@ class Calibrator():
         self.gyro_transform = self.DEG_RAD_RATIO * np.identity(3)
 
         self.magn_transform = np.identity(3)
+        for sensor in SENSORS:
+            self._update_offset(sensor)
 
-    def calibrate(self, vector_measurement, matrix_transform, vector_bias):
-        return np.matmul(matrix_transform, vector_measurement - vector_bias)
+    def _update_offset(self, sensor: str):
+        transform, bias = getattr(self, f"{sensor}_transform"), getattr(self, f"{sensor}_bias")
+        setattr(self, f"{sensor}_offset", transform @ bias)
+
+    def calibrate(self, vector_measurement, matrix_transform, vector_offset):
+        return np.matmul(matrix_transform, vector_measurement) - vector_offset
 
     def calibrate_accl(self, accl):
-        return self.calibrate(accl, self.accl_transform, self.accl_bias)
+        return self.calibrate(accl, self.accl_transform, self.accl_offset)
 
     def calibrate_gyro(self, gyro):
-        return self.calibrate(gyro, self.gyro_transform, self.gyro_bias)
+        return self.calibrate(gyro, self.gyro_transform, self.gyro_offset)
 
     def calibrate_magn(self, magn):
-        return self.calibrate(magn, self.magn_transform, self.magn_bias)
+        return self.calibrate(magn, self.magn_transform, self.magn_offset)
+
+    def set_calibration(self, sensor: str, transform=None, bias=None):
+        """Sets the transform and/or the bias of 'accl', 'gyro' or 'magn'
+
+        The bias is in raw sensor units and subtracted before the transform,
+        which also converts to g, rad/s and the magnetometer units.
+        """
+        if transform is not None:
+            setattr(self, f"{sensor}_transform", np.array(transform, dtype=float).reshape(3, 3))
+        if bias is not None:
+            setattr(self, f"{sensor}_bias", np.array(bias, dtype=float).reshape(3))
+        self._update_offset(sensor)
+
+    def profile(self) -> dict:
+        """Transforms and biases as plain lists, e.g. to store as JSON"""
+        return {sensor: {'transform': getattr(self, f"{sensor}_transform").tolist(),
+                         'bias': getattr(self, f"{sensor}_bias").tolist()}
+                for sensor in SENSORS}
 
-    #TODO: Set biases function
+    def load_profile(self, profile: dict):
+        """Applies a profile from ``profile``; missing sensors keep their calibration"""
+        for sensor in SENSORS:
+            if sensor in profile:
+                self.set_calibration(sensor, profile[sensor].get('transform'), profile[sensor].get('bias'))
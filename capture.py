@@ -0,0 +1,100 @@
+# Developed by Paulo Chiliguano and KA HO Wong
+# Directed by Dr Roberto Alonso Trillo
+# HKBU Academy of Music
+# 2024
+
+"""Raw BLE capture
+
+Compact recording of every notification received by the bridge, so a
+session can be replayed through the same handlers without the bows.
+"""
+import json
+import struct
+from pathlib import Path
+from time import monotonic
+from typing import Iterator, NamedTuple
+
+
+CAPTURE_MAGIC = b"MBCAP\x00\x00\x01"
+RECORD_HEADER = struct.Struct('<dBBH')  # NOTE: arrival time, flags, device id length, data length
+
+SENSORTILE = 0
+NORDIC = 1
+HANDLER_MASK = 0x01
+INTEGER_ID = 0x02
+
+
+class CapturedNotification(NamedTuple):
+    arrival: float
+    handler: int
+    device_number: int | str
+    data: bytes
+
+
+class CaptureWriter:
+    """Appends notifications to a capture file
+
+    Each record holds the arrival time in seconds since the capture started,
+    which handler received it (SENSORTILE or NORDIC), the device identifier
+    and the raw payload.
+    """
+    def __init__(self, path: str | Path, metadata: dict | None = None):
+        self.path = Path(path)
+        self.count = 0
+        self._start = monotonic()
+        self._file = open(self.path, 'wb', buffering=1 << 16)
+        header = json.dumps({'version': 1, **(metadata or {})}).encode('UTF8')
+        self._file.write(CAPTURE_MAGIC)
+        self._file.write(len(header).to_bytes(4, 'little'))
+        self._file.write(header)
+
+    def write(self, handler: int, device_number: int | str, data: bytes):
+        flags = handler
+        if isinstance(device_number, int):
+            flags |= INTEGER_ID
+        identifier = str(device_number).encode('UTF8')
+        self._file.write(RECORD_HEADER.pack(monotonic() - self._start, flags, len(identifier), len(data)))
+        self._file.write(identifier)
+        self._file.write(data)
+        self.count += 1
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_header(path: str | Path) -> dict:
+    """Metadata stored when the capture started"""
+    with open(path, 'rb') as f:
+        if f.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise ValueError(f"{path} is not a capture file")
+        length = int.from_bytes(f.read(4), 'little')
+
+        return json.loads(f.read(length))
+
+
+def read_capture(path: str | Path) -> Iterator[CapturedNotification]:
+    """Yields the captured notifications in arrival order"""
+    data = Path(path).read_bytes()
+    if data[:len(CAPTURE_MAGIC)] != CAPTURE_MAGIC:
+        raise ValueError(f"{path} is not a capture file")
+    length = int.from_bytes(data[len(CAPTURE_MAGIC):len(CAPTURE_MAGIC) + 4], 'little')
+    offset = len(CAPTURE_MAGIC) + 4 + length
+    end = len(data)
+    while offset + RECORD_HEADER.size <= end:
+        arrival, flags, id_length, data_length = RECORD_HEADER.unpack_from(data, offset)
+        offset += RECORD_HEADER.size
+        identifier = data[offset:offset + id_length].decode('UTF8')
+        offset += id_length
+        payload = data[offset:offset + data_length]
+        offset += data_length
+        if len(payload) < data_length:
+            break  # NOTE: Truncated last record
+        device_number = int(identifier) if flags & INTEGER_ID else identifier
+        yield CapturedNotification(arrival, flags & HANDLER_MASK, device_number, payload)
@@ -0,0 +1,171 @@
+# Developed by Paulo Chiliguano and KA HO Wong
+# Directed by Dr Roberto Alonso Trillo
+# HKBU Academy of Music
+# 2024
+
+"""BLE connection manager
+
+Keeps one link per bow: connects to every device at once, by address when
+it is already known (no full scan), and reconnects with exponential backoff
+when a link drops mid-performance. Addresses of connected devices are
+remembered in a small JSON file, so the next launch can connect directly.
+"""
+import asyncio
+import json
+import random
+from pathlib import Path
+from time import time
+from typing import Dict, List
+
+
+CONNECTION_ERRORS = (OSError, asyncio.TimeoutError, LookupError)  # NOTE: Plus BleakError with bleak
+
+
+class KnownDevices:
+    """BLE addresses the bridge connected to before
+
+    Parameters
+    ----------
+    path : str or Path, optional
+        JSON file the addresses are persisted in, None to keep them in memory
+    addresses : iterable of str
+        Addresses from the configuration, always known
+    """
+    def __init__(self, path: str | Path | None = None, addresses=()):
+        self.path = Path(path) if path else None
+        self.devices: Dict[str, str] = {str(address): "" for address in addresses}
+        if self.path is not None and self.path.exists():
+            try:
+                self.devices.update(json.loads(self.path.read_text(encoding='UTF8')))
+            except (OSError, ValueError):
+                pass
+
+    @property
+    def addresses(self) -> List[str]:
+        return list(self.devices)
+
+    def add(self, address: str, name: str = ""):
+        """Remembers an address, saving the file when it is new"""
+        name = name or self.devices.get(address, "")
+        if self.devices.get(address) == name:
+            return
+        self.devices[address] = name
+        if self.path is not None:
+            try:
+                self.path.write_text(json.dumps(self.devices, indent=2), encoding='UTF8')
+            except OSError:
+                self.path = None
+
+
+class Link:
+    """Connection state and counters of one device"""
+    def __init__(self, identifier, target):
+        self.identifier = identifier
+        self.target = target  # NOTE: BLEDevice from a scan, or a bare address string
+        self.address = str(getattr(target, 'address', target))
+        self.connects = 0
+        self.drops = 0
+        self.failures = 0
+
+    def counters(self) -> dict:
+        return {'connects': self.connects, 'drops': self.drops, 'failures': self.failures}
+
+
+class ConnectionManager:
+    """Concurrent links to the devices of one session
+
+    Parameters
+    ----------
+    client_class : type
+        BleakClient or a stand-in with the same signature
+    characteristic_uuid : str
+        Notification characteristic
+    handler_for : callable
+        Returns the notification handler of a device identifier
+    telemetry : Telemetry
+        Receives the connection attempts, for the time to first sample
+    known_devices : KnownDevices, optional
+        Updated with the address of every connected device
+    options : dict
+        ``[connection]`` configuration section
+    errors : tuple
+        Exceptions of a failed or lost connection, retried with backoff
+    """
+    def __init__(self, client_class, characteristic_uuid: str, handler_for, telemetry,
+                 known_devices: KnownDevices | None = None, options: dict | None = None,
+                 errors: tuple = CONNECTION_ERRORS):
+        options = options or {}
+        self.client_class = client_class
+        self.errors = errors
+        self.characteristic_uuid = characteristic_uuid
+        self.handler_for = handler_for
+        self.telemetry = telemetry
+        self.known_devices = known_devices
+        self.timeout = options.get('timeout', 10.0)
+        self.reconnect = options.get('reconnect', True)
+        self.backoff_initial = options.get('backoff-initial', 0.5)
+        self.backoff_max = options.get('backoff-max', 10.0)
+        self.links: List[Link] = []
+        self._stopped = asyncio.Event()
+
+    def counters(self) -> dict:
+        """Connects, drops and failed attempts, keyed by device identifier"""
+        return {link.identifier: link.counters() for link in self.links}
+
+    def stop(self):
+        self._stopped.set()
+
+    async def run(self, links: List[Link]):
+        """Keeps every link up until ``stop`` is called"""
+        self.links = links
+        await asyncio.gather(*(self._keep(link) for link in links))
+
+    async def _keep(self, link: Link):
+        delay = self.backoff_initial
+        while not self._stopped.is_set():
+            self.telemetry.connecting(link.identifier, time())
+            try:
+                connected = await self._session(link)
+            except self.errors:
+                connected = False
+            # NOTE: After a dropout the time to first sample includes the backoff
+            self.telemetry.connecting(link.identifier, time())
+            if self._stopped.is_set() or not self.reconnect:
+                return
+            if connected:
+                link.drops += 1
+                delay = self.backoff_initial
+            else:
+                link.failures += 1
+            # NOTE: Randomised so that bows dropped together do not retry in lockstep
+            await self._wait(delay * random.uniform(0.5, 1.0))
+            delay = min(delay * 2.0, self.backoff_max)
+
+    async def _session(self, link: Link) -> bool:
+        """Streams from one connection until it drops or the manager stops
+
+        Returns True when the device was connected.
+        """
+        dropped = asyncio.Event()
+        client = self.client_class(link.target, disconnected_callback=lambda _: dropped.set(),
+                                   timeout=self.timeout)
+        async with client:
+            link.connects += 1
+            if self.known_devices is not None:
+                self.known_devices.add(link.address, getattr(link.target, 'name', None) or "")
+            await client.start_notify(self.characteristic_uuid, self.handler_for(link.identifier))
+            stopped = asyncio.ensure_future(self._stopped.wait())
+            drop = asyncio.ensure_future(dropped.wait())
+            await asyncio.wait((stopped, drop), return_when=asyncio.FIRST_COMPLETED)
+            stopped.cancel()
+            drop.cancel()
+            if client.is_connected:
+                await client.stop_notify(self.characteristic_uuid)
+
+        return True
+
+    async def _wait(self, seconds: float):
+        try:
+            await asyncio.wait_for(self._stopped.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
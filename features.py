@@ -0,0 +1,97 @@
+# Developed by Paulo Chiliguano and KA HO Wong
+# Directed by Dr Roberto Alonso Trillo
+# HKBU Academy of Music
+# 2024
+
+"""Derived features
+
+Registry of the outputs GestureModel derives from the fusion filter. Every
+feature declares the features it depends on, the OSC streams it feeds and
+the step computing it; a session only runs the steps of the features its
+destinations or its log need, and intermediates such as the rotation
+matrix are computed once per tick for every feature using them.
+"""
+from math import acos, atan2, sqrt
+from typing import Callable, Iterable, List, NamedTuple, Tuple
+import numpy as np
+
+
+RAD_DEG_RATIO = 180 / np.pi
+
+
+class Feature(NamedTuple):
+    requires: Tuple[str, ...]
+    streams: Tuple[str, ...]  # NOTE: Empty for intermediates
+    compute: Callable | None  # NOTE: Called with the model after the fusion step, None when fusion sets it
+
+
+def quaternion_spherical_coords(w: float, x: float, y: float, z: float) -> List[float]:
+    """Spherical coordinates ``[theta, phi]`` of a quaternion
+
+    Same values as ``quaternion.as_spherical_coords`` of numpy-quaternion,
+    from plain floats.
+    """
+    norm = w * w + x * x + y * y + z * z
+    return [2.0 * acos(min(sqrt((w * w + z * z) / norm), 1.0)), atan2(z, w) + atan2(-x, y)]
+
+
+def _rotation_matrix(model):
+    model.matrix = model.fusion_filter.rotation_matrix()
+
+
+def _spherical_coords(model):
+    model.spherical_coords = quaternion_spherical_coords(*model.quaternion.elements.tolist())
+
+
+def _euler_angles(model):
+    (m00, _, _), (m10, _, _), (m20, m21, m22) = model.matrix.tolist()
+    model.skewness = RAD_DEG_RATIO * atan2(m10, m00)
+    model.tilt = RAD_DEG_RATIO * atan2(m20, sqrt(m21 * m21 + m22 * m22))
+    model.roll = RAD_DEG_RATIO * atan2(m21, m22)
+
+
+def _movement_velocity(model):
+    model.movement_velocity = model.movement_velocity * 0.9999 + model.movement_acceleration
+
+
+# NOTE: In dependency and OSC output order
+FEATURES = {
+    'quaternion': Feature((), ("quaternion",), None),
+    'rotation_matrix': Feature(('quaternion',), (), _rotation_matrix),
+    'spherical_coords': Feature(('quaternion',), ("spherical_coords",), _spherical_coords),
+    'motion_acceleration': Feature((), ("motion_acceleration/sensor_frame",), None),
+    'acceleration_derivative': Feature((), ("motion_acceleration/sensor_derivative",), None),
+    'movement_velocity': Feature(('motion_acceleration',), ("motion_acceleration/sensor_velocity",),
+                                 _movement_velocity),
+    'euler_angles': Feature(('rotation_matrix',), ("motion_acceleration/skewness", "motion_acceleration/tilt",
+                                                   "motion_acceleration/roll"), _euler_angles),
+}
+
+# NOTE: Features in the session log columns after the sensor values, see session_log.CSV_HEADER
+LOGGED_FEATURES = ('quaternion', 'motion_acceleration', 'acceleration_derivative', 'movement_velocity',
+                   'euler_angles')
+
+
+def resolve(names: Iterable[str]) -> Tuple[str, ...]:
+    """``names`` and every feature they depend on, in FEATURES order
+
+    Raises
+    ------
+    KeyError
+        For a name missing from FEATURES
+    """
+    needed = set()
+    pending = list(names)
+    while pending:
+        name = pending.pop()
+        if name not in needed:
+            needed.add(name)
+            pending.extend(FEATURES[name].requires)
+
+    return tuple(name for name in FEATURES if name in needed)
+
+
+def features_for(wants: Callable[[str], bool]) -> Tuple[str, ...]:
+    """Features feeding at least one stream for which ``wants(stream)`` is true"""
+    return tuple(name for name, feature in FEATURES.items() if any(wants(stream) for stream in feature.streams))
+
@@ -9,6 +9,7 @@
 """Fusion filter
 """
 import numpy as np
+from math import cos, sin, sqrt
 from time import monotonic
 from pyquaternion import Quaternion
 
@@ -18,11 +19,26 @@ class BaseFilter:
         self.period = 0
         self.current = monotonic()
         self.previous = self.current
+        self.is_timestamped = False
         self.q       = Quaternion()
         self.q_align = Quaternion()
 
-    def calculate_period(self):
-        self.current = monotonic()
+    def calculate_period(self, timestamp=None):
+        """Time elapsed since the previous sample
+
+        Parameters
+        ----------
+        timestamp : float, optional
+            Sample time in seconds, e.g. when reprocessing a recording.
+            Host monotonic time is used otherwise.
+        """
+        if timestamp is None:
+            self.current = monotonic()
+        else:
+            self.current = timestamp
+            if not self.is_timestamped:
+                self.previous = timestamp
+                self.is_timestamped = True
         self.period = self.current - self.previous
         self.previous = self.current
 
@@ -34,9 +50,13 @@ class BaseFilter:
     def align(self, quaternion):
         return self.q_align * quaternion
 
-    def fuse(self, omega, v_a, v_m, k_I = 1.0, k_P = 3.0, k_a=1.0, k_m=1.0):
+    def fuse(self, omega, v_a, v_m, k_I = 1.0, k_P = 3.0, k_a=1.0, k_m=1.0, timestamp=None):
         return Quaternion()
 
+    def rotation_matrix(self):
+        """Rotation matrix of the current orientation"""
+        return self.q.rotation_matrix
+
     def fuse_and_align(self, *args):
         q = self.fuse(*args)
         return self.align(q), self.q_align.rotate(self.ma_earth)
@@ -69,8 +89,8 @@ class FusionFilter(BaseFilter):
     def set_static_threshold(self, v):
         self.static_threshold = v
 
-    def fuse(self, omega, v_a, v_m, k_I = 0.0, k_P = 3.0, k_a=1.0, k_m=0.0):
-        self.calculate_period()
+    def fuse(self, omega, v_a, v_m, k_I = 0.0, k_P = 3.0, k_a=1.0, k_m=0.0, timestamp=None):
+        self.calculate_period(timestamp)
 
         self.aa = self.anm1 * 0.5 + self.aa * 0.5 # average accel
         self.da = (self.aa - self.anm1) # "derivative" accel
@@ -117,3 +137,143 @@ class FusionFilter(BaseFilter):
 
         self.q.integrate(omega, self.period)
         return self.q
+
+
+class FastFusionFilter(FusionFilter):
+    """Allocation-free variant of FusionFilter
+
+    Same Mahony-style update, written on plain floats so that no rotation
+    matrix, Quaternion or small NumPy array is created per tick. The state
+    is written back in place to ``q``, ``rotation``, ``ma_sensor``,
+    ``ma_earth`` and ``da`` once per call.
+    """
+    def __init__(self):
+        super().__init__()
+        self.static = False
+        self.rotation = np.identity(3)
+        self._q = [1.0, 0.0, 0.0, 0.0]
+        self._r = [1.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 1.0]  # NOTE: Row-major rotation matrix of _q
+        self._bias = [0.0, 0.0, 0.0]
+        self._b_hat = [0.0, 0.0, 0.0]
+        self._aa = [0.0, 0.0, 0.0]
+        self._anm1 = [0.0, 0.0, 0.0]
+
+    def rotation_matrix(self):
+        return self.rotation
+
+    def fuse(self, omega, v_a, v_m, k_I = 0.0, k_P = 3.0, k_a=1.0, k_m=0.0, timestamp=None):
+        period = self.calculate_period(timestamp)
+        gx, gy, gz = omega.tolist() if isinstance(omega, np.ndarray) else omega
+        ax, ay, az = v_a.tolist() if isinstance(v_a, np.ndarray) else v_a
+        mx, my, mz = v_m.tolist() if isinstance(v_m, np.ndarray) else v_m
+
+        px, py, pz = self._anm1
+        sx, sy, sz = self._aa
+        sx = px * 0.5 + sx * 0.5  # average accel
+        sy = py * 0.5 + sy * 0.5
+        sz = pz * 0.5 + sz * 0.5
+        dx, dy, dz = sx - px, sy - py, sz - pz  # "derivative" accel
+        self._aa = [sx, sy, sz]
+        self._anm1 = [ax, ay, az]
+        static = sqrt(dx*dx + dy*dy + dz*dz) < self.static_threshold
+        self.static = static
+
+        bx, by, bz = self._bias
+        if static:
+            galpha = self.galpha
+            bx = (1 - galpha) * gx + galpha * bx
+            by = (1 - galpha) * gy + galpha * by
+            bz = (1 - galpha) * gz + galpha * bz
+            self._bias = [bx, by, bz]
+        gx -= bx
+        gy -= by
+        gz -= bz
+
+        r00, r01, r02, r10, r11, r12, r20, r21, r22 = self._r
+
+        # the third row of the rotation matrix is the global Z axis expressed in the sensor frame
+        msx, msy, msz = ax - r20, ay - r21, az - r22  # zero-g in sensor frame
+        mex = r00*msx + r10*msy + r20*msz  # zero-g in global frame
+        mey = r01*msx + r11*msy + r21*msz
+        mez = r02*msx + r12*msy + r22*msz
+
+        n = sqrt(ax*ax + ay*ay + az*az)
+        ax, ay, az = ax / n, ay / n, az / n
+        n = sqrt(mx*mx + my*my + mz*mz)
+        mx, my, mz = mx / n, my / n, mz / n
+        xx, xy, xz = ay*mz - az*my, az*mx - ax*mz, ax*my - ay*mx  # cross vector
+
+        hx = r00*xx + r01*xy + r02*xz
+        hy = r10*xx + r11*xy + r12*xz
+        hz = r20*xx + r21*xy + r22*xz
+        b0, b2 = sqrt(hx*hx + hy*hy), hz
+
+        ex = r00*b0 + r20*b2  # estimated cross vector
+        ey = r01*b0 + r21*b2
+        ez = r02*b0 + r22*b2
+
+        # discrepancies based on accelerometer reading and on cross vector, see Mahoney et al. 2008
+        wx = (ay*r22 - az*r21) * k_a + (xy*ez - xz*ey) * k_m
+        wy = (az*r20 - ax*r22) * k_a + (xz*ex - xx*ez) * k_m
+        wz = (ax*r21 - ay*r20) * k_a + (xx*ey - xy*ex) * k_m
+
+        if k_I > 0.0:
+            ix, iy, iz = self._b_hat
+            ix += static * wx * period  # see eq. (48c)
+            iy += static * wy * period
+            iz += static * wz * period
+            self._b_hat = [ix, iy, iz]
+            gx += k_P * wx + k_I * ix
+            gy += k_P * wy + k_I * iy
+            gz += k_P * wz + k_I * iz
+        else:
+            self._b_hat = [0.0, 0.0, 0.0]  # Madgwick: "prevent integral windup"
+            gx += k_P * wx
+            gy += k_P * wy
+            gz += k_P * wz
+
+        self._integrate(gx, gy, gz, period)
+
+        self.ma_sensor[0], self.ma_sensor[1], self.ma_sensor[2] = msx, msy, msz
+        self.ma_earth[0], self.ma_earth[1], self.ma_earth[2] = mex, mey, mez
+        self.da[0], self.da[1], self.da[2] = dx, dy, dz
+        return self.q
+
+    def _integrate(self, gx, gy, gz, period):
+        """Closed-form integration of a constant rate, as Quaternion.integrate"""
+        qw, qx, qy, qz = _fast_normalise(*self._q)
+        rx, ry, rz = gx * period, gy * period, gz * period
+        angle = sqrt(rx*rx + ry*ry + rz*rz)
+        if angle > 0:
+            s = sin(angle / 2.0) / angle
+            cw, cx, cy, cz = cos(angle / 2.0), rx * s, ry * s, rz * s
+            qw, qx, qy, qz = _fast_normalise(qw*cw - qx*cx - qy*cy - qz*cz,
+                                             qw*cx + qx*cw + qy*cz - qz*cy,
+                                             qw*cy - qx*cz + qy*cw + qz*cx,
+                                             qw*cz + qx*cy - qy*cx + qz*cw)
+        # NOTE: As Quaternion.rotation_matrix, normalise properly before building the matrix
+        norm_sq = qw*qw + qx*qx + qy*qy + qz*qz
+        if abs(1.0 - norm_sq) >= 1e-14 and norm_sq > 0:
+            n = sqrt(norm_sq)
+            qw, qx, qy, qz = qw / n, qx / n, qy / n, qz / n
+        self._q = [qw, qx, qy, qz]
+        self.q.q[0], self.q.q[1], self.q.q[2], self.q.q[3] = qw, qx, qy, qz
+
+        ww, xx, yy, zz = qw*qw, qx*qx, qy*qy, qz*qz
+        self._r = r = [ww + xx - yy - zz, 2*(qx*qy - qw*qz), 2*(qx*qz + qw*qy),
+                       2*(qx*qy + qw*qz), ww - xx + yy - zz, 2*(qy*qz - qw*qx),
+                       2*(qx*qz - qw*qy), 2*(qy*qz + qw*qx), ww - xx - yy + zz]
+        self.rotation.flat[:] = r
+
+
+def _fast_normalise(w, x, y, z):
+    """Float version of Quaternion._fast_normalise"""
+    mag_squared = w*w + x*x + y*y + z*z
+    if abs(1.0 - mag_squared) < 1e-14 or mag_squared == 0:
+        return w, x, y, z
+    if abs(1.0 - mag_squared) < 2.107342e-08:
+        mag = (1.0 + mag_squared) / 2.0  # Pade approximation valid if error is small
+    else:
+        mag = sqrt(mag_squared)
+
+    return w / mag, x / mag, y / mag, z / mag
@@ -10,13 +10,41 @@
 """
 import numpy as np
 from pyquaternion import Quaternion
-from typing import List
+from typing import List, NamedTuple
 from calibrator import Calibrator
-from fusion_filter import FusionFilter
+from features import FEATURES, resolve
+from fusion_filter import FastFusionFilter, FusionFilter
+
+
+class GestureSnapshot(NamedTuple):
+    """Copy of the model outputs for one sample, safe to read from another thread
+
+    Outputs of features the model does not compute are None.
+    """
+    quaternion: Quaternion
+    movement_acceleration: np.ndarray | None
+    acceleration_derivative: np.ndarray | None
+    movement_velocity: np.ndarray | None
+    skewness: float | None
+    tilt: float | None
+    roll: float | None
+    spherical_coords: List[float] | None = None
 
 
 class GestureModel():
-    def __init__(self):
+    """Fusion of one device and the features derived from it
+
+    Parameters
+    ----------
+    fast : bool
+        Use FastFusionFilter instead of the reference FusionFilter
+    gains : dict, optional
+        Fusion gains, see ``configure``
+    features : iterable of str, optional
+        Names from features.FEATURES to compute, with their dependencies;
+        all of them by default
+    """
+    def __init__(self, fast: bool = False, gains: dict | None = None, features=None):
         self.RAD_DEG_RATIO = 180 / np.pi
         self.skewness = 0
         self.tilt = 0
@@ -28,19 +56,48 @@ class GestureModel():
         self.movement_acceleration = np.zeros(3)
         self.acceleration_derivative = np.zeros(3)
         self.movement_velocity = np.zeros(3)
+        self.spherical_coords = [0.0, 0.0]
         self.quaternion = Quaternion()
         self.calibrator = Calibrator()
-        self.fusion_filter = FusionFilter()
+        self.fusion_filter = FastFusionFilter() if fast else FusionFilter()
+        self.fuse_gains = {}
+        self.configure(**(gains or {}))
+        self.select_features(FEATURES if features is None else features)
 
-    def tick(self, accl: List[float], gyro: List[float], magn: List[float]):
+    def select_features(self, features):
+        """Computes only ``features`` and the features they depend on"""
+        self.features = resolve(features)
+        self._steps = [FEATURES[name].compute for name in self.features if FEATURES[name].compute is not None]
+
+    def configure(self, k_I=None, k_P=None, k_a=None, k_m=None, galpha=None, static_threshold=None):
+        """Sets the fusion gains; arguments left as None keep their value"""
+        gains = {'k_I': k_I, 'k_P': k_P, 'k_a': k_a, 'k_m': k_m}
+        self.fuse_gains.update({k: v for k, v in gains.items() if v is not None})
+        if galpha is not None:
+            self.fusion_filter.set_gyro_bias_alpha(galpha)
+        if static_threshold is not None:
+            self.fusion_filter.set_static_threshold(static_threshold)
+
+    def tick(self, accl: List[float], gyro: List[float], magn: List[float], timestamp: float | None = None):
         self.caccl = self.calibrator.calibrate_accl(accl)
         self.cgyro = self.calibrator.calibrate_gyro(gyro)
         self.cmagn = self.calibrator.calibrate_magn(magn)
-        self.quaternion = self.fusion_filter.fuse(self.cgyro, self.caccl, self.cmagn)
-        self.matrix = self.quaternion.rotation_matrix
-        self.skewness = self.RAD_DEG_RATIO * np.arctan2(self.matrix[1,0], self.matrix[0,0])
-        self.tilt = self.RAD_DEG_RATIO * np.arctan2(self.matrix[2,0], np.sqrt(self.matrix[2,1] * self.matrix[2,1] + self.matrix[2,2] * self.matrix[2,2]))
-        self.roll = self.RAD_DEG_RATIO * np.arctan2(self.matrix[2,1], self.matrix[2,2])
+        self.quaternion = self.fusion_filter.fuse(self.cgyro, self.caccl, self.cmagn,
+                                                  timestamp=timestamp, **self.fuse_gains)
+        # NOTE: Byproducts of the fusion step, only copied when selected
         self.movement_acceleration = self.fusion_filter.ma_sensor
         self.acceleration_derivative = self.fusion_filter.da
-        self.movement_velocity = self.movement_velocity * 0.9999 + self.movement_acceleration
+        for step in self._steps:
+            step(self)
+
+    def snapshot(self) -> GestureSnapshot:
+        features = self.features
+        angles = 'euler_angles' in features
+        return GestureSnapshot(Quaternion(array=self.quaternion.elements.copy()),
+                               self.movement_acceleration.copy() if 'motion_acceleration' in features else None,
+                               self.acceleration_derivative.copy() if 'acceleration_derivative' in features else None,
+                               self.movement_velocity.copy() if 'movement_velocity' in features else None,
+                               float(self.skewness) if angles else None,
+                               float(self.tilt) if angles else None,
+                               float(self.roll) if angles else None,
+                               list(self.spherical_coords) if 'spherical_coords' in features else None)
@@ -10,7 +10,9 @@ a = Analysis(
     hookspath=[],
     hooksconfig={},
     runtime_hooks=[],
-    excludes=[],
+    # NOTE: Benchmark-only numpy-quaternion and its optional dependencies, and parts of numpy the bridge never uses
+    excludes=['quaternion', 'scipy', 'numba', 'llvmlite', 'matplotlib', 'pandas', 'IPython', 'pytest',
+              'numpy.f2py', 'numpy.distutils', 'numpy.testing', 'pydoc', 'unittest'],
     noarchive=False,
     optimize=0,
 )
@@ -0,0 +1,89 @@
+#!/usr/bin/python
+
+# Developed by Paulo Chiliguano and KA HO Wong
+# Directed by Dr Roberto Alonso Trillo
+# HKBU Academy of Music
+# 2024
+
+"""Headless Metabow OSC bridge
+
+Runs the bridge engine without a display, driven by ``metabow.toml``.
+Several daemons can run on one host with different configuration files.
+"""
+import argparse
+import asyncio
+import signal
+from bridge_engine import BridgeEngine, load_configuration
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description="Headless Metabow OSC bridge")
+    parser.add_argument('-c', '--config', default="metabow.toml",
+                        help="TOML configuration file (default: metabow.toml)")
+    parser.add_argument('--port', type=int,
+                        help="device UDP port, overrides [bridge] port")
+    parser.add_argument('--mirror-port', type=int,
+                        help="mirror UDP port, overrides [bridge] mirror-port")
+    parser.add_argument('--use-address', action='store_true', default=None,
+                        help="use the BLE address as OSC identifier")
+    parser.add_argument('--scan-time', type=float,
+                        help="seconds to scan before connecting")
+    parser.add_argument('--device', action='append', dest='devices',
+                        help="BLE address to connect to (repeatable)")
+    parser.add_argument('--scan', action='store_true',
+                        help="scan even when known devices could be connected to directly")
+    parser.add_argument('--simulate', type=int, metavar='N',
+                        help="stream from N simulated devices instead of Bluetooth")
+    parser.add_argument('--rate', type=float,
+                        help="samples per second of every simulated device")
+    parser.add_argument('--dropout', type=float, metavar='SECONDS',
+                        help="mean seconds between simulated link drops")
+
+    return parser.parse_args(argv)
+
+
+async def run_daemon(args):
+    configuration_dict = load_configuration(args.config)
+    bridge = configuration_dict['bridge']
+    overrides = {
+        'port': args.port,
+        'mirror-port': args.mirror_port,
+        'use-address': args.use_address,
+        'scan-time': args.scan_time,
+        'devices': args.devices,
+    }
+    bridge.update({k: v for k, v in overrides.items() if v is not None})
+    if args.simulate is not None:
+        configuration_dict['simulation'].update({'enabled': True, 'devices': args.simulate})
+    if args.rate is not None:
+        configuration_dict['simulation']['rate'] = args.rate
+    if args.dropout is not None:
+        configuration_dict['simulation']['dropout'] = args.dropout
+    if args.scan:
+        configuration_dict['connection']['direct'] = False
+    engine = BridgeEngine(configuration_dict)
+
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, lambda: loop.create_task(engine.disconnect()))
+        except NotImplementedError:  # NOTE: Windows event loops
+            pass
+
+    devices = await engine.run(bridge['devices'], bridge['scan-time'])
+    if not devices:
+        print(f"No '{engine.device_name}' device found")
+    for stage, counters in engine.pipeline_stats().items():
+        print(stage, counters)
+    print('log', engine.log_stats())
+    print('metrics', engine.metrics)
+    for destination, counters in engine.osc_stats().items():
+        print(destination, counters)
+
+
+def main(argv=None):
+    asyncio.run(run_daemon(parse_arguments(argv)))
+
+
+if __name__ == '__main__':
+    main()
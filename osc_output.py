@@ -0,0 +1,442 @@
+# Developed by Paulo Chiliguano and KA HO Wong
+# Directed by Dr Roberto Alonso Trillo
+# HKBU Academy of Music
+# 2024
+
+"""OSC output
+
+Addresses and payloads of the OSC streams computed for every sample, and
+an encoder that packs them without going through python-osc builders.
+"""
+import asyncio
+import socket
+import struct
+import threading
+from fnmatch import fnmatchcase
+from typing import Iterator, List, Tuple
+from features import FEATURES
+
+
+NTP_DELTA = 2208988800  # NOTE: Seconds between the NTP (1900) and POSIX (1970) epochs
+BUNDLE_HEADER = b"#bundle\x00"
+TIMETAG = struct.Struct('>Q')
+ELEMENT_SIZE = struct.Struct('>i')
+BRIDGE_STREAMS = "bridge/"  # NOTE: Prefix of the bridge's own streams, e.g. its metrics, which are opt-in
+
+
+def sample_values(model, features=None) -> Iterator[Tuple[str, List[float]]]:
+    """Yields the ``(stream, values)`` pairs derived from one sample
+
+    Parameters
+    ----------
+    model : GestureModel or GestureSnapshot
+        Fusion outputs of the sample
+    features : collection of str, optional
+        Names from features.FEATURES to output, all by default; the model
+        must have computed them
+    """
+    enabled = FEATURES if features is None else features
+    if 'quaternion' in enabled:
+        yield "quaternion", model.quaternion.elements.tolist()
+    if 'spherical_coords' in enabled:
+        yield "spherical_coords", list(model.spherical_coords)
+    if 'motion_acceleration' in enabled:
+        yield "motion_acceleration/sensor_frame", model.movement_acceleration.tolist()
+    if 'acceleration_derivative' in enabled:
+        yield "motion_acceleration/sensor_derivative", model.acceleration_derivative.tolist()
+    if 'movement_velocity' in enabled:
+        yield "motion_acceleration/sensor_velocity", model.movement_velocity.tolist()
+    if 'euler_angles' in enabled:
+        yield "motion_acceleration/skewness", [model.skewness]
+        yield "motion_acceleration/tilt", [model.tilt]
+        yield "motion_acceleration/roll", [model.roll]
+
+
+def sample_messages(device_number, model) -> Iterator[Tuple[str, List[float] | float]]:
+    """Yields the ``(address, value)`` pairs derived from one sample
+
+    Parameters
+    ----------
+    device_number : int or str
+        OSC identifier of the device
+    model : GestureModel or GestureSnapshot
+        Fusion outputs of the sample
+    """
+    for stream, values in sample_values(model):
+        yield f"/{device_number}/{stream}", values if len(values) > 1 else values[0]
+
+
+def build_message(address: str, value):
+    from pythonosc import osc_message_builder  # NOTE: Only metrics and reference paths use python-osc
+    builder = osc_message_builder.OscMessageBuilder(address=address)
+    if isinstance(value, list):
+        for i in value:
+            builder.add_arg(i)
+    else:
+        builder.add_arg(value)
+
+    return builder.build()
+
+
+def build_sample_bundle(device_number, sample_time: float, fusion_data, model):
+    """Builds one timestamped OSC bundle holding every stream of a sample
+
+    Parameters
+    ----------
+    device_number : int or str
+        OSC identifier of the device
+    sample_time : float
+        POSIX time of the sample, used as the bundle time tag
+    fusion_data : list
+        Decoded packet, sent as ``/raw``
+    model : GestureModel or GestureSnapshot
+        Fusion outputs of the sample
+
+    Returns
+    -------
+    pythonosc.osc_bundle.OscBundle
+    """
+    from pythonosc import osc_bundle_builder
+    builder = osc_bundle_builder.OscBundleBuilder(sample_time)
+    builder.add_content(build_message(f"/{device_number}/raw", list(fusion_data)))
+    for address, value in sample_messages(device_number, model):
+        builder.add_content(build_message(address, value))
+
+    return builder.build()
+
+
+def _osc_string(text: str) -> bytes:
+    data = text.encode() + b"\x00"
+    return data + b"\x00" * (-len(data) % 4)
+
+
+def ntp_timetag(seconds: float) -> int:
+    """POSIX seconds as a 64-bit OSC/NTP time tag"""
+    return int((seconds + NTP_DELTA) * 2.0 ** 32)
+
+
+class MessageTemplate:
+    """Precompiled OSC message with a fixed address and float32 arguments
+
+    The padded address and type tag are encoded once; encoding a message only
+    packs the floats into a reusable buffer.
+    """
+    def __init__(self, address: str, count: int):
+        self.address = address
+        self.count = count
+        self.prefix = _osc_string(address) + _osc_string("," + "f" * count)
+        self.payload = struct.Struct(f">{count}f")
+        self.size = len(self.prefix) + self.payload.size
+        self.buffer = bytearray(self.prefix) + bytearray(self.payload.size)
+
+    def encode(self, values) -> bytearray:
+        """Encodes a message; the returned buffer is reused by the next call"""
+        self.payload.pack_into(self.buffer, len(self.prefix), *values)
+        return self.buffer
+
+
+class BundleTemplate:
+    """Precompiled OSC bundle holding one message per stream of a sample"""
+    def __init__(self, templates: List[MessageTemplate]):
+        self.templates = templates
+        self.buffer = bytearray(BUNDLE_HEADER) + bytearray(TIMETAG.size)
+        self.offsets = []
+        for template in templates:
+            self.buffer += ELEMENT_SIZE.pack(template.size)
+            self.offsets.append(len(self.buffer) + len(template.prefix))
+            self.buffer += template.prefix + bytearray(template.payload.size)
+
+    def encode(self, seconds: float, streams) -> bytearray:
+        """Encodes a bundle; the returned buffer is reused by the next call"""
+        buffer = self.buffer
+        TIMETAG.pack_into(buffer, len(BUNDLE_HEADER), ntp_timetag(seconds))
+        for template, offset, (_, values) in zip(self.templates, self.offsets, streams):
+            template.payload.pack_into(buffer, offset, *values)
+        return buffer
+
+
+class OscEncoder:
+    """Encodes OSC messages and bundles from cached per-device templates
+
+    Templates are keyed by device identifier, stream and argument count, so
+    address strings are only formatted the first time a stream is sent.
+    """
+    def __init__(self):
+        self._messages = {}
+        self._bundles = {}
+
+    def template(self, device_number, stream: str, count: int) -> MessageTemplate:
+        key = (device_number, stream, count)
+        template = self._messages.get(key)
+        if template is None:
+            template = self._messages[key] = MessageTemplate(f"/{device_number}/{stream}", count)
+        return template
+
+    def message(self, device_number, stream: str, values) -> bytearray:
+        return self.template(device_number, stream, len(values)).encode(values)
+
+    def bundle(self, device_number, seconds: float, streams: List[Tuple[str, List[float]]]) -> bytearray:
+        """Encodes ``(stream, values)`` pairs as one bundle time-tagged with ``seconds``"""
+        key = (device_number, *[(stream, len(values)) for stream, values in streams])
+        template = self._bundles.get(key)
+        if template is None:
+            template = self._bundles[key] = BundleTemplate(
+                [self.template(device_number, stream, len(values)) for stream, values in streams])
+        return template.encode(seconds, streams)
+
+
+class StreamPolicy:
+    """Output policy of one stream
+
+    Parameters
+    ----------
+    max_rate : float
+        Maximum messages per second per device, 0 for the full sample rate
+    deadband : float
+        Only send when a value changed by more than this since the last send
+    keyframe : float
+        Send at least every ``keyframe`` seconds regardless of the deadband,
+        0 to disable
+    """
+    def __init__(self, max_rate: float = 0.0, deadband: float = 0.0, keyframe: float = 0.0):
+        self.min_interval = 1.0 / max_rate if max_rate else 0.0
+        self.deadband = deadband
+        self.keyframe = keyframe
+
+    def should_send(self, state: list, seconds: float, values) -> bool:
+        """Decides whether to send and updates ``state`` ([time, values])"""
+        last_time, last_values = state
+        if last_values is not None:
+            elapsed = seconds - last_time
+            if not (self.keyframe and elapsed >= self.keyframe):
+                if elapsed < self.min_interval:
+                    return False
+                if self.deadband and len(values) == len(last_values) and \
+                        all(abs(a - b) <= self.deadband for a, b in zip(values, last_values)):
+                    return False
+        state[0] = seconds
+        state[1] = list(values)
+
+        return True
+
+
+class OutputPolicies:
+    """Per-stream output policies from the ``[streams]`` configuration tables
+
+    Tables are keyed by stream name or fnmatch pattern, e.g.
+    ``[streams."motion_acceleration/*"]``, with ``max-rate``, ``deadband``
+    and ``keyframe`` entries. Streams without a table are always sent.
+    """
+    def __init__(self, tables: dict | None = None):
+        self.policies = {pattern: StreamPolicy(table.get('max-rate', 0.0),
+                                               table.get('deadband', 0.0),
+                                               table.get('keyframe', 0.0))
+                         for pattern, table in (tables or {}).items()}
+        self.suppressed = 0
+        self._resolved = {}
+        self._states = {}
+
+    def __bool__(self) -> bool:
+        return bool(self.policies)
+
+    def policy(self, stream: str) -> StreamPolicy | None:
+        if stream not in self._resolved:
+            policy = self.policies.get(stream)
+            if policy is None:
+                policy = next((v for k, v in self.policies.items() if fnmatchcase(stream, k)), None)
+            self._resolved[stream] = policy
+        return self._resolved[stream]
+
+    def filter(self, device_number, seconds: float, streams: List[Tuple[str, List[float]]]):
+        """Keeps the ``(stream, values)`` pairs that are due for sending"""
+        selected = []
+        for stream, values in streams:
+            policy = self.policy(stream)
+            if policy is not None:
+                state = self._states.get((device_number, stream))
+                if state is None:
+                    state = self._states[(device_number, stream)] = [0.0, None]
+                if not policy.should_send(state, seconds, values):
+                    self.suppressed += 1
+                    continue
+            selected.append((stream, values))
+
+        return selected
+
+
+class Destination:
+    """UDP receiver of a subset of the OSC streams
+
+    Parameters
+    ----------
+    host : str
+        Receiver host name or address
+    port : int
+        Receiver UDP port
+    streams : list of str
+        Stream names or fnmatch patterns, e.g. ``"motion_acceleration/*"``
+    bundle : bool
+        Send each sample as one bundle instead of one datagram per stream
+    """
+    def __init__(self, host: str, port: int, streams=("*",), bundle: bool = False):
+        self.host = host
+        self.port = port
+        self.streams = tuple(streams)
+        self.bundle = bundle
+        self.address = (host, port)
+        self.family = socket.AF_INET
+        self.sent = 0
+        self.bytes_sent = 0
+        self.errors = 0
+        self._wants = {}
+
+    @property
+    def name(self) -> str:
+        return f"{self.host}:{self.port}"
+
+    def wants(self, stream: str) -> bool:
+        """Whether ``stream`` matches the streams of the destination
+
+        Bridge streams (``bridge/...``) only match patterns that name them,
+        so that ``"*"`` never sends telemetry to a sound engine.
+        """
+        wanted = self._wants.get(stream)
+        if wanted is None:
+            patterns = self.streams
+            if stream.startswith(BRIDGE_STREAMS):
+                patterns = [i for i in patterns if i.startswith(BRIDGE_STREAMS)]
+            wanted = self._wants[stream] = any(fnmatchcase(stream, i) for i in patterns)
+        return wanted
+
+    async def resolve(self):
+        """Resolves the host once, so sends never wait on name lookups
+
+        The lookup runs in the loop's executor, so a slow DNS server does not
+        stall the event loop. IPv4 addresses are preferred, IPv6 hosts are
+        sent to through an IPv6 endpoint.
+
+        Raises
+        ------
+        OSError
+            When the host cannot be resolved (socket.gaierror)
+        """
+        infos = await asyncio.get_running_loop().getaddrinfo(self.host, self.port, family=socket.AF_UNSPEC,
+                                                              type=socket.SOCK_DGRAM)
+        family, _, _, _, address = next((i for i in infos if i[0] == socket.AF_INET), infos[0])
+        self.family, self.address = family, address
+
+
+def destinations_from_configuration(configuration_dict: dict, port0: int, port1: int) -> List[Destination]:
+    """Destinations of the ``[[destinations]]`` tables, or the device and mirror ports"""
+    bundle = configuration_dict.get('osc', {}).get('bundle', False)
+    tables = configuration_dict.get('destinations', [])
+    if not tables:
+        tables = [{'port': port} for port in dict.fromkeys((port0, port1))]
+
+    return [Destination(i.get('host', "127.0.0.1"), i['port'], i.get('streams', ["*"]), i.get('bundle', bundle))
+            for i in tables]
+
+
+class OscFanout(asyncio.DatagramProtocol):
+    """Sends OSC to every destination through one asyncio datagram endpoint
+
+    Encoding happens in the calling thread; the datagrams of a sample are
+    handed to the event loop in one batch, and the non-blocking transport
+    never stalls the loop. When the transport buffer exceeds
+    ``high_water`` bytes, datagrams are dropped and counted as errors.
+    IPv6 destinations get a second endpoint.
+    """
+    def __init__(self, destinations: List[Destination], encoder: OscEncoder | None = None,
+                 high_water: int = 1 << 20):
+        self.destinations = destinations
+        self.encoder = encoder or OscEncoder()
+        self.high_water = high_water
+        self.transports = {}  # NOTE: One endpoint per address family of the destinations
+        self.loop = None
+        self.unattributed_errors = 0
+        self._loop_thread = None
+        self._groups = {}
+
+    async def open(self):
+        self.loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        await asyncio.gather(*(destination.resolve() for destination in self.destinations))
+        for family in sorted({destination.family for destination in self.destinations}):
+            local_addr = ("::", 0) if family == socket.AF_INET6 else ("0.0.0.0", 0)
+            self.transports[family], _ = await self.loop.create_datagram_endpoint(
+                lambda: self, local_addr=local_addr, family=family)
+
+    def close(self):
+        transports, self.transports = self.transports, {}
+        for transport in transports.values():
+            transport.close()
+
+    def error_received(self, exc):
+        self.unattributed_errors += 1  # NOTE: ICMP errors of an unconnected socket carry no address
+
+    def _group(self, streams) -> List[Tuple[bool, List[int], List[Destination]]]:
+        """Destinations grouped by bundle mode and selected streams"""
+        key = tuple(stream for stream, _ in streams)
+        groups = self._groups.get(key)
+        if groups is None:
+            grouped = {}
+            for destination in self.destinations:
+                selection = tuple(i for i, stream in enumerate(key) if destination.wants(stream))
+                if selection:
+                    grouped.setdefault((destination.bundle, selection), []).append(destination)
+            groups = self._groups[key] = [(bundle, list(selection), members)
+                                          for (bundle, selection), members in grouped.items()]
+        return groups
+
+    def publish(self, device_number, seconds: float, streams: List[Tuple[str, List[float]]]):
+        """Encodes and sends the ``(stream, values)`` pairs of one sample"""
+        batch = []
+        for bundle, selection, members in self._group(streams):
+            selected = [streams[i] for i in selection]
+            if bundle:
+                batch.append((bytes(self.encoder.bundle(device_number, seconds, selected)), members))
+            else:
+                for stream, values in selected:
+                    batch.append((bytes(self.encoder.message(device_number, stream, values)), members))
+        self.send_batch(batch)
+
+    def send(self, dgram, destinations: List[Destination] | None = None):
+        """Sends one datagram to ``destinations``, every destination when None"""
+        if destinations is None:
+            destinations = self.destinations
+        if destinations:
+            self.send_batch([(bytes(dgram), destinations)])
+
+    def send_batch(self, batch):
+        if threading.get_ident() == self._loop_thread:
+            self._send_batch(batch)
+        elif self.loop is not None:
+            self.loop.call_soon_threadsafe(self._send_batch, batch)
+
+    def _send_batch(self, batch):
+        transports = self.transports
+        if not transports:
+            return
+        overloaded = {family: transport.get_write_buffer_size() > self.high_water
+                      for family, transport in transports.items()}
+        for dgram, destinations in batch:
+            for destination in destinations:
+                if overloaded[destination.family]:
+                    destination.errors += 1
+                    continue
+                try:
+                    transports[destination.family].sendto(dgram, destination.address)
+                except OSError:
+                    destination.errors += 1
+                    continue
+                destination.sent += 1
+                destination.bytes_sent += len(dgram)
+
+    def stats(self) -> dict:
+        stats = {destination.name: {'sent': destination.sent,
+                                    'bytes': destination.bytes_sent,
+                                    'errors': destination.errors}
+                 for destination in self.destinations}
+        stats['unattributed_errors'] = self.unattributed_errors
+
+        return stats
@@ -0,0 +1,318 @@
+# Developed by Paulo Chiliguano and KA HO Wong
+# Directed by Dr Roberto Alonso Trillo
+# HKBU Academy of Music
+# 2024
+
+"""Worker pipeline
+
+Long-lived stages connected by bounded queues. Each stage runs in its own
+thread, so BLE callbacks only enqueue packets and return.
+"""
+import logging
+import threading
+from collections import OrderedDict, deque
+from time import monotonic
+from typing import Any, Callable, Hashable, List, Tuple
+from telemetry import LatencyHistogram
+
+
+POLICIES = ('block', 'drop-oldest', 'latest')
+ERROR_LOG_INTERVAL = 10.0  # NOTE: Seconds between logged errors of a stage, the others are only counted
+
+logger = logging.getLogger(__name__)
+
+
+class QueueClosed(Exception):
+    """Raised by StageQueue.get once the queue is closed and drained"""
+
+
+class StageQueue:
+    """Bounded queue with an overload policy
+
+    Parameters
+    ----------
+    maxsize : int
+        Maximum number of queued items
+    policy : str
+        'block' waits for room, 'drop-oldest' discards the oldest item and
+        'latest' keeps only the newest item per key (latest-value-wins)
+    """
+    def __init__(self, maxsize: int = 256, policy: str = 'block'):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown overload policy '{policy}', expected one of {POLICIES}")
+        self.maxsize = maxsize
+        self.policy = policy
+        self._items = OrderedDict() if policy == 'latest' else deque()
+        self._condition = threading.Condition()
+        self._closed = False
+        self.put_count = 0
+        self.drop_count = 0
+        self.max_depth = 0
+
+    @property
+    def depth(self) -> int:
+        return len(self._items)
+
+    def put(self, key: Hashable, item: Any):
+        with self._condition:
+            if self._closed:
+                return
+            if self.policy == 'latest':
+                if key in self._items:
+                    self.drop_count += 1
+                elif len(self._items) >= self.maxsize:
+                    self._items.popitem(last=False)
+                    self.drop_count += 1
+                self._items[key] = item
+            else:
+                if len(self._items) >= self.maxsize:
+                    if self.policy == 'block':
+                        while len(self._items) >= self.maxsize and not self._closed:
+                            self._condition.wait()
+                    else:
+                        self._items.popleft()
+                        self.drop_count += 1
+                self._items.append((key, item))
+            self.put_count += 1
+            self.max_depth = max(self.max_depth, len(self._items))
+            self._condition.notify_all()
+
+    def get(self) -> Tuple[Hashable, Any]:
+        with self._condition:
+            while not self._items:
+                if self._closed:
+                    raise QueueClosed
+                self._condition.wait()
+            if self.policy == 'latest':
+                entry = self._items.popitem(last=False)
+            else:
+                entry = self._items.popleft()
+            self._condition.notify_all()
+
+            return entry
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+
+class Batch(list):
+    """Stage result whose elements are forwarded to the next stage one by one"""
+
+
+class Stage(threading.Thread):
+    """Pipeline stage applying ``function(key, item)`` to every queued item
+
+    The returned value is forwarded to the next stage unless it is None.
+    Items whose function raises are dropped, counted in ``errors`` and
+    logged at most once every ERROR_LOG_INTERVAL seconds.
+    """
+    def __init__(self, name: str, function: Callable, inbox: StageQueue, outbox: StageQueue | None = None,
+                 close_outbox: bool = True):
+        super().__init__(name=f"pipeline-{name}", daemon=True)
+        self.stage_name = name
+        self.function = function
+        self.inbox = inbox
+        self.outbox = outbox
+        self.close_outbox = close_outbox
+        self.processed = 0
+        self.errors = 0
+        self.busy_time = 0.0
+        self.timing = LatencyHistogram()
+        self._error_logged = None
+        self._errors_logged = 0
+
+    def run(self):
+        while True:
+            try:
+                key, item = self.inbox.get()
+            except QueueClosed:
+                break
+            start = monotonic()
+            try:
+                result = self.function(key, item)
+            except Exception:
+                self.errors += 1
+                self._log_error(key)
+                continue
+            finally:
+                elapsed = monotonic() - start
+                self.busy_time += elapsed
+                self.timing.record(elapsed)
+            self.processed += 1
+            if result is None or self.outbox is None:
+                continue
+            if isinstance(result, Batch):
+                for element in result:
+                    self.outbox.put(key, element)
+            else:
+                self.outbox.put(key, result)
+
+        if self.outbox is not None and self.close_outbox:
+            self.outbox.close()
+
+    def _log_error(self, key: Hashable):
+        """Logs the exception being handled, unless one was logged recently"""
+        now = monotonic()
+        if self._error_logged is not None and now - self._error_logged < ERROR_LOG_INTERVAL:
+            return
+        logger.exception("Stage %s failed on %r (%d errors not logged since the previous one)",
+                         self.stage_name, key, self.errors - self._errors_logged - 1)
+        self._error_logged = now
+        self._errors_logged = self.errors
+
+
+class PartitionedStage:
+    """Stage running one worker thread per key, e.g. one per device
+
+    It behaves as the inbox of the stage: the upstream stage puts items into
+    it and each key is routed to its own queue and worker, so a slow device
+    never delays the others and per-key state is only touched by one thread.
+    """
+    def __init__(self, name: str, function: Callable, maxsize: int = 256, policy: str = 'block',
+                 outbox: StageQueue | None = None):
+        self.stage_name = name
+        self.function = function
+        self.maxsize = maxsize
+        self.policy = policy
+        self.outbox = outbox
+        self.workers = {}
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def _worker(self, key: Hashable) -> Stage:
+        worker = self.workers.get(key)
+        if worker is None:
+            with self._lock:
+                worker = self.workers.get(key)
+                if worker is None:
+                    worker = Stage(f"{self.stage_name}-{key}", self.function,
+                                   StageQueue(self.maxsize, self.policy), self.outbox, close_outbox=False)
+                    worker.start()
+                    self.workers[key] = worker
+        return worker
+
+    def put(self, key: Hashable, item: Any):
+        if self._closed:
+            return
+        self._worker(key).inbox.put(key, item)
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            workers = list(self.workers.values())
+        for worker in workers:
+            worker.inbox.close()
+        for worker in workers:
+            worker.join()
+        if self.outbox is not None:
+            self.outbox.close()
+
+    def start(self):
+        pass
+
+    def is_alive(self) -> bool:
+        return any(worker.is_alive() for worker in self.workers.values())
+
+    def join(self, timeout: float | None = None):
+        for worker in list(self.workers.values()):
+            worker.join(timeout)
+
+    def _total(self, attribute: str, queue: bool = False):
+        with self._lock:
+            workers = list(self.workers.values())
+        return sum(getattr(worker.inbox if queue else worker, attribute) for worker in workers)
+
+    depth = property(lambda self: self._total('depth', queue=True))
+    max_depth = property(lambda self: self._total('max_depth', queue=True))
+    put_count = property(lambda self: self._total('put_count', queue=True))
+    drop_count = property(lambda self: self._total('drop_count', queue=True))
+    processed = property(lambda self: self._total('processed'))
+    errors = property(lambda self: self._total('errors'))
+    busy_time = property(lambda self: self._total('busy_time'))
+
+    @property
+    def timing(self) -> LatencyHistogram:
+        with self._lock:
+            workers = list(self.workers.values())
+        return LatencyHistogram.merge(worker.timing for worker in workers)
+
+
+class Pipeline:
+    """Chain of stages, e.g. decode -> fuse -> publish -> log
+
+    Parameters
+    ----------
+    stages : list
+        ``(name, function)`` pairs in processing order
+    maxsize : int
+        Capacity of every inter-stage queue
+    policy : str
+        Overload policy of the queues, see StageQueue
+    policies : dict
+        Per-stage policy overrides keyed by stage name
+    partitioned : iterable of str
+        Names of the stages that run one worker per key
+    """
+    def __init__(self, stages: List[Tuple[str, Callable]], maxsize: int = 256,
+                 policy: str = 'block', policies: dict | None = None, partitioned=()):
+        policies = policies or {}
+        self.queues = [None] * len(stages)
+        self.stages = [None] * len(stages)
+        for i in reversed(range(len(stages))):
+            name, function = stages[i]
+            stage_policy = policies.get(name, policy)
+            outbox = self.queues[i + 1] if i + 1 < len(stages) else None
+            if name in partitioned:
+                stage = PartitionedStage(name, function, maxsize, stage_policy, outbox)
+                self.queues[i] = stage
+            else:
+                self.queues[i] = StageQueue(maxsize, stage_policy)
+                stage = Stage(name, function, self.queues[i], outbox)
+            self.stages[i] = stage
+        self._index = {stage.stage_name: i for i, stage in enumerate(self.stages)}
+
+    def start(self):
+        for stage in self.stages:
+            stage.start()
+
+    def submit(self, key: Hashable, item: Any, stage: str | None = None):
+        """Enqueues an item at the first stage, or at the named stage"""
+        index = 0 if stage is None else self._index[stage]
+        self.queues[index].put(key, item)
+
+    def stop(self, timeout: float | None = 5.0):
+        """Closes the pipeline; queued items are drained before the stages exit"""
+        self.queues[0].close()
+        for stage in self.stages:
+            if stage.is_alive():
+                stage.join(timeout)
+
+    def timings(self) -> dict:
+        """Processing time histogram of every stage"""
+        return {stage.stage_name: stage.timing for stage in self.stages}
+
+    def stats(self) -> dict:
+        stats = {
+            stage.stage_name: {
+                'depth': queue.depth,
+                'max_depth': queue.max_depth,
+                'enqueued': queue.put_count,
+                'dropped': queue.drop_count,
+                'processed': stage.processed,
+                'errors': stage.errors,
+                'busy_time': stage.busy_time,
+            }
+            for stage, queue in zip(self.stages, self.queues)
+        }
+        for stage in self.stages:
+            if isinstance(stage, PartitionedStage):
+                stats[stage.stage_name]['partitions'] = {
+                    key: {'depth': worker.inbox.depth,
+                          'dropped': worker.inbox.drop_count,
+                          'processed': worker.processed}
+                    for key, worker in list(stage.workers.items())
+                }
+
+        return stats
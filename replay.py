@@ -0,0 +1,118 @@
+#!/usr/bin/python
+
+# Developed by Paulo Chiliguano and KA HO Wong
+# Directed by Dr Roberto Alonso Trillo
+# HKBU Academy of Music
+# 2024
+
+"""Timed replay of raw BLE captures
+
+Feeds a capture recorded with ``[capture] enabled = true`` back through the
+bridge engine notification handlers, with the original timing, N times
+faster, or as fast as possible, and reports the end-to-end throughput.
+The packets are decoded with the device protocol recorded in the capture.
+"""
+import argparse
+import asyncio
+from time import perf_counter
+from bridge_engine import BridgeEngine, load_configuration
+from capture import NORDIC, read_capture, read_header
+
+
+async def replay(engine: BridgeEngine, path, speed: float = 1.0) -> dict:
+    """Replays a capture through ``engine``
+
+    Parameters
+    ----------
+    engine : BridgeEngine
+        Engine whose handlers receive the notifications
+    path : str or Path
+        Capture file
+    speed : float
+        Time scale: 1.0 keeps the original timing, 0 replays as fast as possible
+
+    Returns
+    -------
+    dict
+        Notification count, elapsed wall time and throughput
+
+    Raises
+    ------
+    ValueError
+        When the capture was recorded with another ``device.protocol`` than
+        the one of ``engine``, whose packet layout would misread it
+    """
+    header = read_header(path)
+    protocol = header.get('device', {}).get('protocol')
+    if protocol is not None and protocol != engine.protocol:
+        raise ValueError(f"{path} was recorded with protocol '{protocol}', the engine decodes '{engine.protocol}'")
+    notifications = list(read_capture(path))
+    devices = header.get('devices') or {str(i.device_number): str(i.device_number) for i in notifications}
+    identifiers = {str(i.device_number): i.device_number for i in notifications}
+    await engine.start_session([(identifiers.get(k, k), v) for k, v in devices.items()])
+
+    loop = asyncio.get_running_loop()
+    start = perf_counter()
+    origin = loop.time()
+    for count, notification in enumerate(notifications):
+        if speed > 0:
+            delay = origin + notification.arrival / speed - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        elif count % 64 == 0:
+            await asyncio.sleep(0)  # NOTE: Lets the event loop flush queued OSC sends
+        if notification.handler == NORDIC:
+            engine.notification_handler_for_nordic(notification.device_number, 0, notification.data)
+        else:
+            engine.notification_handler(notification.device_number, 0, notification.data)
+    await engine.stop_session()
+    elapsed = perf_counter() - start
+
+    return {
+        'notifications': len(notifications),
+        'elapsed': elapsed,
+        'rate': len(notifications) / elapsed if elapsed > 0 else 0.0,
+        'recorded_duration': notifications[-1].arrival if notifications else 0.0,
+    }
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description="Replay a raw BLE capture through the bridge")
+    parser.add_argument('capture', help="capture file (.mbcap)")
+    parser.add_argument('-c', '--config', default="metabow.toml",
+                        help="TOML configuration file (default: metabow.toml)")
+    timing = parser.add_mutually_exclusive_group()
+    timing.add_argument('--speed', type=float, default=1.0,
+                        help="time scale, e.g. 4 replays four times faster (default: 1)")
+    timing.add_argument('--fast', action='store_true', help="replay as fast as possible")
+
+    return parser.parse_args(argv)
+
+
+async def run_replay(args):
+    configuration_dict = load_configuration(args.config)
+    # NOTE: The packets are decoded as recorded, whatever device the configuration describes
+    recorded = read_header(args.capture).get('device', {})
+    for key in ('protocol', 'timestamp-tick'):
+        if key in recorded:
+            configuration_dict['device'][key] = recorded[key]
+    configuration_dict['capture']['enabled'] = False
+    # NOTE: Offline, so the inbox can wait for the stages and every notification is processed
+    configuration_dict['pipeline']['inbox-policy'] = "block"
+    engine = BridgeEngine(configuration_dict)
+    result = await replay(engine, args.capture, 0.0 if args.fast else args.speed)
+    print(f"{result['notifications']} notifications in {result['elapsed']:.3f} s "
+          f"({result['rate']:.0f}/s, recorded over {result['recorded_duration']:.3f} s)")
+    for stage, counters in engine.pipeline_stats().items():
+        print(stage, counters)
+    print('log', engine.log_stats())
+    for destination, counters in engine.osc_stats().items():
+        print(destination, counters)
+
+
+def main(argv=None):
+    asyncio.run(run_replay(parse_arguments(argv)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+#!/usr/bin/python
+
+# Developed by Paulo Chiliguano and KA HO Wong
+# Directed by Dr Roberto Alonso Trillo
+# HKBU Academy of Music
+# 2024
+
+"""Offline reprocessing of recorded sessions
+
+Streams the raw accl/gyro/magn columns of a session log through
+GestureModel, integrating on the recorded timestamps (smoothed as in the
+bridge, see sample_clock.py) rather than in real time, and writes a log
+with the same columns. Use it to try other fusion gains without playing
+the performance again.
+"""
+import argparse
+import csv
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Iterable, List
+from gesture_model import GestureModel
+from sample_clock import SampleClock
+from session_log import CSV_HEADER, SENSOR_COLUMNS, TimestampParser, log_row
+
+
+REPROCESSED_SUFFIX = "_reprocessed"
+WRITE_CHUNK = 4096
+
+
+def reprocess_file(path: str | Path, output_path: str | Path, gains: dict | None = None,
+                   fast: bool = True) -> int:
+    """Recomputes the fusion columns of one session log
+
+    Parameters
+    ----------
+    path : str or Path
+        CSV session log
+    output_path : str or Path
+        Destination CSV file
+    gains : dict, optional
+        Arguments of GestureModel.configure (k_P, k_a, galpha, ...)
+    fast : bool
+        Use the FastFusionFilter kernel
+
+    Returns
+    -------
+    int
+        Number of samples processed
+    """
+    parse_timestamp = TimestampParser()
+    models = {}
+    clocks = {}
+    rows = []
+    count = 0
+    with open(path, newline='', encoding='UTF8') as source, \
+            open(output_path, 'w', newline='', encoding='UTF8') as destination:
+        reader = csv.reader(source)
+        writer = csv.writer(destination)
+        header = next(reader, None)
+        if header != CSV_HEADER:
+            raise ValueError(f"{path} is not a session log")
+        writer.writerow(CSV_HEADER)
+        for row in reader:
+            device_number, timestamp = row[0], row[1]
+            sensor_data = row[SENSOR_COLUMNS]
+            values = [float(i) for i in sensor_data]
+            model = models.get(device_number)
+            if model is None:
+                model = models[device_number] = GestureModel(fast, gains)
+                clocks[device_number] = SampleClock()
+            sample_time = clocks[device_number](host_time=parse_timestamp(timestamp))
+            model.tick(values[0:3], values[3:6], values[6:9], timestamp=sample_time)
+            rows.append(log_row(timestamp, device_number, sensor_data, model))
+            if len(rows) >= WRITE_CHUNK:
+                writer.writerows(rows)
+                count += len(rows)
+                rows.clear()
+        writer.writerows(rows)
+        count += len(rows)
+
+    return count
+
+
+def session_files(paths: Iterable[str | Path]) -> List[Path]:
+    """Expands directories into the session logs they contain"""
+    files = []
+    for path in map(Path, paths):
+        if path.is_dir():
+            files.extend(sorted(i for i in path.glob("*.csv") if not i.stem.endswith(REPROCESSED_SUFFIX)))
+        else:
+            files.append(path)
+
+    return files
+
+
+def output_file(path: Path, output_dir: str | Path | None) -> Path:
+    directory = path.parent if output_dir is None else Path(output_dir)
+    return directory / f"{path.stem}{REPROCESSED_SUFFIX}{path.suffix}"
+
+
+def reprocess_paths(paths: Iterable[str | Path], output_dir: str | Path | None = None,
+                    gains: dict | None = None, fast: bool = True, workers: int | None = None) -> dict:
+    """Reprocesses files and directories of sessions, in parallel across files
+
+    Returns
+    -------
+    dict
+        Number of samples processed per output file
+    """
+    files = session_files(paths)
+    if output_dir is not None:
+        Path(output_dir).mkdir(parents=True, exist_ok=True)
+    outputs = [output_file(i, output_dir) for i in files]
+    if len(files) <= 1 or workers == 1:
+        counts = [reprocess_file(i, o, gains, fast) for i, o in zip(files, outputs)]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            counts = list(executor.map(reprocess_file, files, outputs,
+                                       [gains] * len(files), [fast] * len(files)))
+
+    return dict(zip(outputs, counts))
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description="Recompute fusion outputs of recorded sessions")
+    parser.add_argument('paths', nargs='+', help="session logs or directories of session logs")
+    parser.add_argument('-o', '--output-dir', help="destination directory (default: next to each log)")
+    parser.add_argument('-j', '--workers', type=int, help="worker processes (default: one per CPU)")
+    parser.add_argument('--reference', action='store_true',
+                        help="use the reference FusionFilter instead of the fast kernel")
+    parser.add_argument('--k-I', type=float, dest='k_I')
+    parser.add_argument('--k-P', type=float, dest='k_P')
+    parser.add_argument('--k-a', type=float, dest='k_a')
+    parser.add_argument('--k-m', type=float, dest='k_m')
+    parser.add_argument('--galpha', type=float)
+    parser.add_argument('--static-threshold', type=float)
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_arguments(argv)
+    gains = {'k_I': args.k_I, 'k_P': args.k_P, 'k_a': args.k_a, 'k_m': args.k_m,
+             'galpha': args.galpha, 'static_threshold': args.static_threshold}
+    counts = reprocess_paths(args.paths, args.output_dir, gains, not args.reference, args.workers)
+    for path, count in counts.items():
+        print(f"{path}: {count} samples")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+# Developed by Paulo Chiliguano and KA HO Wong
+# Directed by Dr Roberto Alonso Trillo
+# HKBU Academy of Music
+# 2024
+
+"""Sample clock
+
+Integration times for the fusion filter. BLE stacks deliver notifications
+in bursts, so host arrival times alternate between dt ~ 0 and one large
+gap. The clock follows the device counter when the packets carry one (the
+SensorTile uint16 timestamp) and the host arrival time otherwise, through
+an alpha-beta tracker that smooths both bursts and counter quantisation
+while staying locked to the source on average.
+
+Sample times are also mapped to POSIX time, e.g. for OSC bundle time tags,
+through an epoch that follows the host arrival times slowly enough to
+ignore BLE latency jitter while tracking the drift of the device clock.
+"""
+
+
+WARMUP_SAMPLES = 8
+EPOCH_GAIN = 0.001  # NOTE: Per sample, about ten seconds of averaging at 100 Hz
+
+
+class SampleClock:
+    """Smoothed, monotonic sample times of one device
+
+    Parameters
+    ----------
+    tick : float
+        Seconds per device counter tick, 0 to always use host time
+    bits : int
+        Width of the device counter, which wraps around
+    alpha : float
+        Tracking gain of the time estimate, smaller is smoother
+    max_gap : float
+        Error in seconds beyond which the clock resynchronises (dropouts,
+        board resets); the sample after a resync is one period later, so
+        the filter never integrates over the gap
+    """
+    def __init__(self, tick: float = 0.0, bits: int = 16, alpha: float = 0.125, max_gap: float = 0.5):
+        self.tick = tick
+        self.modulus = 1 << bits
+        self.alpha = alpha
+        self.beta = alpha * alpha / (2.0 - alpha)  # NOTE: Critically damped alpha-beta tracker
+        self.max_gap = max_gap
+        self.period = 0.0
+        self.resyncs = 0
+        self.epoch = None  # NOTE: POSIX time minus sample time, known once a host time was given
+        self._ticks = None
+        self._source = 0.0
+        self._first = 0.0
+        self._estimate = 0.0
+        self._offset = 0.0
+        self._count = 0
+
+    def __call__(self, ticks: int | float | None = None, host_time: float | None = None) -> float:
+        """Sample time in seconds
+
+        Parameters
+        ----------
+        ticks : int, optional
+            Device counter of the sample
+        host_time : float, optional
+            Host arrival time, used when the device has no counter or
+        ``tick`` is 0
+        """
+        if self.tick > 0.0 and ticks is not None:
+            ticks = int(ticks)
+            if self._ticks is not None:
+                self._source += ((ticks - self._ticks) % self.modulus) * self.tick
+            self._ticks = ticks
+            source = self._source
+        else:
+            source = host_time
+
+        resyncs = self.resyncs
+        seconds = self._track(source)
+        if host_time is not None:
+            if self.epoch is None or self.resyncs != resyncs:
+                self.epoch = host_time - seconds
+            else:
+                self.epoch += EPOCH_GAIN * (host_time - seconds - self.epoch)
+
+        return seconds
+
+    def posix_time(self, seconds: float) -> float:
+        """POSIX time of a sample time returned by the clock"""
+        return seconds + (self.epoch or 0.0)
+
+    def _track(self, source: float) -> float:
+        self._count += 1
+        if self._count == 1:
+            self._first = self._estimate = source
+            return source + self._offset
+        if self._count <= WARMUP_SAMPLES:
+            # NOTE: Mean period of the first samples, before any smoothing
+            self.period = (source - self._first) / (self._count - 1)
+            self._estimate = max(source, self._estimate)
+            return self._estimate + self._offset
+
+        predicted = self._estimate + self.period
+        error = source - predicted
+        if abs(error) > self.max_gap:
+            self.resyncs += 1
+            self._offset += predicted - source
+            self._estimate = source
+        else:
+            self._estimate = max(predicted + self.alpha * error, self._estimate)
+            self.period = max(self.period + self.beta * error, 0.0)
+
+        return self._estimate + self._offset
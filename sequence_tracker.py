@@ -0,0 +1,164 @@
+# Developed by Paulo Chiliguano and KA HO Wong
+# Directed by Dr Roberto Alonso Trillo
+# HKBU Academy of Music
+# 2024
+
+"""Packet sequence tracking
+
+Detects lost, duplicated and late notifications of one device from the
+wrapping counter carried by its packets (the SensorTile uint16 timestamp),
+and optionally fills short gaps by interpolation so the fusion filter does
+not see missing data as a discontinuity.
+
+The counter ticks are coarser than, or close to, the sample period
+(8 ms ticks for 10 ms samples), so tick differences alone are ambiguous.
+Sample indices are instead recovered from a running least-squares line
+of elapsed ticks against sample index, whose intercept absorbs the
+quantisation phase of the device. Gaps can only be resolved while the
+sample period is at least one tick; at higher rates only duplicate and
+late packets are counted.
+"""
+from typing import List, Tuple
+
+
+WARMUP_SAMPLES = 16
+
+
+class InterpolatedSample(list):
+    """Decoded sample synthesised to fill a gap; it is fused and published but not logged"""
+
+
+class SequenceTracker:
+    """Gap, duplicate and late packet counters of one device
+
+    Parameters
+    ----------
+    modulus : int
+        Period of the packet counter, 2**16 for a uint16 timestamp
+    interpolate : int
+        Longest gap, in samples, filled by linear interpolation (0 disables)
+    max_gap : int
+        Gaps longer than this many samples are treated as a restart of the
+        device counter rather than as loss
+    """
+    def __init__(self, modulus: int = 1 << 16, interpolate: int = 0, max_gap: int = 1000):
+        self.modulus = modulus
+        self.interpolate = interpolate
+        self.max_gap = max_gap
+        self.received = 0
+        self.gaps = 0
+        self.missing = 0
+        self.duplicates = 0
+        self.late = 0
+        self.interpolated = 0
+        self.resyncs = 0
+        self.period = 0.0  # NOTE: Counter ticks per sample
+        self._restart()
+
+    def _restart(self):
+        self._ticks = None
+        self._previous = None
+        self._elapsed = 0
+        self._index = 0
+        self._count = 0
+        self._mean_index = 0.0
+        self._mean_elapsed = 0.0
+        self._covariance = 0.0
+        self._variance = 0.0
+        self._fit(0, 0)
+
+    def _fit(self, index: int, elapsed: int):
+        """Adds one point to the running line fit, elapsed ticks = period * index + intercept"""
+        self._count += 1
+        d_index = index - self._mean_index
+        self._mean_index += d_index / self._count
+        self._mean_elapsed += (elapsed - self._mean_elapsed) / self._count
+        self._covariance += d_index * (elapsed - self._mean_elapsed)
+        self._variance += d_index * (index - self._mean_index)
+        if self._variance > 0.0:
+            self.period = self._covariance / self._variance
+
+    def counters(self) -> dict:
+        return {
+            'received': self.received,
+            'gaps': self.gaps,
+            'missing': self.missing,
+            'duplicates': self.duplicates,
+            'late': self.late,
+            'interpolated': self.interpolated,
+            'resyncs': self.resyncs,
+        }
+
+    def update(self, sample_time: float, sample: list) -> List[Tuple[float, list]]:
+        """Checks one decoded sample
+
+        Parameters
+        ----------
+        sample_time : float
+            Host arrival time
+        sample : list
+            Decoded sample, counter first
+
+        Returns
+        -------
+        list
+            ``(sample_time, sample)`` pairs to forward: nothing for duplicate
+            and late samples, the interpolated samples of a short gap
+            followed by the sample otherwise
+        """
+        self.received += 1
+        ticks = int(sample[0])
+        if self._ticks is None:
+            self._ticks, self._previous = ticks, (sample_time, sample)
+            return [(sample_time, sample)]
+
+        delta = (ticks - self._ticks) % self.modulus
+        if delta > self.modulus // 2:
+            self.late += 1
+            if self.missing:
+                self.missing -= 1  # NOTE: Counted as lost when the newer sample arrived
+            return []
+        if delta == 0 and sample == self._previous[1]:
+            self.duplicates += 1
+            return []
+
+        elapsed = self._elapsed + delta
+        missing = 0
+        if self._count >= WARMUP_SAMPLES and self.period >= 1.0:
+            intercept = self._mean_elapsed - self.period * self._mean_index
+            missing = round((elapsed - intercept) / self.period) - self._index - 1
+            if missing > self.max_gap:
+                self.resyncs += 1
+                self._restart()
+                self._ticks, self._previous = ticks, (sample_time, sample)
+                return [(sample_time, sample)]
+            missing = max(missing, 0)
+
+        forward = []
+        if missing:
+            self.gaps += 1
+            self.missing += missing
+            if missing <= self.interpolate:
+                forward = self._fill(missing, sample_time, sample)
+                self.interpolated += missing
+
+        self._index += missing + 1
+        self._elapsed = elapsed
+        self._ticks = ticks
+        self._previous = (sample_time, sample)
+        self._fit(self._index, elapsed)
+        forward.append((sample_time, sample))
+
+        return forward
+
+    def _fill(self, missing: int, sample_time: float, sample: list) -> List[Tuple[float, list]]:
+        previous_time, previous = self._previous
+        ticks = previous[0] + ((sample[0] - previous[0]) % self.modulus)
+        filled = []
+        for i in range(1, missing + 1):
+            weight = i / (missing + 1)
+            values = InterpolatedSample(a + (b - a) * weight for a, b in zip(previous, sample))
+            values[0] = float(round(previous[0] + (ticks - previous[0]) * weight) % self.modulus)
+            filled.append((previous_time + (sample_time - previous_time) * weight, values))
+
+        return filled
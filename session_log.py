@@ -0,0 +1,513 @@
+# Developed by Paulo Chiliguano and KA HO Wong
+# Directed by Dr Roberto Alonso Trillo
+# HKBU Academy of Music
+# 2024
+
+"""Session log
+
+Layout of the session logs written by the bridge, either as CSV text or
+as a compact binary file of fixed-width records that can be memory-mapped.
+"""
+import argparse
+import csv
+import gzip
+import json
+import shutil
+import threading
+import numpy as np
+from collections import deque
+from datetime import datetime
+from pathlib import Path
+from time import monotonic
+from typing import List
+from pipeline import POLICIES
+
+
+LOG_TIMESTAMP_FORMAT = "%Y%m%d_%H%M%S.%f"
+
+CSV_HEADER = [
+    'ID',
+    'timestamp',
+    'accl_x',
+    'accl_y',
+    'accl_z',
+    'gyro_x',
+    'gyro_y',
+    'gyro_z',
+    'magn_x',
+    'magn_y',
+    'magn_z',
+    'q_w',
+    'q_x',
+    'q_y',
+    'q_z',
+    'accl_sensor_frame_x',
+    'accl_sensor_frame_y',
+    'accl_sensor_frame_z',
+    'accl_derivative_x',
+    'accl_derivative_y',
+    'accl_derivative_z',
+    'accl_vel_x',
+    'accl_vel_y',
+    'accl_vel_z',
+    'accl_skewness',
+    'accl_tilt',
+    'accl_roll'
+]
+
+SENSOR_COLUMNS = slice(2, 11)  # NOTE: accl, gyro and magn X, Y, Z
+NAN = float('nan')
+
+
+def log_timestamp(seconds: float | None = None) -> str:
+    """Formats a POSIX time, or the current time, as LOG_TIMESTAMP_FORMAT"""
+    moment = datetime.now() if seconds is None else datetime.fromtimestamp(seconds)
+    return moment.strftime(LOG_TIMESTAMP_FORMAT)
+
+
+def log_row(timestamp: float | str, device_number, sensor_data, model) -> List:
+    """Builds one CSV row
+
+    Parameters
+    ----------
+    timestamp : float or str
+        Host time of the sample, as POSIX seconds or formatted as
+        LOG_TIMESTAMP_FORMAT; seconds are only formatted by CsvLogWriter
+    device_number : int or str
+        OSC identifier of the device
+    sensor_data : sequence of float
+        accl, gyro and magn X, Y, Z values
+    model : GestureModel or GestureSnapshot
+        Fusion outputs of the sample; outputs that were not computed
+        (None in the snapshot) are logged as NaN
+
+    Returns
+    -------
+    list
+        Values in the CSV_HEADER order
+    """
+    return [device_number,
+            timestamp,
+            *sensor_data,
+            *model.quaternion.elements.tolist(),
+            *_vector(model.movement_acceleration),
+            *_vector(model.acceleration_derivative),
+            *_vector(model.movement_velocity),
+            NAN if model.skewness is None else model.skewness,
+            NAN if model.tilt is None else model.tilt,
+            NAN if model.roll is None else model.roll]
+
+
+def _vector(values) -> List[float]:
+    return [NAN, NAN, NAN] if values is None else values.tolist()
+
+
+class TimestampParser:
+    """Converts LOG_TIMESTAMP_FORMAT strings to POSIX seconds
+
+    datetime.strptime is only called once per distinct second, which keeps
+    reading long logs cheap.
+    """
+    def __init__(self):
+        self._seconds = {}
+
+    def __call__(self, text: str) -> float:
+        whole, _, fraction = text.partition('.')
+        seconds = self._seconds.get(whole)
+        if seconds is None:
+            seconds = datetime.strptime(whole, "%Y%m%d_%H%M%S").timestamp()
+            self._seconds[whole] = seconds
+
+        return seconds + (int(fraction) / 10 ** len(fraction) if fraction else 0.0)
+
+
+BINARY_LOG_MAGIC = b"MBLOG\x00\x00\x01"
+BINARY_LOG_HEADER_SIZE = 4096  # NOTE: Reserved so the device map can be rewritten in place
+BINARY_LOG_COLUMNS = CSV_HEADER[2:]
+BINARY_RECORD_DTYPE = np.dtype([
+    ('device', '<u2'),
+    ('timestamp', '<f8'),
+    ('values', '<f4', (len(BINARY_LOG_COLUMNS),)),
+])
+
+
+def _format_timestamp(seconds: float) -> str:
+    return datetime.fromtimestamp(seconds).strftime(LOG_TIMESTAMP_FORMAT)
+
+
+class BinaryLogWriter:
+    """Writes a binary session log
+
+    The file starts with BINARY_LOG_MAGIC, a uint32 header length and a JSON
+    header holding the schema and the device map, padded to
+    BINARY_LOG_HEADER_SIZE bytes. It is followed by one BINARY_RECORD_DTYPE
+    record per sample. Device identifiers are stored as indices into the
+    device map, which is rewritten whenever a new device appears so a
+    truncated file stays readable.
+    """
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        self.devices = []
+        self._indices = {}
+        self._parse_timestamp = TimestampParser()
+        self._record = np.zeros(1, dtype=BINARY_RECORD_DTYPE)
+        self._file = open(self.path, 'wb')
+        self._write_header()
+
+    def _write_header(self):
+        header = json.dumps({
+            'version': 1,
+            'columns': ['ID', 'timestamp', *BINARY_LOG_COLUMNS],
+            'dtype': BINARY_RECORD_DTYPE.descr,
+            'devices': self.devices,
+        }).encode('UTF8')
+        size = len(BINARY_LOG_MAGIC) + 4 + len(header)
+        if size > BINARY_LOG_HEADER_SIZE:
+            raise ValueError("Too many devices for the binary log header")
+        position = self._file.tell()
+        self._file.seek(0)
+        self._file.write(BINARY_LOG_MAGIC)
+        self._file.write(len(header).to_bytes(4, 'little'))
+        self._file.write(header.ljust(BINARY_LOG_HEADER_SIZE - len(BINARY_LOG_MAGIC) - 4))
+        if position > BINARY_LOG_HEADER_SIZE:
+            self._file.seek(position)
+
+    def device_index(self, device_number) -> int:
+        key = str(device_number)
+        index = self._indices.get(key)
+        if index is None:
+            index = self._indices[key] = len(self.devices)
+            self.devices.append(key)
+            self._write_header()
+        return index
+
+    def write(self, seconds: float, device_number, values):
+        """Appends one sample
+
+        Parameters
+        ----------
+        seconds : float
+            POSIX time of the sample
+        device_number : int or str
+            OSC identifier of the device
+        values : sequence of float
+            The BINARY_LOG_COLUMNS values
+        """
+        record = self._record[0]
+        record['device'] = self.device_index(device_number)
+        record['timestamp'] = seconds
+        record['values'] = values
+        self._file.write(self._record.tobytes())
+
+    def write_row(self, row):
+        """Appends one row laid out as CSV_HEADER, e.g. from log_row"""
+        timestamp = row[1]
+        self.write(self._parse_timestamp(timestamp) if isinstance(timestamp, str) else timestamp, row[0], row[2:])
+
+    def write_rows(self, rows):
+        for row in rows:
+            self.write_row(row)
+
+    def tell(self) -> int:
+        return self._file.tell()
+
+    def write_records(self, records: np.ndarray):
+        self._file.write(np.ascontiguousarray(records, dtype=BINARY_RECORD_DTYPE).tobytes())
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class BinaryLog:
+    """Memory-mapped reader of a binary session log
+
+    Columns are returned as NumPy views of the file, nothing is parsed.
+    """
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        with open(self.path, 'rb') as f:
+            if f.read(len(BINARY_LOG_MAGIC)) != BINARY_LOG_MAGIC:
+                raise ValueError(f"{path} is not a binary session log")
+            length = int.from_bytes(f.read(4), 'little')
+            self.header = json.loads(f.read(length))
+        self.devices = self.header['devices']
+        self.columns = self.header['columns']
+        dtype = np.dtype([tuple(i) for i in self.header['dtype']])
+        count = (self.path.stat().st_size - BINARY_LOG_HEADER_SIZE) // dtype.itemsize
+        if count > 0:
+            self.records = np.memmap(self.path, dtype=dtype, mode='r',
+                                     offset=BINARY_LOG_HEADER_SIZE, shape=(count,))
+        else:
+            self.records = np.zeros(0, dtype=dtype)
+        self._indices = {name: i for i, name in enumerate(self.columns[2:])}
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def column(self, name: str) -> np.ndarray:
+        """View of one column; 'ID' gives device indices into ``devices``"""
+        if name == 'ID':
+            return self.records['device']
+        if name == 'timestamp':
+            return self.records['timestamp']
+        return self.records['values'][:, self._indices[name]]
+
+    def device_mask(self, device_number) -> np.ndarray:
+        return self.records['device'] == self.devices.index(str(device_number))
+
+    def rows(self):
+        """Yields rows laid out as CSV_HEADER"""
+        for record in self.records:
+            yield [self.devices[record['device']],
+                   _format_timestamp(float(record['timestamp'])),
+                   *map(str, record['values'])]  # NOTE: Shortest float32 representation
+
+
+class CsvLogWriter:
+    """Writes a CSV session log, keeping the file open
+
+    Timestamps given as POSIX seconds are formatted as LOG_TIMESTAMP_FORMAT.
+    """
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        self._file = open(self.path, 'w', newline='', encoding='UTF8')
+        self._writer = csv.writer(self._file)
+        self._writer.writerow(CSV_HEADER)
+
+    def write_rows(self, rows):
+        for row in rows:
+            if not isinstance(row[1], str):
+                row[1] = log_timestamp(row[1])
+        self._writer.writerows(rows)
+
+    def tell(self) -> int:
+        return self._file.tell()
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+
+
+BUFFER_FLUSHES = 8  # NOTE: Buffered rows of SessionLogWriter, in flush_rows batches
+
+LOG_WRITERS = {
+    'csv': (CsvLogWriter, "csv"),
+    'binary': (BinaryLogWriter, "mblog"),
+}
+
+
+class SessionLogWriter:
+    """Background service writing session log rows in batches
+
+    Rows are appended to an in-memory buffer and written by one thread that
+    keeps the segment file open. The buffer is flushed when it holds
+    ``flush_rows`` rows or after ``flush_interval`` seconds, and holds at
+    most BUFFER_FLUSHES times as many rows; when the disk falls that far
+    behind, ``policy`` either blocks the caller or drops the oldest rows.
+    Segments are rotated by size and/or duration and optionally
+    gzip-compressed once closed.
+
+    Parameters
+    ----------
+    path_factory : callable
+        ``path_factory(extension)`` returns the path of the first segment
+    format : str
+        'csv' or 'binary'
+    flush_rows : int
+        Buffered rows that trigger a write
+    flush_interval : float
+        Maximum seconds a row stays buffered
+    rotate_bytes : int
+        Segment size that triggers a rotation, 0 to disable
+    rotate_seconds : float
+        Segment duration that triggers a rotation, 0 to disable
+    compress : bool
+        gzip closed segments
+    policy : str
+        Overload policy of the full buffer, one of pipeline.POLICIES;
+        'latest' drops the oldest rows like 'drop-oldest'
+    """
+    def __init__(self, path_factory, format: str = 'csv', flush_rows: int = 256,
+                 flush_interval: float = 1.0, rotate_bytes: int = 0,
+                 rotate_seconds: float = 0.0, compress: bool = False, policy: str = 'block'):
+        if format not in LOG_WRITERS:
+            raise ValueError(f"Unknown log format '{format}', expected one of {tuple(LOG_WRITERS)}")
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown overload policy '{policy}', expected one of {POLICIES}")
+        self.writer_class, extension = LOG_WRITERS[format]
+        self.path = Path(path_factory(extension))
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.rotate_bytes = rotate_bytes
+        self.rotate_seconds = rotate_seconds
+        self.compress = compress
+        self.policy = policy
+        self.max_rows = BUFFER_FLUSHES * max(flush_rows, 1)
+        self.segments = []
+        self.rows_written = 0
+        self.bytes_written = 0
+        self.errors = 0
+        self.dropped = 0  # NOTE: Rows discarded from the full buffer
+        self.failed = 0  # NOTE: Rows of the batches whose write raised
+        self._buffer = deque()
+        self._oldest = None
+        self._condition = threading.Condition()
+        self._running = False
+        self._writer = None
+        self._bytes_closed = 0
+        self._thread = threading.Thread(target=self._run, name="session-log-writer", daemon=True)
+
+    def start(self):
+        self._open_segment()
+        self._running = True
+        self._thread.start()
+
+    def write(self, row):
+        with self._condition:
+            if len(self._buffer) >= self.max_rows:
+                if self.policy == 'block':
+                    while len(self._buffer) >= self.max_rows and self._running:
+                        self._condition.wait()
+                else:
+                    self._buffer.popleft()
+                    self.dropped += 1
+            if not self._buffer:
+                self._oldest = monotonic()
+            self._buffer.append(row)
+            if len(self._buffer) >= self.flush_rows:
+                self._condition.notify_all()
+
+    def stop(self):
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+        if self._thread.is_alive():
+            self._thread.join()
+        self._close_segment()
+
+    def stats(self) -> dict:
+        """Backlog and output counters
+
+        ``lag`` is the number of buffered rows and ``lag_seconds`` the age of
+        the oldest one, i.e. how far the writer has fallen behind.
+        """
+        with self._condition:
+            lag = len(self._buffer)
+            oldest = self._oldest
+        return {
+            'lag': lag,
+            'lag_seconds': monotonic() - oldest if lag and oldest is not None else 0.0,
+            'rows_written': self.rows_written,
+            'bytes_written': self.bytes_written,
+            'segments': len(self.segments),
+            'errors': self.errors,
+            'dropped': self.dropped,
+            'failed': self.failed,
+        }
+
+    def _segment_path(self) -> Path:
+        if not self.segments:
+            return self.path
+        return self.path.with_name(f"{self.path.stem}_part{len(self.segments) + 1:03d}{self.path.suffix}")
+
+    def _open_segment(self):
+        path = self._segment_path()
+        self._writer = self.writer_class(path)
+        self._segment_start = monotonic()
+        self.segments.append(path)
+
+    def _close_segment(self):
+        if self._writer is None:
+            return
+        self._writer.close()
+        self._bytes_closed += self._writer.path.stat().st_size
+        self._writer = None
+        if self.compress:
+            path = self.segments[-1]
+            compressed = path.with_name(path.name + ".gz")
+            with open(path, 'rb') as source, gzip.open(compressed, 'wb') as destination:
+                shutil.copyfileobj(source, destination)
+            path.unlink()
+            self.segments[-1] = compressed
+
+    def _should_rotate(self) -> bool:
+        if self.rotate_bytes and self._writer.tell() >= self.rotate_bytes:
+            return True
+        return bool(self.rotate_seconds) and monotonic() - self._segment_start >= self.rotate_seconds
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if self._running and len(self._buffer) < self.flush_rows:
+                    self._condition.wait(self.flush_interval)
+                rows = self._buffer
+                self._buffer = deque()
+                self._oldest = None
+                running = self._running
+                self._condition.notify_all()  # NOTE: Wakes the callers blocked on a full buffer
+            if rows:
+                try:
+                    self._writer.write_rows(rows)
+                    self._writer.flush()
+                    self.rows_written += len(rows)
+                    self.bytes_written = self._bytes_closed + self._writer.tell()
+                except Exception:
+                    self.errors += 1
+                    self.failed += len(rows)
+            if running and self._should_rotate():
+                self._close_segment()
+                self._open_segment()
+            if not running:
+                break
+
+
+def csv_to_binary(csv_path: str | Path, binary_path: str | Path) -> int:
+    count = 0
+    with open(csv_path, newline='', encoding='UTF8') as f, BinaryLogWriter(binary_path) as writer:
+        reader = csv.reader(f)
+        if next(reader, None) != CSV_HEADER:
+            raise ValueError(f"{csv_path} is not a session log")
+        for row in reader:
+            writer.write_row(row)
+            count += 1
+
+    return count
+
+
+def binary_to_csv(binary_path: str | Path, csv_path: str | Path) -> int:
+    log = BinaryLog(binary_path)
+    with open(csv_path, 'w', newline='', encoding='UTF8') as f:
+        writer = csv.writer(f)
+        writer.writerow(CSV_HEADER)
+        writer.writerows(log.rows())
+
+    return len(log)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Convert session logs between CSV and binary")
+    parser.add_argument('source')
+    parser.add_argument('destination')
+    args = parser.parse_args(argv)
+    if Path(args.source).suffix == '.csv':
+        count = csv_to_binary(args.source, args.destination)
+    else:
+        count = binary_to_csv(args.source, args.destination)
+    print(f"{args.destination}: {count} samples")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,291 @@
+# Developed by Paulo Chiliguano and KA HO Wong
+# Directed by Dr Roberto Alonso Trillo
+# HKBU Academy of Music
+# 2024
+
+"""Simulated BLE backend
+
+Drop-in stand-ins for BleakScanner and BleakClient that behave like N
+virtual bows, so the bridge can be load tested without hardware. Every
+device plays a periodic bow stroke in the packet layout of the real
+boards: the Nordic "metabow" (13 floats and a flag byte) or the SensorTile
+"AM1V330" (int16 packets).
+"""
+import asyncio
+import struct
+import zlib
+from functools import partial
+import numpy as np
+from utils import SENSORTILE_PACKET_DTYPE
+
+
+PROTOCOLS = ('nordic', 'sensortile')
+NORDIC_PACKET = struct.Struct('<13fB')  # NOTE: accl, gyro, magn, quaternion (w, x, y, z), flag
+SENSORTILE_TICK = 0.008  # NOTE: Seconds per device timestamp tick (HAL_GetTick() >> 3)
+STROKE_FREQUENCY = 0.5  # NOTE: Bow strokes per second
+MAX_BACKLOG = 32  # NOTE: Overdue notifications a BLE link buffers before it loses them
+EARTH_FIELD = np.array([0.4, 0.0, -0.3])  # NOTE: Gauss, roughly the field at Hong Kong latitude
+
+
+def bow_stroke(n: int, rate: float, phase: float = 0.0, seed: int | None = None) -> dict:
+    """Synthetic IMU samples of one periodic bow stroke
+
+    Yaw sweeps the stroke, pitch and roll follow the wrist. Sensors are in
+    the body frame: accelerometer in g, gyroscope in degrees per second and
+    magnetometer in gauss.
+
+    Parameters
+    ----------
+    n : int
+        Number of samples of the cycle
+    rate : float
+        Samples per second
+    phase : float
+        Phase offset in radians, so devices do not move in lockstep
+    seed : int, optional
+        Seed of the sensor noise
+
+    Returns
+    -------
+    dict
+        ``accl``, ``gyro``, ``magn`` with shape (n, 3) and ``quaternion``
+        with shape (n, 4)
+    """
+    w = 2.0 * np.pi * rate / n
+    t = np.arange(n) / rate
+    yaw, yaw_rate = 0.8 * np.sin(w * t + phase), 0.8 * w * np.cos(w * t + phase)
+    pitch, pitch_rate = 0.3 * np.sin(w * t + phase + 1.0), 0.3 * w * np.cos(w * t + phase + 1.0)
+    roll, roll_rate = 0.2 * np.sin(2 * w * t + phase), 0.4 * w * np.cos(2 * w * t + phase)
+    cy, sy = np.cos(yaw), np.sin(yaw)
+    cp, sp = np.cos(pitch), np.sin(pitch)
+    cr, sr = np.cos(roll), np.sin(roll)
+
+    # NOTE: Body to earth rotation Rz(yaw) Ry(pitch) Rx(roll)
+    rotation = np.empty((n, 3, 3))
+    rotation[:, 0] = np.stack([cy * cp, cy * sp * sr - sy * cr, cy * sp * cr + sy * sr], axis=1)
+    rotation[:, 1] = np.stack([sy * cp, sy * sp * sr + cy * cr, sy * sp * cr - cy * sr], axis=1)
+    rotation[:, 2] = np.stack([-sp, cp * sr, cp * cr], axis=1)
+
+    gyro = np.stack([roll_rate - yaw_rate * sp,
+                     pitch_rate * cr + yaw_rate * cp * sr,
+                     -pitch_rate * sr + yaw_rate * cp * cr], axis=1)
+    accl = np.einsum('nji,j->ni', rotation, np.array([0.0, 0.0, 1.0]))
+    magn = np.einsum('nji,j->ni', rotation, EARTH_FIELD)
+
+    half_yaw, half_pitch, half_roll = yaw / 2, pitch / 2, roll / 2
+    quaternion = np.stack([
+        np.cos(half_roll) * np.cos(half_pitch) * np.cos(half_yaw) + np.sin(half_roll) * np.sin(half_pitch) * np.sin(half_yaw),
+        np.sin(half_roll) * np.cos(half_pitch) * np.cos(half_yaw) - np.cos(half_roll) * np.sin(half_pitch) * np.sin(half_yaw),
+        np.cos(half_roll) * np.sin(half_pitch) * np.cos(half_yaw) + np.sin(half_roll) * np.cos(half_pitch) * np.sin(half_yaw),
+        np.cos(half_roll) * np.cos(half_pitch) * np.sin(half_yaw) - np.sin(half_roll) * np.sin(half_pitch) * np.cos(half_yaw),
+    ], axis=1)
+
+    noise = np.random.default_rng(seed)
+    return {
+        'accl': accl + noise.normal(0.0, 0.005, accl.shape),
+        'gyro': np.degrees(gyro) + noise.normal(0.0, 0.2, gyro.shape),
+        'magn': magn + noise.normal(0.0, 0.002, magn.shape),
+        'quaternion': quaternion,
+    }
+
+
+class SimulatedDevice:
+    """Virtual bow with the attributes of a bleak BLEDevice
+
+    The packets of one stroke are encoded once, so emitting a notification
+    only costs a lookup (and the timestamp for SensorTile packets).
+
+    Parameters
+    ----------
+    name : str
+        Advertised name, e.g. "metabow" or "AM1V330"
+    address : str
+        BLE address
+    protocol : str
+        'nordic' or 'sensortile'
+    rate : float
+        Samples per second
+    samples_per_notification : int
+        Packets (SensorTile) or records (Nordic) concatenated in one notification
+    """
+    def __init__(self, name: str, address: str, protocol: str = 'nordic', rate: float = 100.0,
+                 samples_per_notification: int = 1, phase: float = 0.0):
+        if protocol not in PROTOCOLS:
+            raise ValueError(f"Unknown protocol '{protocol}', expected one of {PROTOCOLS}")
+        self.name = name
+        self.address = address
+        self.protocol = protocol
+        self.rate = rate
+        self.samples_per_notification = samples_per_notification
+        self.notifications_sent = 0
+        self.notifications_lost = 0
+        self.epoch = None  # NOTE: Loop time of the first notification
+        n = max(int(round(rate / STROKE_FREQUENCY)), 2)
+        stroke = bow_stroke(n, rate, phase, seed=zlib.crc32(address.encode()))
+        if protocol == 'nordic':
+            self._packets = [
+                NORDIC_PACKET.pack(*a, *g, *m, *q, 1)
+                for a, g, m, q in zip(stroke['accl'], stroke['gyro'], stroke['magn'], stroke['quaternion'])
+            ]
+        else:
+            packets = np.zeros(n, dtype=SENSORTILE_PACKET_DTYPE)
+            packets['accl'] = np.clip(np.round(stroke['accl'] * 1000.0), -32768, 32767)  # NOTE: mg
+            packets['gyro'] = np.clip(np.round(stroke['gyro'] * 10.0), -32768, 32767)  # NOTE: 0.1 dps
+            packets['magn'] = np.clip(np.round(stroke['magn'] * 1000.0), -32768, 32767)  # NOTE: mgauss
+            self._packets = packets
+
+    @property
+    def period(self) -> float:
+        """Seconds between notifications"""
+        return self.samples_per_notification / self.rate
+
+    def notification(self, index: int) -> bytearray:
+        """Payload of the index-th notification"""
+        self.notifications_sent += 1
+        first = index * self.samples_per_notification
+        if self.protocol == 'nordic':
+            return bytearray(b"".join(self._packets[i % len(self._packets)]
+                                      for i in range(first, first + self.samples_per_notification)))
+        samples = np.arange(first, first + self.samples_per_notification)
+        packets = self._packets[samples % len(self._packets)]
+        packets['timestamp'] = (samples / self.rate / SENSORTILE_TICK).astype(np.int64) & 0xFFFF
+        return bytearray(packets.tobytes())
+
+    def __repr__(self):
+        return f"SimulatedDevice({self.name!r}, {self.address!r}, {self.protocol!r}, {self.rate})"
+
+
+def simulated_devices(n: int, name: str = "metabow", protocol: str = 'nordic', rate: float = 100.0,
+                      samples_per_notification: int = 1) -> list:
+    """N virtual bows with distinct addresses and stroke phases"""
+    return [
+        SimulatedDevice(name, f"5A:1B:00:00:{i >> 8:02X}:{i & 0xFF:02X}", protocol, rate,
+                        samples_per_notification, phase=2.0 * np.pi * i / max(n, 1))
+        for i in range(n)
+    ]
+
+
+class SimulatedScanner:
+    """BleakScanner stand-in that reports every simulated device on start"""
+    def __init__(self, detection_callback, devices: list | None = None):
+        self.detection_callback = detection_callback
+        self.devices = devices or []
+        self._tasks = set()
+
+    async def start(self):
+        for device in self.devices:
+            result = self.detection_callback(device, None)
+            if asyncio.iscoroutine(result):
+                task = asyncio.get_running_loop().create_task(result)
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+
+    async def stop(self):
+        pass
+
+
+class SimulatedClient:
+    """BleakClient stand-in streaming the packets of a SimulatedDevice
+
+    Notifications are scheduled against absolute deadlines, so a late wake-up
+    delivers the overdue notifications at once, as a busy BLE stack would.
+    Beyond MAX_BACKLOG overdue notifications the oldest ones are lost.
+
+    Parameters
+    ----------
+    device : SimulatedDevice or str
+        Device, or its address among ``devices``
+    disconnected_callback : callable, optional
+        Called with the client when the link drops
+    timeout : float
+        Unused, as in BleakClient
+    connect_delay : float
+        Seconds a connection takes
+    devices : list
+        Simulated devices addresses are looked up in
+    dropout : float
+        Mean seconds between link drops, 0 for a link that never drops
+    """
+    def __init__(self, device: SimulatedDevice | str, disconnected_callback=None, timeout: float = 10.0,
+                 connect_delay: float = 0.0, devices: list | None = None, dropout: float = 0.0):
+        if isinstance(device, str):
+            found = [i for i in devices or [] if i.address == device]
+            if not found:
+                raise LookupError(f"Device with address {device} was not found")
+            device = found[0]
+        self.device = device
+        self.disconnected_callback = disconnected_callback
+        self.connect_delay = connect_delay
+        self.dropout = dropout
+        self.is_connected = False
+        self._notify_tasks = {}
+        self._random = np.random.default_rng(zlib.crc32(device.address.encode()) + device.notifications_sent)
+
+    async def connect(self):
+        await asyncio.sleep(self.connect_delay)
+        self.is_connected = True
+        return True
+
+    async def disconnect(self):
+        for task in self._notify_tasks.values():
+            task.cancel()
+        self._notify_tasks.clear()
+        self.is_connected = False
+        return True
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.disconnect()
+
+    async def start_notify(self, characteristic, callback):
+        self._notify_tasks[characteristic] = asyncio.get_running_loop().create_task(self._emit(callback))
+
+    async def stop_notify(self, characteristic):
+        task = self._notify_tasks.pop(characteristic, None)
+        if task is not None:
+            task.cancel()
+
+    async def _emit(self, callback):
+        loop = asyncio.get_running_loop()
+        period = self.device.period
+        if self.device.epoch is None:
+            self.device.epoch = loop.time()
+        start = self.device.epoch  # NOTE: The device keeps sampling while the link is down
+        index = int((loop.time() - start) / period)
+        drop = loop.time() + self._random.exponential(self.dropout) if self.dropout > 0.0 else float('inf')
+        while self.is_connected:
+            if loop.time() >= drop:
+                self._notify_tasks.clear()
+                self.is_connected = False
+                if self.disconnected_callback is not None:
+                    self.disconnected_callback(self)
+                return
+            due = int((loop.time() - start) / period) + 1
+            if due - index > MAX_BACKLOG:
+                self.device.notifications_lost += due - index - MAX_BACKLOG
+                index = due - MAX_BACKLOG
+            while index < due:
+                callback(self, self.device.notification(index))
+                index += 1
+            await asyncio.sleep(max(start + index * period - loop.time(), 0.0))
+
+
+def simulated_backend(simulation: dict, name: str, protocol: str = 'nordic'):
+    """Scanner and client classes for the ``[simulation]`` configuration section
+
+    Returns
+    -------
+    tuple
+        ``(scanner_class, client_class)`` with the signatures of
+        BleakScanner and BleakClient
+    """
+    devices = simulated_devices(simulation.get('devices', 1), name,
+                                simulation.get('protocol', protocol),
+                                simulation.get('rate', 100.0),
+                                simulation.get('samples-per-notification', 1))
+
+    return (partial(SimulatedScanner, devices=devices),
+            partial(SimulatedClient, devices=devices, dropout=simulation.get('dropout', 0.0)))
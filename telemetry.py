@@ -0,0 +1,277 @@
+# Developed by Paulo Chiliguano and KA HO Wong
+# Directed by Dr Roberto Alonso Trillo
+# HKBU Academy of Music
+# 2024
+
+"""Bridge telemetry
+
+Always-on counters cheap enough for performances: per-device packet rate
+and inter-arrival jitter, and log-scale histograms of the time spent in
+every pipeline stage. Writers only increment numbers; the periodic report
+works on the difference between two reads, so nothing is ever reset under
+a writer.
+"""
+import math
+from typing import Dict, Hashable, List
+
+
+HISTOGRAM_OCTAVES = 48  # NOTE: Powers of two from 2**-24 s (60 ns) to 2**24 s
+HISTOGRAM_OFFSET = 24
+HISTOGRAM_SUBBUCKETS = 4  # NOTE: Buckets per octave, i.e. at most 25 % relative error
+HISTOGRAM_BUCKETS = HISTOGRAM_OCTAVES * HISTOGRAM_SUBBUCKETS
+JITTER_GAIN = 1.0 / 16.0  # NOTE: RFC 3550 interarrival jitter estimator
+
+
+class LatencyHistogram:
+    """Histogram of durations in seconds with log-scale buckets
+
+    Recording is one ``frexp`` and one increment, and histograms of several
+    threads can be merged, e.g. the per-device workers of a stage.
+    """
+    def __init__(self):
+        self.counts = [0] * HISTOGRAM_BUCKETS
+        self.maximum = 0.0
+
+    def record(self, seconds: float):
+        if seconds > 0.0:
+            mantissa, exponent = math.frexp(seconds)
+            bucket = ((exponent + HISTOGRAM_OFFSET) * HISTOGRAM_SUBBUCKETS
+                      + int((2.0 * mantissa - 1.0) * HISTOGRAM_SUBBUCKETS))
+            bucket = min(max(bucket, 0), HISTOGRAM_BUCKETS - 1)
+        else:
+            bucket = 0
+        self.counts[bucket] += 1
+        if seconds > self.maximum:
+            self.maximum = seconds
+
+    @staticmethod
+    def merge(histograms) -> 'LatencyHistogram':
+        merged = LatencyHistogram()
+        for histogram in histograms:
+            merged.counts = [a + b for a, b in zip(merged.counts, histogram.counts)]
+            merged.maximum = max(merged.maximum, histogram.maximum)
+        return merged
+
+
+def bucket_upper_bound(bucket: int) -> float:
+    """Upper bound in seconds of a histogram bucket"""
+    octave, sub = divmod(bucket, HISTOGRAM_SUBBUCKETS)
+    return math.ldexp(1.0 + (sub + 1) / HISTOGRAM_SUBBUCKETS, octave - HISTOGRAM_OFFSET - 1)
+
+
+def percentile(counts: List[int], q: float) -> float | None:
+    """Upper bound of the bucket holding the q-th percentile of ``counts``"""
+    total = sum(counts)
+    if total == 0:
+        return None
+    rank = q / 100.0 * total
+    cumulative = 0
+    for bucket, count in enumerate(counts):
+        cumulative += count
+        if cumulative >= rank:
+            return bucket_upper_bound(bucket)
+
+    return bucket_upper_bound(len(counts) - 1)
+
+
+class DeviceTelemetry:
+    """Arrival counters of one device, updated by its notification handler"""
+    def __init__(self):
+        self.packets = 0
+        self.last_arrival = None
+        self.interval = 0.0
+        self.jitter = 0.0
+        self.connecting_since = None
+        self.first_sample = None  # NOTE: Seconds from the last connection attempt to its first packet
+        self.malformed = 0  # NOTE: Notifications dropped by the decode stage for their length
+
+    def arrival(self, seconds: float):
+        self.packets += 1
+        if self.connecting_since is not None:
+            self.first_sample = seconds - self.connecting_since
+            self.connecting_since = None
+            self.last_arrival = None  # NOTE: The dropout is not an inter-arrival interval
+        if self.last_arrival is not None:
+            interval = seconds - self.last_arrival
+            if self.interval == 0.0:
+                self.interval = interval
+            # NOTE: Deviation from the running mean interval, smoothed as in RFC 3550
+            self.jitter += (abs(interval - self.interval) - self.jitter) * JITTER_GAIN
+            self.interval += (interval - self.interval) * JITTER_GAIN
+        self.last_arrival = seconds
+
+
+class Telemetry:
+    """Device arrivals and stage histograms, reported as periodic snapshots
+
+    Parameters
+    ----------
+    latencies : iterable of str
+        Names of the end-to-end latency histograms, e.g. "ble_to_osc" for
+        the time from BLE arrival to the OSC send
+    """
+    def __init__(self, latencies=("ble_to_osc", "ble_to_log")):
+        self.devices: Dict[Hashable, DeviceTelemetry] = {}
+        self.latencies = {name: LatencyHistogram() for name in latencies}
+        self._previous = {}
+
+    def _device(self, device_number: Hashable) -> DeviceTelemetry:
+        device = self.devices.get(device_number)
+        if device is None:
+            device = self.devices[device_number] = DeviceTelemetry()
+        return device
+
+    def arrival(self, device_number: Hashable, seconds: float):
+        self._device(device_number).arrival(seconds)
+
+    def malformed(self, device_number: Hashable):
+        self._device(device_number).malformed += 1
+
+    def connecting(self, device_number: Hashable, seconds: float):
+        """Starts the time to first sample of a connection attempt"""
+        device = self._device(device_number)
+        if device.connecting_since is None:
+            device.connecting_since = seconds  # NOTE: Failed attempts count towards the next success
+
+    def latency(self, name: str, seconds: float):
+        self.latencies[name].record(seconds)
+
+    def _delta(self, key, counts: List[int]) -> List[int]:
+        previous = self._previous.get(key)
+        self._previous[key] = list(counts)
+        if previous is None:
+            return list(counts)
+        return [a - b for a, b in zip(counts, previous)]
+
+    def _summary(self, key, histogram: LatencyHistogram) -> dict:
+        counts = self._delta(key, histogram.counts)
+        p50, p99 = percentile(counts, 50), percentile(counts, 99)
+        return {
+            'count': sum(counts),
+            'p50_ms': None if p50 is None else p50 * 1e3,
+            'p99_ms': None if p99 is None else p99 * 1e3,
+            'max_ms': histogram.maximum * 1e3,
+        }
+
+    def snapshot(self, seconds: float, interval: float, stages: dict | None = None,
+                 sequence: dict | None = None, connections: dict | None = None,
+                 stage_counters: dict | None = None, log: dict | None = None) -> dict:
+        """Rates and percentiles since the previous snapshot
+
+        Parameters
+        ----------
+        seconds : float
+            POSIX time of the snapshot
+        interval : float
+            Seconds since the previous snapshot
+        stages : dict
+            LatencyHistogram of every pipeline stage, keyed by stage name
+        sequence : dict
+            SequenceTracker counters of every device, added to its entry
+        connections : dict
+            ConnectionManager counters of every device, added to its entry
+        stage_counters : dict
+            Dropped items and errors of every pipeline stage (session
+            totals), added to its entry
+        log : dict
+            Backlog, dropped and failed rows of the session log writer
+
+        Returns
+        -------
+        dict
+            ``devices`` (rate, jitter, packets, malformed notifications,
+            time to first sample, sequence and connection counters),
+            ``stages`` (with their
+            drop and error counters), ``latency``
+            (count, p50 and p99 of the interval, session maximum, in
+            milliseconds) and ``log``
+        """
+        devices = {}
+        sequence = sequence or {}
+        connections = connections or {}
+        stage_counters = stage_counters or {}
+        for device_number, device in list(self.devices.items()):
+            packets = device.packets
+            previous = self._previous.get(('device', device_number), 0)
+            self._previous[('device', device_number)] = packets
+            devices[str(device_number)] = {
+                'rate': (packets - previous) / interval if interval > 0 else 0.0,
+                'jitter_ms': device.jitter * 1e3,
+                'packets': packets,
+                'first_sample_ms': None if device.first_sample is None else device.first_sample * 1e3,
+                'malformed': device.malformed,
+                **sequence.get(device_number, {}),
+                **connections.get(device_number, {}),
+            }
+
+        return {
+            'time': seconds,
+            'devices': devices,
+            'stages': {name: {**self._summary(('stage', name), histogram), **stage_counters.get(name, {})}
+                       for name, histogram in (stages or {}).items()},
+            'latency': {name: self._summary(('latency', name), histogram)
+                        for name, histogram in self.latencies.items()},
+            'log': dict(log or {}),
+        }
+
+
+def metrics_messages(snapshot: dict) -> List[list]:
+    """``/bridge/metrics`` arguments of a snapshot, one message per device and stage
+
+    Each message starts with its kind and name, e.g.
+    ``device 0 <rate> <jitter ms> <packets> <missing> <duplicates> <late>
+    <first sample ms> <drops> <malformed>`` or
+    ``stage fuse <count> <p50 ms> <p99 ms> <max ms> <dropped> <errors>``
+    and, while a session log is written, ``log <lag> <dropped> <failed>``.
+    """
+    messages = []
+    for device_number, device in snapshot['devices'].items():
+        messages.append(["device", device_number, float(device['rate']), float(device['jitter_ms']),
+                         int(device['packets']), int(device.get('missing', 0)),
+                         int(device.get('duplicates', 0)), int(device.get('late', 0)),
+                         float(device.get('first_sample_ms') or 0.0), int(device.get('drops', 0)),
+                         int(device.get('malformed', 0))])
+    for kind in ('stages', 'latency'):
+        for name, summary in snapshot[kind].items():
+            message = [kind.rstrip('s'), name, int(summary['count']),
+                       float(summary['p50_ms'] or 0.0), float(summary['p99_ms'] or 0.0),
+                       float(summary['max_ms'])]
+            if kind == 'stages':
+                message += [int(summary.get('dropped', 0)), int(summary.get('errors', 0))]
+            messages.append(message)
+    log = snapshot.get('log')
+    if log:
+        messages.append(["log", int(log.get('lag', 0)), int(log.get('dropped', 0)), int(log.get('failed', 0))])
+
+    return messages
+
+
+def format_metrics(snapshot: dict) -> str:
+    """Short multi-line summary for the Monitoring frame"""
+    if not snapshot:
+        return ""
+    lines = []
+    for device_number, device in snapshot['devices'].items():
+        line = f"{device_number}: {device['rate']:6.1f} Hz  jitter {device['jitter_ms']:5.2f} ms"
+        if 'missing' in device:
+            line += f"  lost {device['missing']} dup {device['duplicates']} late {device['late']}"
+        if device.get('drops'):
+            line += f"  drops {device['drops']}"
+        if device.get('malformed'):
+            line += f"  malformed {device['malformed']}"
+        if device.get('first_sample_ms') is not None:
+            line += f"  first {device['first_sample_ms']:.0f} ms"
+        lines.append(line)
+    for name, summary in {**snapshot['stages'], **snapshot['latency']}.items():
+        if summary['p99_ms'] is not None:
+            line = f"{name:>8}: p50 {summary['p50_ms']:7.3f} ms  p99 {summary['p99_ms']:7.3f} ms"
+            if summary.get('dropped'):
+                line += f"  dropped {summary['dropped']}"
+            if summary.get('errors'):
+                line += f"  errors {summary['errors']}"
+            lines.append(line)
+    log = snapshot.get('log', {})
+    if log.get('dropped') or log.get('failed'):
+        lines.append(f"     log: dropped {log.get('dropped', 0)}  failed {log.get('failed', 0)}")
+
+    return "\n".join(lines)
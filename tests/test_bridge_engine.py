@@ -0,0 +1,161 @@
+# Developed by Paulo Chiliguano and KA HO Wong
+# Directed by Dr Roberto Alonso Trillo
+# HKBU Academy of Music
+# 2024
+
+import asyncio
+import struct
+import sys
+import threading
+from pathlib import Path
+from time import perf_counter
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import bridge_engine  # noqa: E402
+from bridge_engine import BridgeEngine, load_configuration  # noqa: E402
+from capture import SENSORTILE, CaptureWriter  # noqa: E402
+from replay import replay  # noqa: E402
+
+
+PACKET = struct.Struct('<H9h')
+PERIOD = 0.008  # NOTE: One counter tick of sensortile.toml per sample
+
+
+def packet(counter: int) -> bytes:
+    return PACKET.pack(counter & 0xFFFF, 10, 20, 1000, 5, 6, 7, 300, 200, 100)
+
+
+@pytest.fixture
+def engine(tmp_path, monkeypatch):
+    monkeypatch.setattr(bridge_engine, 'log_file_path', lambda extension: tmp_path / f"session.{extension}")
+    configuration_dict = load_configuration(ROOT / "sensortile.toml")
+    configuration_dict['calibration']['profiles'] = ""
+    configuration_dict['connection']['known-devices'] = ""
+    configuration_dict['metrics'] = {'interval': 1.0, 'osc': False, 'file': False}
+    return BridgeEngine(configuration_dict)
+
+
+def run_session(engine, counters, arrival):
+    """Fuses one packet per counter value and returns the integration periods"""
+    async def session():
+        await engine.start_session([(0, "AA:BB:CC:DD:EE:FF")])
+        periods = []
+        for i, counter in enumerate(counters):
+            sample = engine.layout.decode(packet(counter)).tolist()[0]
+            engine._fuse_stage(0, (arrival + i * PERIOD, sample))
+            periods.append(engine.device_models[0].fusion_filter.period)
+        await engine.stop_session()
+        return periods
+
+    return asyncio.run(session())
+
+
+@pytest.mark.parametrize('tick', [PERIOD, 0.0])
+def test_reconnect_keeps_time_base(engine, tick):
+    engine.timestamp_tick = tick  # NOTE: 0 integrates on host arrival time
+    run_session(engine, range(300), arrival=1000.0)
+    # NOTE: Reconnected five seconds later, the device counter went on meanwhile
+    periods = run_session(engine, range(925, 1225), arrival=1007.4)
+
+    assert 0.0 < periods[0] < 0.1
+    assert min(periods) >= 0.0
+    assert periods[-1] == pytest.approx(PERIOD, rel=0.05)
+
+
+def test_slow_stage_never_blocks_notifications(engine):
+    engine.configuration_dict['pipeline']['queue-size'] = 8
+    released = threading.Event()
+
+    def stalled_fuse(device_number, item):
+        released.wait()
+
+    engine._fuse_stage = stalled_fuse
+
+    async def session():
+        await engine.start_session([(0, "AA:BB:CC:DD:EE:FF")])
+        start = perf_counter()
+        for counter in range(1000):
+            engine.notification_handler(0, 0, packet(counter))
+        elapsed = perf_counter() - start
+        engine._publish_metrics()
+        metrics = engine.metrics
+        released.set()
+        await engine.stop_session()
+        return elapsed, metrics
+
+    elapsed, metrics = asyncio.run(session())
+
+    assert elapsed < 1.0
+    assert metrics['stages']['decode']['dropped'] > 0
+
+
+def test_samples_of_one_notification_get_their_own_time(engine):
+    async def session():
+        await engine.start_session([(0, "AA:BB:CC:DD:EE:FF")])
+        times = []
+        for notification in range(50):
+            arrival = 1000.0 + notification * 4 * PERIOD
+            data = b"".join(packet(notification * 4 + i) for i in range(4))
+            for item in engine._decode_stage(0, (arrival, data)):
+                times.append((arrival, engine._fuse_stage(0, item)[3]))
+        await engine.stop_session()
+        return times
+
+    times = asyncio.run(session())
+    arrivals, device_times = zip(*times[-8:])
+
+    assert len(set(arrivals)) == 2
+    assert all(b - a == pytest.approx(PERIOD, rel=0.05) for a, b in zip(device_times, device_times[1:]))
+    assert abs(device_times[-1] - arrivals[-1]) < 0.1
+
+
+def test_disconnect_while_scanning_ends_the_run(tmp_path, monkeypatch):
+    monkeypatch.setattr(bridge_engine, 'log_file_path', lambda extension: tmp_path / f"session.{extension}")
+    configuration_dict = load_configuration(ROOT / "sensortile.toml")
+    configuration_dict['simulation'].update({'enabled': True, 'devices': 1})
+    configuration_dict['metrics'] = {'interval': 1.0, 'osc': False, 'file': False}
+    engine = BridgeEngine(configuration_dict)
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        loop.call_later(0.1, lambda: loop.create_task(engine.disconnect()))
+        return await asyncio.wait_for(engine.run(scan_time=0.3), 5.0)
+
+    assert asyncio.run(run())
+    assert engine.pipeline is None
+
+
+def test_replay_refuses_a_capture_of_another_protocol(engine, tmp_path):
+    path = tmp_path / "nordic.mbcap"
+    with CaptureWriter(path, {'device': {'protocol': "nordic"}}) as capture:
+        capture.write(SENSORTILE, 0, packet(0))
+
+    with pytest.raises(ValueError, match="nordic"):
+        asyncio.run(replay(engine, path, 0.0))
+    assert engine.pipeline is None
+
+
+def test_data_files_are_kept_beside_the_configuration(tmp_path):
+    (tmp_path / "bow.toml").write_text('[connection]\nknown-devices = "state/devices.json"\n')
+    configuration_dict = load_configuration(tmp_path / "bow.toml")
+    assert configuration_dict['connection']['known-devices'] == str(tmp_path / "state" / "devices.json")
+    assert configuration_dict['calibration']['profiles'] == str(tmp_path / "calibration_profiles.json")
+
+
+def test_short_notifications_are_dropped_and_counted(engine):
+    async def session():
+        await engine.start_session([(0, "AA:BB:CC:DD:EE:FF")])
+        results = [engine._decode_stage(0, (1000.0, data)) for data in (packet(0)[:12], packet(1) + packet(2)[:10],
+                                                                         packet(3) + packet(4))]
+        engine._publish_metrics()
+        await engine.stop_session()
+        return results
+
+    short, truncated, whole = asyncio.run(session())
+    assert short is None and truncated is None
+    assert [sample[0] for _, sample in whole] == [3.0, 4.0]
+    assert engine.metrics['devices']['0']['malformed'] == 2
@@ -0,0 +1,84 @@
+# Developed by Paulo Chiliguano and KA HO Wong
+# Directed by Dr Roberto Alonso Trillo
+# HKBU Academy of Music
+# 2024
+
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from calibration import EllipsoidFit, RunningMean, StaticDetector  # noqa: E402
+
+GYRO_BIAS = np.array([0.8, -1.5, 0.3])
+CENTER = np.array([120.0, -45.0, 60.0])
+RADII = np.array([480.0, 520.0, 450.0])
+
+
+def unit_vectors(rng, count):
+    points = rng.normal(size=(count, 3))
+    return points / np.linalg.norm(points, axis=1, keepdims=True)
+
+
+def test_static_detector_needs_a_held_rest():
+    rng = np.random.default_rng(1)
+    detector = StaticDetector(hold=50)
+    gravity = np.array([0.0, 0.0, 1000.0])
+    at_rest = [detector.update(gravity + rng.normal(0, 2, 3), GYRO_BIAS + rng.normal(0, 0.2, 3))
+               for _ in range(200)]
+    assert not any(at_rest[:50])
+    assert all(at_rest[100:])
+
+    for _ in range(20):
+        moving = detector.update(gravity + rng.normal(0, 200, 3), rng.normal(0, 50, 3))
+    assert not moving
+    assert detector.run == 0
+
+
+def test_running_mean_estimates_the_gyro_bias():
+    rng = np.random.default_rng(2)
+    mean = RunningMean()
+    for _ in range(2000):
+        mean.add(GYRO_BIAS + rng.normal(0, 0.5, 3))
+    assert mean.count == 2000
+    assert np.allclose(mean.mean, GYRO_BIAS, atol=0.05)
+
+
+def test_running_mean_follows_drift_past_its_horizon():
+    rng = np.random.default_rng(3)
+    welford, ema = RunningMean(), RunningMean(horizon=100)
+    for _ in range(1000):
+        sample = GYRO_BIAS + rng.normal(0, 0.1, 3)
+        welford.add(sample)
+        ema.add(sample)
+    for _ in range(1000):
+        sample = GYRO_BIAS + 1.0 + rng.normal(0, 0.1, 3)
+        welford.add(sample)
+        ema.add(sample)
+    assert np.allclose(welford.mean, GYRO_BIAS + 0.5, atol=0.05)
+    assert np.allclose(ema.mean, GYRO_BIAS + 1.0, atol=0.05)
+
+
+@pytest.mark.parametrize('axis_aligned', [True, False])
+def test_ellipsoid_fit_recovers_offset_and_scale(axis_aligned):
+    rng = np.random.default_rng(4)
+    fit = EllipsoidFit(axis_aligned=axis_aligned)
+    for direction in unit_vectors(rng, 200):
+        fit.add(CENTER + RADII * direction + rng.normal(0, 1, 3))
+
+    center, transform, radii = fit.solve()
+    assert np.allclose(center, CENTER, atol=3.0)
+    assert np.allclose(np.sort(radii), np.sort(RADII), rtol=0.01)
+    # NOTE: The transform maps the ellipsoid back onto the unit sphere
+    corrected = np.linalg.norm((CENTER + RADII * unit_vectors(rng, 50) - center) @ transform.T, axis=1)
+    assert np.allclose(corrected, 1.0, atol=0.01)
+
+
+def test_ellipsoid_fit_waits_for_enough_points():
+    fit = EllipsoidFit()
+    for point in ([500.0, 0.0, 0.0], [0.0, 500.0, 0.0], [0.0, 0.0, 500.0]):
+        fit.add(point)
+    assert fit.solve() is None
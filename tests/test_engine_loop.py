@@ -0,0 +1,50 @@
+# Developed by Paulo Chiliguano and KA HO Wong
+# Directed by Dr Roberto Alonso Trillo
+# HKBU Academy of Music
+# 2024
+
+import asyncio
+import sys
+from pathlib import Path
+from time import perf_counter, sleep
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from bridge_engine import EngineLoop  # noqa: E402
+
+PERIOD = 0.005
+WAKE_UPS = 400
+MAX_P99_LATENESS = 0.010
+
+
+def gui_work(seconds: float):
+    """Redraw-like main thread work: pure Python holding the GIL, then a blocking call"""
+    deadline = perf_counter() + seconds
+    while perf_counter() < deadline:
+        sum(i * i for i in range(2000))
+        sleep(0.002)
+
+
+def test_engine_loop_wakes_up_while_the_main_thread_is_busy():
+    async def tick():
+        lateness = []
+        deadline = perf_counter()
+        for _ in range(WAKE_UPS):
+            deadline += PERIOD
+            await asyncio.sleep(max(deadline - perf_counter(), 0.0))
+            lateness.append(perf_counter() - deadline)
+        return lateness
+
+    engine_loop = EngineLoop()
+    engine_loop.start()
+    try:
+        future = engine_loop.submit(tick())
+        while not future.done():
+            gui_work(0.1)
+        lateness = future.result()
+    finally:
+        engine_loop.stop()
+
+    assert np.percentile(lateness, 99) < MAX_P99_LATENESS
@@ -0,0 +1,105 @@
+# Developed by Paulo Chiliguano and KA HO Wong
+# Directed by Dr Roberto Alonso Trillo
+# HKBU Academy of Music
+# 2024
+
+import asyncio
+import socket
+import sys
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import bridge_engine  # noqa: E402
+from bridge_engine import BridgeEngine, load_configuration  # noqa: E402
+from osc_output import Destination, OscFanout  # noqa: E402
+
+
+@pytest.fixture
+def sinks():
+    sockets = []
+    for _ in range(2):
+        sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sink.bind(("127.0.0.1", 0))
+        sink.setblocking(False)
+        sockets.append(sink)
+    yield sockets
+    for sink in sockets:
+        sink.close()
+
+
+def received(sink) -> list:
+    datagrams = []
+    while True:
+        try:
+            datagrams.append(sink.recv(65536))
+        except BlockingIOError:
+            return datagrams
+
+
+def test_bridge_streams_need_an_explicit_pattern():
+    assert not Destination("127.0.0.1", 9000).wants("bridge/metrics")
+    assert Destination("127.0.0.1", 9000).wants("quaternion")
+    assert Destination("127.0.0.1", 9000, ["bridge/*"]).wants("bridge/metrics")
+
+
+def test_metrics_only_reach_subscribed_destinations(sinks, tmp_path, monkeypatch):
+    monkeypatch.setattr(bridge_engine, 'log_file_path', lambda extension: tmp_path / f"session.{extension}")
+    audio, monitor = sinks
+    configuration_dict = load_configuration(ROOT / "metabow.toml")
+    configuration_dict['calibration']['profiles'] = ""
+    configuration_dict['metrics'].update({'osc': True, 'file': False})
+    configuration_dict['destinations'] = [
+        {'port': audio.getsockname()[1], 'streams': ["quaternion"]},
+        {'port': monitor.getsockname()[1], 'streams': ["bridge/metrics"]},
+    ]
+    engine = BridgeEngine(configuration_dict)
+
+    async def session():
+        await engine.start_session([(0, "AA:BB:CC:DD:EE:FF")])
+        engine._publish_metrics()
+        engine.fanout.send(b"/nothing\x00\x00\x00\x00,\x00\x00\x00", [])
+        await asyncio.sleep(0.05)
+        await engine.stop_session()
+
+    asyncio.run(session())
+
+    assert received(audio) == []
+    assert any(i.startswith(b"/bridge/metrics") for i in received(monitor))
+
+
+def test_ipv6_destination():
+    try:
+        sink = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
+        sink.bind(("::1", 0))
+    except OSError:
+        pytest.skip("no IPv6 loopback")
+    sink.settimeout(1.0)
+    fanout = OscFanout([Destination("::1", sink.getsockname()[1])])
+
+    async def send():
+        await fanout.open()
+        fanout.send(b"/ping\x00\x00\x00,\x00\x00\x00")
+        await asyncio.sleep(0.05)
+        fanout.close()
+
+    asyncio.run(send())
+    with sink:
+        assert sink.recv(64) == b"/ping\x00\x00\x00,\x00\x00\x00"
+
+
+def test_unresolved_destination_ends_the_session(tmp_path, monkeypatch):
+    monkeypatch.setattr(bridge_engine, 'log_file_path', lambda extension: tmp_path / f"session.{extension}")
+    configuration_dict = load_configuration(ROOT / "metabow.toml")
+    configuration_dict['calibration']['profiles'] = ""
+    configuration_dict['simulation'].update({'enabled': True, 'devices': 1})
+    configuration_dict['destinations'] = [{'host': "no-such-host.invalid", 'port': 9000}]
+    engine = BridgeEngine(configuration_dict)
+
+    with pytest.raises(OSError):
+        asyncio.run(engine.connect(["SIM:00"]))
+    assert not engine.is_notify_loop
+    assert engine._metrics_task is None
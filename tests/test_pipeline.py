@@ -0,0 +1,28 @@
+# Developed by Paulo Chiliguano and KA HO Wong
+# Directed by Dr Roberto Alonso Trillo
+# HKBU Academy of Music
+# 2024
+
+import logging
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from pipeline import Pipeline  # noqa: E402
+
+
+def test_stage_errors_are_counted_and_rate_limited(caplog):
+    def failing(key, item):
+        raise ValueError(item)
+
+    pipeline = Pipeline([('fail', failing)])
+    pipeline.start()
+    with caplog.at_level(logging.ERROR, logger="pipeline"):
+        for i in range(100):
+            pipeline.submit(0, i)
+        pipeline.stop()
+
+    assert pipeline.stats()['fail']['errors'] == 100
+    assert len(caplog.records) == 1
+    assert caplog.records[0].exc_info[0] is ValueError
@@ -0,0 +1,89 @@
+# Developed by Paulo Chiliguano and KA HO Wong
+# Directed by Dr Roberto Alonso Trillo
+# HKBU Academy of Music
+# 2024
+
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from sequence_tracker import InterpolatedSample, SequenceTracker  # noqa: E402
+
+TICK = 0.008  # NOTE: SensorTile counter tick
+PERIOD = 0.010
+
+
+def sample(index: int, start: int = 0):
+    """Arrival time and decoded sample ``index`` of a device whose counter started at ``start``"""
+    return index * PERIOD, [float((start + int(index * PERIOD / TICK)) % 65536), float(index), 2.0 * index]
+
+
+def feed(tracker: SequenceTracker, indices, start: int = 0):
+    forwarded = []
+    for index in indices:
+        forwarded.extend(tracker.update(*sample(index, start)))
+    return forwarded
+
+
+def test_in_order_samples_are_forwarded():
+    tracker = SequenceTracker()
+    forwarded = feed(tracker, range(200))
+    assert [values[1] for _, values in forwarded] == list(range(200))
+    assert tracker.counters() == {'received': 200, 'gaps': 0, 'missing': 0, 'duplicates': 0, 'late': 0,
+                                  'interpolated': 0, 'resyncs': 0}
+    assert abs(tracker.period - PERIOD / TICK) < 0.01
+
+
+def test_gap_is_counted_and_interpolated():
+    tracker = SequenceTracker(interpolate=4)
+    forwarded = feed(tracker, [*range(50), *range(53, 100)])
+    assert tracker.gaps == 1
+    assert tracker.missing == 3
+    assert tracker.interpolated == 3
+
+    filled = [(sample_time, values) for sample_time, values in forwarded if isinstance(values, InterpolatedSample)]
+    assert [values[1:] for _, values in filled] == [[50.0, 100.0], [51.0, 102.0], [52.0, 104.0]]
+    for (sample_time, values), index in zip(filled, (50, 51, 52)):
+        expected_time, expected = sample(index)
+        assert abs(sample_time - expected_time) < 1e-9
+        assert abs(values[0] - expected[0]) <= 1
+    assert [values[1] for _, values in forwarded] == list(range(100))
+
+
+def test_long_gap_is_counted_but_not_interpolated():
+    tracker = SequenceTracker(interpolate=2)
+    forwarded = feed(tracker, [*range(50), *range(55, 100)])
+    assert tracker.missing == 5
+    assert tracker.interpolated == 0
+    assert len(forwarded) == 95
+
+
+def test_duplicate_is_dropped():
+    tracker = SequenceTracker()
+    forwarded = feed(tracker, [*range(30), 29, *range(30, 60)])
+    assert tracker.duplicates == 1
+    assert tracker.missing == 0
+    assert [values[1] for _, values in forwarded] == list(range(60))
+
+
+def test_late_sample_is_dropped_and_no_longer_missing():
+    tracker = SequenceTracker()
+    forwarded = feed(tracker, [*range(40), 41, 40, *range(42, 80)])
+    assert tracker.gaps == 1
+    assert tracker.late == 1
+    assert tracker.missing == 0
+    assert 40.0 not in [values[1] for _, values in forwarded]
+
+
+def test_counter_wrap_is_not_a_gap():
+    start = 65536 - 100
+    tracker = SequenceTracker(interpolate=4)
+    forwarded = feed(tracker, range(300), start)
+    assert any(values[0] < 100 for _, values in forwarded)
+    assert tracker.counters()['missing'] == 0
+    assert tracker.resyncs == 0
+
+    forwarded = feed(tracker, range(302, 320), start)
+    assert tracker.missing == 2
+    assert [values[1] for _, values in forwarded[:2]] == [300.0, 301.0]
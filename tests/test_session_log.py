@@ -0,0 +1,103 @@
+# Developed by Paulo Chiliguano and KA HO Wong
+# Directed by Dr Roberto Alonso Trillo
+# HKBU Academy of Music
+# 2024
+
+import sys
+import threading
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from session_log import BinaryLog, SessionLogWriter, TimestampParser  # noqa: E402
+
+ROW = [0, "20240101_000000.000000", *range(25)]
+SAMPLE_TIME = 1700000000.123456
+
+
+class StalledWriter:
+    """CsvLogWriter stand-in whose writes wait for ``release``, or raise once it is set with ``fail``"""
+    release = threading.Event()
+    fail = False
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.touch()
+
+    def write_rows(self, rows):
+        self.release.wait()
+        if self.fail:
+            raise OSError("disk full")
+
+    def tell(self):
+        return 0
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def stalled_log(tmp_path, policy, fail=False):
+    StalledWriter.release = threading.Event()
+    StalledWriter.fail = fail
+    log_writer = SessionLogWriter(lambda extension: tmp_path / f"session.{extension}", flush_rows=4,
+                                  flush_interval=0.01, policy=policy)
+    log_writer.writer_class = StalledWriter
+    log_writer.start()
+    return log_writer
+
+
+def test_full_buffer_drops_the_oldest_rows(tmp_path):
+    log_writer = stalled_log(tmp_path, 'drop-oldest')
+    for _ in range(1000):
+        log_writer.write(ROW)
+    stats = log_writer.stats()
+    StalledWriter.release.set()
+    log_writer.stop()
+
+    assert stats['lag'] <= log_writer.max_rows
+    assert stats['dropped'] >= 1000 - 2 * log_writer.max_rows
+    assert log_writer.rows_written + log_writer.dropped == 1000
+
+
+def test_full_buffer_blocks_the_caller(tmp_path):
+    log_writer = stalled_log(tmp_path, 'block')
+    writing = threading.Thread(target=lambda: [log_writer.write(ROW) for _ in range(1000)])
+    writing.start()
+    writing.join(0.2)
+    assert writing.is_alive()
+    assert log_writer.stats()['lag'] <= log_writer.max_rows
+
+    StalledWriter.release.set()
+    writing.join(5.0)
+    log_writer.stop()
+    assert log_writer.rows_written == 1000
+    assert log_writer.dropped == 0
+
+
+def test_failed_writes_count_their_rows(tmp_path):
+    log_writer = stalled_log(tmp_path, 'block', fail=True)
+    StalledWriter.release.set()
+    for _ in range(10):
+        log_writer.write(ROW)
+    log_writer.stop()
+
+    stats = log_writer.stats()
+    assert stats['failed'] == 10
+    assert stats['errors'] >= 1
+    assert stats['rows_written'] == 0
+
+
+def test_float_sample_times_are_only_formatted_for_csv(tmp_path):
+    for format in ('csv', 'binary'):
+        log_writer = SessionLogWriter(lambda extension: tmp_path / f"session.{extension}", format=format)
+        log_writer.start()
+        log_writer.write([0, SAMPLE_TIME, *map(float, range(25))])
+        log_writer.stop()
+        if format == 'binary':
+            assert BinaryLog(log_writer.path).column('timestamp')[0] == SAMPLE_TIME
+        else:
+            timestamp = log_writer.path.read_text().splitlines()[1].split(',')[1]
+            assert abs(TimestampParser()(timestamp) - SAMPLE_TIME) < 1e-6
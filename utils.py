@@ -4,16 +4,30 @@
 # 2024
 
 
-import quaternion
+import numpy as np
 from datetime import datetime
 from os import makedirs
 from os.path import expandvars, isdir
 from pathlib import Path
 from platform import system
-from typing import ByteString, List
+from typing import ByteString, Callable, List, NamedTuple
 
 
-Array = List[int]
+SENSORTILE_PACKET_DTYPE = np.dtype([
+    ('timestamp', '<u2'),
+    ('accl', '<i2', (3,)),
+    ('gyro', '<i2', (3,)),
+    ('magn', '<i2', (3,)),
+])
+SENSORTILE_PACKET_SIZE = SENSORTILE_PACKET_DTYPE.itemsize
+SENSORTILE_FIELDS = 10  # NOTE: timestamp followed by accl, gyro and magn X, Y, Z
+
+NORDIC_RECORD_DTYPE = np.dtype([
+    ('values', '<f4', (13,)),  # NOTE: accl (g), gyro (deg/s), magn, orientation quaternion (w, x, y, z)
+    ('flag', 'u1'),
+])
+NORDIC_RECORD_SIZE = NORDIC_RECORD_DTYPE.itemsize
+NORDIC_FIELDS = 13
 
 
 def bytearray_to_fusion_data(data: ByteString) -> List[float]:
@@ -29,30 +43,41 @@ def bytearray_to_fusion_data(data: ByteString) -> List[float]:
     list
         A list of floats representing the timestamp and coordinates values
     """
-    raw_list = _int_list_from_bytearray(data)
-    raw_list[4:7] = _scale_gyroscope_coordinates(raw_list[4:7])
-
-    return [float(f'{i:.1f}') for i in raw_list]
+    return decode_sensortile_packets(data)[0].tolist()
 
 
-def _scale_gyroscope_coordinates(data: Array) -> Array:
-    """Scale gyroscope data 1/10x as it comes multiplied
+def decode_sensortile_packets(data: ByteString, out: np.ndarray | None = None) -> np.ndarray:
+    """Decodes one or several concatenated SensorTile packets
 
     Parameters
     ----------
-    data : list
-        X, Y, Z coordinates data (int16 each)
+    data : bytearray
+        bytes from BLE device, a multiple of SENSORTILE_PACKET_SIZE
+    out : numpy.ndarray, optional
+        Preallocated float array of shape (N, 10) receiving the result
 
     Returns
     -------
-    list
-        A list of floats corresponding to coordinates data of the Blue ST gyroscope
+    numpy.ndarray
+        (N, 10) array with the timestamp, accl, gyro (scaled 1/10x) and magn values
     """
-    return [0.1*i for i in data]
+    count = len(data) // SENSORTILE_PACKET_SIZE
+    packets = np.frombuffer(data, dtype=SENSORTILE_PACKET_DTYPE, count=count)
+    if out is None:
+        out = np.empty((count, SENSORTILE_FIELDS))
+    out[:count, 0] = packets['timestamp']
+    out[:count, 1:4] = packets['accl']
+    np.divide(packets['gyro'], 10.0, out=out[:count, 4:7])
+    out[:count, 7:10] = packets['magn']
+
+    return out[:count]
+
 
+def decode_nordic_records(data: ByteString) -> np.ndarray:
+    """Decodes the valid samples of a Nordic IMU notification
 
-def _int_list_from_bytearray(data: ByteString) -> Array:
-    """Converts a bytearray to a list of signed integers
+    A notification holds one or several records of 13 floats followed by a
+    flag byte, aligned to its end; records whose flag is not 1 are skipped.
 
     Parameters
     ----------
@@ -61,48 +86,54 @@ def _int_list_from_bytearray(data: ByteString) -> Array:
 
     Returns
     -------
-    list
-        A list of integers representing the timestamp and coordinates values
+    numpy.ndarray
+        (N, 13) array of the valid samples
     """
-    step = 2
-    timestamp = [uint16_from_bytes(data[0:step]),]
-    sensor_data = [int16_from_bytes(data[i:i+step]) for i in range(step, len(data) - 1, step)]
-
-    return timestamp + sensor_data
+    count = len(data) // NORDIC_RECORD_SIZE
+    records = np.frombuffer(data, dtype=NORDIC_RECORD_DTYPE, count=count,
+                            offset=len(data) - count * NORDIC_RECORD_SIZE)
 
+    return records['values'][records['flag'] == 1].astype(np.float64)
 
-def int16_from_bytes(data: ByteString) -> int:
-    """Converts Little Indian (LE) bytes into integer
 
-    Parameters
-    ----------
-    data : bytearray
-        bytes subset in LE order
+class PacketLayout(NamedTuple):
+    """Where the sensors are in the decoded samples of a protocol
 
-    Returns
-    -------
-    int
-        Equivalent int16 signed integer
+    ``accl_scale`` converts the accelerometer to mg, the unit expected by
+    GestureModel; ``counter`` is the column of the packet counter, if any.
+    A notification holds whole ``packet_size`` packets, or with ``padded``
+    at least one packet after a header of any length.
     """
+    decode: Callable
+    accl: slice
+    gyro: slice
+    magn: slice
+    accl_scale: float
+    counter: int | None
+    packet_size: int
+    padded: bool
 
-    return int.from_bytes(data, byteorder='little', signed=True)
+    def complete(self, data: ByteString) -> bool:
+        """Whether ``data`` is a notification ``decode`` reads without losing bytes"""
+        size = len(data)
+        return size >= self.packet_size and (self.padded or size % self.packet_size == 0)
 
 
-def uint16_from_bytes(data: ByteString) -> int:
-    """Converts Little Indian (LE) bytes into unsigned integer
+PACKET_LAYOUTS = {
+    'sensortile': PacketLayout(decode_sensortile_packets, slice(1, 4), slice(4, 7), slice(7, 10), 1.0, 0,
+                               SENSORTILE_PACKET_SIZE, False),
+    'nordic': PacketLayout(decode_nordic_records, slice(0, 3), slice(3, 6), slice(6, 9), 1000.0, None,
+                           NORDIC_RECORD_SIZE, True),
+}
 
-    Parameters
-    ----------
-    data : bytearray
-        bytes subset in LE order
 
-    Returns
-    -------
-    int
-        Equivalent uint16 integer
-    """
+def sensor_values(layout: PacketLayout, sample: List[float]) -> List[float]:
+    """accl (mg), gyro and magn values of a decoded sample, as logged"""
+    accl = sample[layout.accl]
+    if layout.accl_scale != 1.0:
+        accl = [i * layout.accl_scale for i in accl]
 
-    return int.from_bytes(data, byteorder='little', signed=False)
+    return [*accl, *sample[layout.gyro], *sample[layout.magn]]
 
 
 def _create_folder_in_desktop(dir: str):
@@ -118,16 +149,11 @@ def get_home_folder() -> str:
     return expandvars(r"$HOME")
 
 
-def log_file_path() -> str:
+def log_file_path(extension: str = "csv") -> str:
     log_dir = Path(get_home_folder()) / "Desktop" / "Metabow Logs"
 
     _create_folder_in_desktop(log_dir)
     now = datetime.now().strftime("%Y%m%d_%H%M%S")
-    filename = log_dir / f"mb_{now}.csv"
+    filename = log_dir / f"mb_{now}.{extension}"
 
     return filename
-
-
-def pyquaternion_as_spherical_coords(elements):
-    elems = quaternion.from_float_array(elements)
-    return quaternion.as_spherical_coords(elems)